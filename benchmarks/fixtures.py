@@ -0,0 +1,332 @@
+""" Fixtures for the offline benchmarks: synthetic generators and recorders.
+
+    A fixture directory holds:
+
+        products.json               [{"id": "BTC-USD"}, ...]
+        level2.jsonl.gz             one websocket message per line: a level2
+                                    snapshot per product, then l2update deltas
+                                    and heartbeats
+        candles.json.gz             {market: [[time, low, high, open, close,
+                                    volume], ...]}, newest first, as returned
+                                    by get_product_historic_rates
+        tradingview_{MARKET}.html   technicals page for each market
+
+    Synthetic fixtures are deterministic for a given seed. Recorded ones are
+    captured from the live exchange and tradingview.com. TradingView's page
+    is a JavaScript app that won't render offline, so its recorder scrapes
+    the real values and writes them into the same self-contained page the
+    generator uses.
+
+    $ python -m benchmarks.fixtures generate DIR [--products N] [--updates N]
+    $ python -m benchmarks.fixtures record DIR [--seconds N] [--hours N]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import time
+
+
+TIME_INTERVALS = ['1_min', '5_min', '15_min', '1_hour', '4_hour', '1_day',
+                  '1_week', '1_month']
+TRADINGVIEW_MARKETS = ['BCHUSD', 'BTCUSD', 'ETHUSD', 'LTCUSD']
+SIGNAL_WORDS = ['Strong Sell', 'Sell', 'Neutral', 'Buy', 'Strong Buy']
+DEFAULT_PRODUCTS = ['BTC-USD', 'ETH-USD', 'LTC-USD', 'BCH-USD', 'ETH-BTC', 'LTC-BTC',
+                    'BCH-BTC', 'BTC-EUR', 'ETH-EUR', 'LTC-EUR', 'BCH-EUR', 'BTC-GBP']
+HEARTBEAT_EVERY = 1000  # l2updates between heartbeat rounds
+
+
+def product_list(count):
+    products = DEFAULT_PRODUCTS[:count]
+    while len(products) < count:
+        products.append('SYN{0}-USD'.format(len(products)))
+    return products
+
+
+def _price(value):
+    return '{0:.2f}'.format(value)
+
+
+def _iso(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + '.000000Z'
+
+
+def synthetic_level2(product_ids, levels=20000, updates=100000, seed=0):
+    """ Yields a snapshot per product, then `updates` l2update messages spread
+        across them, with a heartbeat per product every HEARTBEAT_EVERY
+        updates. As on the real level2 channel, snapshots and l2updates carry
+        no sequence; only heartbeats do, and theirs never gap. Bids stay below
+        and asks above each product's mid, so books never cross.
+    """
+    rng = random.Random(seed)
+    mids = {}
+    sequences = {}
+    for i, product_id in enumerate(product_ids):
+        mid = round(rng.uniform(50, 15000), 2)
+        mids[product_id] = mid
+        sequences[product_id] = rng.randint(1000, 10 ** 6)
+        tick = max(0.01, round(mid * 0.00002, 2))
+        yield {
+            'type': 'snapshot',
+            'product_id': product_id,
+            'bids': [[_price(mid - tick * (n + 1)), '{0:.8f}'.format(rng.expovariate(1.0))]
+                     for n in range(levels)],
+            'asks': [[_price(mid + tick * (n + 1)), '{0:.8f}'.format(rng.expovariate(1.0))]
+                     for n in range(levels)],
+        }
+    timestamp = time.time()
+    for n in range(updates):
+        if n % HEARTBEAT_EVERY == 0:
+            for heartbeat_id in product_ids:
+                sequences[heartbeat_id] += 1
+                yield {'type': 'heartbeat', 'product_id': heartbeat_id,
+                       'sequence': sequences[heartbeat_id],
+                       'last_trade_id': sequences[heartbeat_id],
+                       'time': _iso(timestamp + n * 0.001)}
+        product_id = product_ids[n % len(product_ids)]
+        mid = mids[product_id]
+        changes = []
+        for _ in range(rng.choice((1, 1, 1, 2, 3))):
+            offset = mid * min(0.2, rng.expovariate(400.0)) + 0.01
+            side = rng.choice(('buy', 'sell'))
+            price = mid - offset if side == 'buy' else mid + offset
+            size = 0.0 if rng.random() < 0.35 else rng.expovariate(1.0)
+            changes.append([side, _price(price), '{0:.8f}'.format(size)])
+        yield {
+            'type': 'l2update',
+            'product_id': product_id,
+            'time': _iso(timestamp + n * 0.001),
+            'changes': changes,
+        }
+
+
+def synthetic_candles(product_ids, minutes=7 * 24 * 60, end=None, seed=0):
+    """ {market: rows} of 1-minute candles ending at `end`, newest first. """
+    rng = random.Random(seed)
+    end = int(end or time.time())
+    end -= end % 60
+    candles = {}
+    for product_id in product_ids:
+        price = rng.uniform(50, 15000)
+        rows = []
+        for n in range(minutes):
+            t = end - (minutes - n) * 60
+            open_ = price
+            close = price * (1 + rng.gauss(0, 0.001))
+            high = max(open_, close) * (1 + abs(rng.gauss(0, 0.0005)))
+            low = min(open_, close) * (1 - abs(rng.gauss(0, 0.0005)))
+            rows.append([t, round(low, 2), round(high, 2), round(open_, 2), round(close, 2),
+                         round(rng.expovariate(0.2), 8)])
+            price = close
+        rows.reverse()
+        candles[product_id] = rows
+    return candles
+
+
+def synthetic_signals(market, seed=0):
+    rng = random.Random('{0}-{1}'.format(market, seed))
+    signals = {'market': market}
+    for interval in TIME_INTERVALS:
+        counts = [rng.randint(0, 17) for _ in range(3)]
+        signals[interval] = {'sell_count': counts[0], 'neutral_count': counts[1],
+                             'buy_count': counts[2], 'signal_word': rng.choice(SIGNAL_WORDS)}
+    return signals
+
+
+TRADINGVIEW_PAGE = """<!DOCTYPE html>
+<html><head><title>{market} technicals</title></head>
+<body>
+<div id="technicals-root"><div><div>
+  <div><div>{buttons}</div></div>
+  <div>
+    <div></div>
+    <div>
+      <span>Summary</span><span id="word"></span>
+      <div></div>
+      <div>
+        <div><span id="sell"></span><span>Sell</span></div>
+        <div><span id="neutral"></span><span>Neutral</span></div>
+        <div><span id="buy"></span><span>Buy</span></div>
+      </div>
+    </div>
+  </div>
+</div></div></div>
+<script>
+var signals = {signals};
+var intervals = {intervals};
+function show(i) {{
+  var s = signals[intervals[i]];
+  setTimeout(function() {{
+    document.getElementById('word').textContent = s.signal_word;
+    document.getElementById('sell').textContent = s.sell_count;
+    document.getElementById('neutral').textContent = s.neutral_count;
+    document.getElementById('buy').textContent = s.buy_count;
+  }}, {render_delay});
+}}
+show(0);
+</script>
+</body></html>
+"""
+
+
+def render_tradingview(signals, render_delay=20):
+    """ Self-contained technicals page laid out for the scraper's XPaths.
+        Each interval button swaps the panel values after render_delay ms,
+        like the real page re-rendering.
+    """
+    buttons = ''.join('<div><div onclick="show({0})">{1}</div></div>'.format(i, interval)
+                      for i, interval in enumerate(TIME_INTERVALS))
+    return TRADINGVIEW_PAGE.format(
+        market=signals['market'], buttons=buttons, render_delay=render_delay,
+        signals=json.dumps(dict((k, v) for k, v in signals.items() if k in TIME_INTERVALS)),
+        intervals=json.dumps(TIME_INTERVALS))
+
+
+def save(directory, products, level2=None, candles=None, pages=None):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, 'products.json'), 'w') as f:
+        json.dump([{'id': product_id} for product_id in products], f)
+    if level2 is not None:
+        with gzip.open(os.path.join(directory, 'level2.jsonl.gz'), 'wt') as f:
+            for message in level2:
+                f.write(json.dumps(message, separators=(',', ':')))
+                f.write('\n')
+    if candles is not None:
+        with gzip.open(os.path.join(directory, 'candles.json.gz'), 'wt') as f:
+            json.dump(candles, f)
+    for market, html in (pages or {}).items():
+        with open(os.path.join(directory, 'tradingview_{0}.html'.format(market)), 'w') as f:
+            f.write(html)
+
+
+def generate(directory, products=8, levels=20000, updates=100000, minutes=7 * 24 * 60, seed=0):
+    product_ids = product_list(products)
+    pages = dict((market, render_tradingview(synthetic_signals(market, seed)))
+                 for market in TRADINGVIEW_MARKETS)
+    save(directory, product_ids,
+         level2=synthetic_level2(product_ids, levels, updates, seed),
+         candles=synthetic_candles(product_ids, minutes, seed=seed),
+         pages=pages)
+    return directory
+
+
+class Fixtures(object):
+    """ Lazy reader for a fixture directory. """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def products(self):
+        with open(self._path('products.json')) as f:
+            return [product['id'] for product in json.load(f)]
+
+    def level2_lines(self):
+        """ Raw JSON lines, as they would arrive on the websocket. """
+        with gzip.open(self._path('level2.jsonl.gz'), 'rt') as f:
+            return [line.rstrip('\n') for line in f if line.strip()]
+
+    def level2(self):
+        return [json.loads(line) for line in self.level2_lines()]
+
+    def candles(self):
+        with gzip.open(self._path('candles.json.gz'), 'rt') as f:
+            return json.load(f)
+
+    def tradingview_markets(self):
+        return sorted(name[len('tradingview_'):-len('.html')]
+                      for name in os.listdir(self.directory)
+                      if name.startswith('tradingview_') and name.endswith('.html'))
+
+    def tradingview_page(self, market):
+        path = self._path('tradingview_{0}.html'.format(market))
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read()
+
+
+def record_level2(product_ids, seconds=60):
+    """ Records the live level2 feed (snapshots, then updates) and heartbeats
+        for `seconds`.
+    """
+    from websocket import create_connection
+    ws = create_connection("wss://ws-feed.gdax.com")
+    ws.send(json.dumps({"type": "subscribe", "product_ids": product_ids, "channels": ["level2", "heartbeat"]}))
+    messages = []
+    deadline = time.time() + seconds
+    try:
+        while time.time() < deadline:
+            message = json.loads(ws.recv())
+            if message.get('type') in ('snapshot', 'l2update', 'heartbeat'):
+                messages.append(message)
+    finally:
+        ws.close()
+    return messages
+
+
+def record_candles(product_ids, hours=24):
+    """ Pages through get_product_historic_rates for the last `hours`. """
+    import gdax
+    client = gdax.PublicClient()
+    end = int(time.time())
+    end -= end % 60
+    candles = {}
+    for product_id in product_ids:
+        rows = []
+        for page_end in range(end, end - hours * 3600, -300 * 60):
+            page_start = max(end - hours * 3600, page_end - 300 * 60)
+            data = client.get_product_historic_rates(
+                product_id, start=_iso(page_start), end=_iso(page_end), granularity=60)
+            if isinstance(data, list):
+                rows.extend(data)
+            time.sleep(0.4)  # stay under the public rate limit
+        candles[product_id] = sorted(dict((row[0], row) for row in rows).values(), reverse=True)
+    return candles
+
+
+def record_tradingview(markets=TRADINGVIEW_MARKETS):
+    import get_tradingview_technicals as tradingview
+    pages = {}
+    for market in markets:
+        pages[market] = render_tradingview(tradingview.get_signals(market))
+    return pages
+
+
+def record(directory, seconds=60, hours=24, product_ids=None):
+    import gdax
+    product_ids = product_ids or [product['id'] for product in gdax.PublicClient().get_products()]
+    save(directory, product_ids,
+         level2=record_level2(product_ids, seconds),
+         candles=record_candles(product_ids, hours),
+         pages=record_tradingview())
+    return directory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    generate_parser = commands.add_parser('generate')
+    generate_parser.add_argument('directory')
+    generate_parser.add_argument('--products', type=int, default=8)
+    generate_parser.add_argument('--levels', type=int, default=20000)
+    generate_parser.add_argument('--updates', type=int, default=100000)
+    generate_parser.add_argument('--minutes', type=int, default=7 * 24 * 60)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    record_parser = commands.add_parser('record')
+    record_parser.add_argument('directory')
+    record_parser.add_argument('--seconds', type=int, default=60)
+    record_parser.add_argument('--hours', type=int, default=24)
+    record_parser.add_argument('--products', nargs='*')
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args.directory, args.products, args.levels, args.updates, args.minutes, args.seed)
+    elif args.command == 'record':
+        record(args.directory, args.seconds, args.hours, args.products)
+    else:
+        parser.print_help()
@@ -0,0 +1,364 @@
+""" Offline benchmark suite for the collectors.
+
+    Runs the hot paths against local stand-ins, with no exchange, RDS,
+    Firebase, DynamoDB or tradingview.com involved:
+
+        bands           get_bid_ask_volumes on raw snapshots and live books,
+                        and OrderBook.apply over the update stream
+        feed            the order book collector's websocket reader/workers,
+                        fed by FakeFeed
+        insert_rows     candle writes (watermarks, rollups) into SQLite
+        lambda_handler  one candlestick Lambda run: FakeExchange over HTTP,
+                        SQLite for MySQL, FakeFirebase
+        get_signals     the TradingView scraper against FakeExchange's pages
+                        (needs selenium and ./chromedriver, otherwise skipped)
+
+    Every benchmark reports throughput and per-operation latency. Results
+    can be saved with --json and compared with --baseline, which exits
+    non-zero if any p50 got more than --tolerance slower.
+
+    $ python -m benchmarks.run                          # synthetic fixtures
+    $ python -m benchmarks.run --fixtures DIR --only bands insert_rows
+    $ python -m benchmarks.run --json new.json --baseline old.json
+
+    Requires the collectors' own dependencies (numpy, pymysql, requests,
+    websocket-client; selenium for get_signals).
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+
+from benchmarks import fixtures as fixture_tools
+from benchmarks import servers, sqlstore
+
+
+BENCHMARKS = ['bands', 'feed', 'insert_rows', 'lambda_handler', 'get_signals']
+DEFAULT_TOLERANCE = 0.2
+
+
+class Skipped(Exception):
+    pass
+
+
+class Result(object):
+    """ Latency samples (seconds per operation) for one benchmark case. """
+
+    def __init__(self, name, unit='op'):
+        self.name = name
+        self.unit = unit
+        self.samples = []
+        self.ops = 0
+        self.seconds = 0.0
+        self.extra = {}
+
+    def add(self, seconds, ops=1):
+        self.samples.append(seconds / ops if ops else seconds)
+        self.ops += ops
+        self.seconds += seconds
+
+    def _percentile(self, q):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q / 100.0 * len(ordered)))]
+
+    def summary(self):
+        if not self.samples:
+            return {'name': self.name, 'ops': 0}
+        summary = {
+            'name': self.name,
+            'unit': self.unit,
+            'ops': self.ops,
+            'seconds': round(self.seconds, 6),
+            'throughput': round(self.ops / self.seconds, 3) if self.seconds else None,
+            'mean_ms': round(1000.0 * self.seconds / self.ops, 6),
+            'p50_ms': round(1000.0 * self._percentile(50), 6),
+            'p90_ms': round(1000.0 * self._percentile(90), 6),
+            'p99_ms': round(1000.0 * self._percentile(99), 6),
+        }
+        summary.update(self.extra)
+        return summary
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    value = func(*args)
+    return time.perf_counter() - started, value
+
+
+def install_config(api_url, rate=1000):
+    """ get_gdax_candlesticks reads its endpoints and rate limit from config
+        at import time, so this has to run before the first import. The
+        suite always replaces it; a real config.py is never used.
+    """
+    config = types.ModuleType('config')
+    config.API_URL = api_url
+    config.URL = 'http://firebase.invalid'
+    config.RDS_HOST = config.USER = config.PASSWORD = config.DB_NAME = None
+    config.PUBLIC_RATE_LIMIT = rate
+    config.PUBLIC_RATE_BURST = rate
+    config.BACKFILL_DIR = tempfile.mkdtemp(prefix='gdax_backfill_')
+    sys.modules['config'] = config
+    return config
+
+
+def import_script(name):
+    try:
+        return __import__(name)
+    except ImportError as e:
+        raise Skipped("cannot import {0}: {1}".format(name, e))
+
+
+def reset_candlestick_caches(candlesticks):
+    candlesticks._watermarks.clear()
+    candlesticks._coverage.clear()
+    candlesticks._watermarks_loaded = 0
+    candlesticks._coverage_loaded = 0
+
+
+def bench_bands(fixtures, exchange, args):
+    orderbook = import_script('get_gdax_live_orderbook')
+    messages = fixtures.level2()
+    snapshots = [m for m in messages if m['type'] == 'snapshot']
+    updates = [m for m in messages if m['type'] == 'l2update']
+
+    raw = Result('bands.raw_snapshot', 'snapshot')
+    for _ in range(args.repeat):
+        for snapshot in snapshots:
+            raw.add(timed(orderbook.get_bid_ask_volumes, snapshot)[0])
+
+    books = dict((s['product_id'], orderbook.OrderBook(s['product_id'])) for s in snapshots)
+    load = Result('orderbook.load_snapshot', 'snapshot')
+    for snapshot in snapshots:
+        load.add(timed(books[snapshot['product_id']].apply, snapshot)[0])
+
+    apply = Result('orderbook.apply', 'message')
+    chunk = 1000
+    for i in range(0, len(updates), chunk):
+        started = time.perf_counter()
+        for message in updates[i:i + chunk]:
+            books[message['product_id']].apply(message)
+        apply.add(time.perf_counter() - started, len(updates[i:i + chunk]))
+    apply.extra['resyncs'] = sum(1 for book in books.values() if book.needs_resync)
+
+    live = Result('bands.live_book', 'book')
+    widest = max(orderbook.BANDS)
+    for _ in range(args.repeat):
+        for book in books.values():
+            live.add(timed(lambda: orderbook.get_bid_ask_volumes(book.snapshot(within=widest)))[0])
+    return [raw, load, apply, live]
+
+
+def bench_feed(fixtures, exchange, args):
+    orderbook = import_script('get_gdax_live_orderbook')
+    try:
+        from websocket import WebSocketConnectionClosedException, create_connection
+    except ImportError as e:
+        raise Skipped("cannot import websocket: {0}".format(e))
+    lines = fixtures.level2_lines()
+    products = fixtures.products()
+
+    async def replay(url):
+        ws = create_connection(url)
+        orderbook.subscribe(ws, products)
+        books = dict((product_id, orderbook.OrderBook(product_id)) for product_id in products)
+        for book in books.values():
+            book.expect_snapshot()  # as in collect()
+        queues = dict((product_id, asyncio.Queue()) for product_id in products)
+        workers = [asyncio.ensure_future(orderbook._apply_updates(ws, books[p], queues[p]))
+                   for p in products]
+        try:
+            await orderbook._read_feed(ws, queues)
+        except (WebSocketConnectionClosedException, OSError):
+            pass  # the replay is over once the feed closes
+        while any(not queue.empty() for queue in queues.values()):
+            await asyncio.sleep(0)
+        for worker in workers:
+            worker.cancel()
+        ws.close()
+        return books
+
+    result = Result('feed.end_to_end', 'message')
+    with servers.FakeFeed(lines, rate=args.feed_rate) as feed:
+        for _ in range(args.repeat):
+            seconds, books = timed(asyncio.run, replay(feed.url))
+            result.add(seconds, len(lines))
+    result.extra['books_healthy'] = sum(1 for book in books.values() if not book.needs_resync)
+    return [result]
+
+
+def bench_insert_rows(fixtures, exchange, args):
+    candlesticks = import_script('get_gdax_candlesticks')
+    candles = fixtures.candles()
+    connection = sqlstore.connect()
+    cursor = connection.cursor()
+    reset_candlestick_caches(candlesticks)
+    candlesticks.check_mysql_tables(connection, cursor, list(candles))
+    candlesticks.check_watermark_table(connection, cursor)
+    page = candlesticks.MAX_CANDLES_PER_REQUEST
+    fresh = Result('insert_rows.new', 'row')
+    replace = Result('insert_rows.replace', 'row')
+    for result in (fresh, replace):
+        for market, rows in candles.items():
+            table = 'gdax_{0}_candlesticks'.format(market.lower())
+            oldest_first = list(reversed(rows))
+            for i in range(0, len(oldest_first), page):
+                batch = oldest_first[i:i + page]
+                seconds, _ = timed(candlesticks.insert_rows, connection, cursor, table, batch)
+                result.add(seconds, len(batch))
+    fresh.extra['rows_counted'] = sum(w['row_count'] for w in candlesticks._watermarks.values())
+    connection.close()
+    return [fresh, replace]
+
+
+def bench_lambda_handler(fixtures, exchange, args):
+    candlesticks = import_script('get_gdax_candlesticks')
+    import instrumentation
+    import resource_cache
+    reset_candlestick_caches(candlesticks)
+    resource_cache._resources['mysql'] = sqlstore.connect()
+    resource_cache._resources['gdax'] = servers.FakePublicClient(exchange.url)
+    resource_cache._resources['firebase'] = servers.FakeFirebase()
+    instrumentation.enable()
+    results = []
+    try:
+        for run in ('cold', 'warm'):
+            result = Result('lambda_handler.{0}'.format(run), 'request')
+            requests_before = exchange.requests
+            seconds, _ = timed(candlesticks.lambda_handler, {}, None)
+            result.add(seconds, max(exchange.requests - requests_before, 1))
+            summary = instrumentation.last_summary or {}
+            result.extra['invocation_seconds'] = round(seconds, 6)
+            result.extra['rows_written'] = summary.get('counters', {}).get('rows_written', 0)
+            result.extra['stages'] = dict(
+                (stage, {'count': timer['count'], 'p50_ms': timer['p50_ms'], 'p99_ms': timer['p99_ms']})
+                for stage, timer in summary.get('timers', {}).items())
+            results.append(result)
+    finally:
+        instrumentation.disable()
+        for name in ('mysql', 'gdax', 'firebase', 'http'):
+            resource_cache.drop(name)
+    return results
+
+
+def bench_get_signals(fixtures, exchange, args):
+    tradingview = import_script('get_tradingview_technicals')
+    markets = fixtures.tradingview_markets()
+    if not markets:
+        raise Skipped("no TradingView pages in fixtures")
+    tradingview.BASE_URL = exchange.url + '/symbols/{}/technicals/'
+    try:
+        pool = tradingview.DriverPool(size=args.pool_size)
+    except Exception as e:
+        raise Skipped("cannot start Chrome: {0}".format(e))
+    try:
+        single = Result('get_signals.market', 'market')
+        for _ in range(args.repeat):
+            for market in markets:
+                seconds, _ = timed(tradingview.get_signals_from_pool, pool, market)
+                single.add(seconds)
+        pooled = Result('get_signals.scrape_markets', 'market')
+        seconds, scraped = timed(lambda: list(tradingview.scrape_markets(pool, markets)))
+        pooled.add(seconds, len(markets))
+        pooled.extra['scraped'] = len(scraped)
+    finally:
+        pool.close()
+    return [single, pooled]
+
+
+def compare(results, baseline, tolerance):
+    """ Returns names whose p50 regressed by more than tolerance. """
+    previous = dict((r['name'], r) for r in baseline.get('results', []))
+    regressions = []
+    for result in results:
+        old = previous.get(result['name'])
+        if not old or not old.get('p50_ms') or not result.get('p50_ms'):
+            continue
+        change = result['p50_ms'] / old['p50_ms'] - 1
+        result['p50_change'] = round(change, 4)
+        if change > tolerance:
+            regressions.append(result['name'])
+    return regressions
+
+
+def print_report(results, skipped):
+    header = '{0:<30} {1:>10} {2:>14} {3:>10} {4:>10} {5:>10} {6:>10}'
+    print(header.format('benchmark', 'ops', 'ops/s', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for r in results:
+        if not r.get('ops'):
+            continue
+        line = '{0:<30} {1:>10} {2:>14.1f} {3:>10.4f} {4:>10.4f} {5:>10.4f} {6:>10.4f}'.format(
+            r['name'], r['ops'], r['throughput'] or 0, r['mean_ms'], r['p50_ms'], r['p90_ms'], r['p99_ms'])
+        if 'p50_change' in r:
+            line += ' {0:+.1%}'.format(r['p50_change'])
+        print(line)
+        for stage, timer in sorted(r.get('stages', {}).items()):
+            print('    {0:<26} {1:>10} {2:>25} {3:>10} {4:>21}'.format(
+                stage, timer['count'], '', timer['p50_ms'], timer['p99_ms']))
+    for name, reason in skipped.items():
+        print('{0:<30} skipped: {1}'.format(name, reason))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--fixtures', help="fixture directory (default: generate synthetic ones)")
+    parser.add_argument('--only', nargs='*', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--rate', type=float, default=1000,
+                        help="exchange requests/second for lambda_handler (the real limit is 3)")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each HTTP response")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="fraction of candle requests answered with HTTP 429")
+    parser.add_argument('--feed-rate', type=float, default=None, help="websocket messages/second")
+    parser.add_argument('--pool-size', type=int, default=2)
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--baseline', help="compare against a previous --json file")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+    # The scripts set the root logger to INFO on import; keep the report readable.
+    logging.disable(logging.getLevelName(args.log_level) - 10)
+    directory = args.fixtures
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='bench_fixtures_')
+        print("Generating synthetic fixtures in {0}...".format(directory))
+        fixture_tools.generate(directory, products=8, levels=20000, updates=100000,
+                               minutes=3 * 24 * 60)
+    fixtures = fixture_tools.Fixtures(directory)
+
+    results = []
+    skipped = {}
+    with servers.FakeExchange(fixtures, args.latency, args.error_rate) as exchange:
+        install_config(exchange.url, args.rate)
+        for name in args.only:
+            try:
+                cases = globals()['bench_' + name](fixtures, exchange, args)
+            except Skipped as e:
+                skipped[name] = str(e)
+                continue
+            results.extend(case.summary() for case in cases)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    print_report(results, skipped)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'time': int(time.time()), 'fixtures': os.path.abspath(directory),
+                       'results': results, 'skipped': skipped}, f, indent=2)
+    if regressions:
+        print("Regressions beyond {0:.0%}: {1}".format(args.tolerance, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+""" Local stand-ins for the services the collectors talk to.
+
+    FakeExchange    HTTP: GDAX /products and /products/{id}/candles, plus
+                    TradingView /symbols/{market}/technicals/ pages
+    FakeFeed        websocket: replays recorded level2 messages to each client
+    FakePublicClient / FakeFirebase
+                    drop-in objects for the gdax client and Firebase app
+
+    Both servers bind to 127.0.0.1 on a free port and run on daemon threads:
+
+        with FakeExchange(fixtures) as exchange:
+            requests.get(exchange.url + '/products')
+"""
+
+import base64
+import hashlib
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from urllib.request import urlopen
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'  # RFC 6455
+
+
+def _parse_time(value):
+    """ Accepts the ISO strings get_gdax_candlesticks sends, or unix seconds. """
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(datetime.fromisoformat(value).timestamp())
+
+
+class _Server(object):
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeExchange(_Server):
+    """ Serves candles from a fixture's candles, shifted so the newest candle
+        is the last complete minute (the collectors plan requests from now).
+
+        latency: seconds added to every response.
+        error_rate: fraction of candle requests answered with HTTP 429.
+        fail_after: candle requests served before every further one gets a
+            non-retryable HTTP 400, like a run that dies part way through.
+    """
+
+    def __init__(self, fixtures, latency=0.0, error_rate=0.0, shift_to_now=True, fail_after=None):
+        self.products = fixtures.products()
+        self.pages = dict((market, fixtures.tradingview_page(market))
+                          for market in fixtures.tradingview_markets())
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fail_after = fail_after
+        self.requests = 0
+        self.served = 0
+        self._candles = {}
+        now = int(time.time())
+        for market, rows in fixtures.candles().items():
+            if not rows:
+                continue
+            shift = now - now % 60 - 60 - rows[0][0] if shift_to_now else 0
+            times = [row[0] + shift for row in reversed(rows)]
+            values = [[row[0] + shift] + list(row[1:]) for row in reversed(rows)]
+            self._candles[market] = (times, values)
+        self._errors = 0.0
+        self._lock = threading.Lock()
+        handler = self._handler()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    def candles(self, market, start, end):
+        """ Newest-first rows with start <= time < end, capped at 300. """
+        times, values = self._candles.get(market, ([], []))
+        from bisect import bisect_left
+        i = bisect_left(times, start)
+        j = bisect_left(times, end)
+        return list(reversed(values[i:j]))[:300]
+
+    def _throttle(self):
+        with self._lock:
+            self.requests += 1
+            self._errors += self.error_rate
+            if self._errors >= 1:
+                self._errors -= 1
+                return 429
+            if self.fail_after is not None and self.served >= self.fail_after:
+                return 400
+            self.served += 1
+        return None
+
+    def _handler(self):
+        exchange = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type='application/json'):
+                if exchange.latency:
+                    time.sleep(exchange.latency)
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                parts = [part for part in url.path.split('/') if part]
+                if parts == ['products']:
+                    return self._send(200, json.dumps([{'id': p} for p in exchange.products]))
+                if len(parts) == 3 and parts[0] == 'products' and parts[2] == 'candles':
+                    error = exchange._throttle()
+                    if error is not None:
+                        return self._send(error, json.dumps({'message': 'Slow down' if error == 429
+                                                             else 'Bad request'}))
+                    query = parse_qs(url.query)
+                    rows = exchange.candles(parts[1], _parse_time(query['start'][0]),
+                                            _parse_time(query['end'][0]))
+                    return self._send(200, json.dumps(rows))
+                if len(parts) == 3 and parts[0] == 'symbols' and parts[2] == 'technicals':
+                    page = exchange.pages.get(parts[1])
+                    if page is not None:
+                        return self._send(200, page, 'text/html')
+                self._send(404, json.dumps({'message': 'NotFound'}))
+
+        return Handler
+
+
+class FakePublicClient(object):
+    """ The parts of gdax.PublicClient the collectors use, against FakeExchange. """
+
+    def __init__(self, url):
+        self.url = url
+
+    def _get(self, path):
+        with urlopen(self.url + path) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def get_products(self):
+        return self._get('/products')
+
+    def get_product_historic_rates(self, product_id, start=None, end=None, granularity=None):
+        return self._get('/products/{0}/candles?start={1}&end={2}&granularity={3}'.format(
+            product_id, start, end, granularity))
+
+
+class FakeFirebase(object):
+
+    def __init__(self):
+        self.data = {}
+        self.puts = 0
+
+    def get(self, path, name):
+        return self.data.get(path.strip('/'))
+
+    def put(self, path, name, value):
+        self.puts += 1
+        self.data['{0}/{1}'.format(path.strip('/'), name)] = value
+        return value
+
+
+def _read_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("Client went away")
+        data += chunk
+    return data
+
+
+def read_frame(sock):
+    """ Reads one client frame. Returns (opcode, payload). """
+    first, second = _read_exact(sock, 2)
+    length = second & 0x7f
+    if length == 126:
+        length = struct.unpack('>H', _read_exact(sock, 2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', _read_exact(sock, 8))[0]
+    mask = _read_exact(sock, 4) if second & 0x80 else None
+    payload = _read_exact(sock, length)
+    if mask:
+        if np is not None:
+            key = np.frombuffer((mask * (length // 4 + 1))[:length], dtype=np.uint8)
+            payload = (np.frombuffer(payload, dtype=np.uint8) ^ key).tobytes()
+        else:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return first & 0x0f, payload
+
+
+def frame(payload, opcode=0x1):
+    """ One unmasked, final server frame. """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('>BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+class FakeFeed(_Server):
+    """ Minimal websocket server. Each client gets the handshake, then every
+        recorded message as a text frame once it sends its first frame (the
+        subscribe), then a close frame.
+
+        rate: messages per second to pace the replay at; None for as fast as
+        the socket allows.
+    """
+
+    def __init__(self, lines, rate=None):
+        self.lines = [line.encode('utf-8') if not isinstance(line, bytes) else line
+                      for line in lines]
+        self.rate = rate
+        self.clients = 0
+        feed = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                feed._serve(self.request)
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'ws://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    def _handshake(self, sock):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("Client went away")
+            request += chunk
+        key = None
+        for line in request.split(b'\r\n'):
+            if line.lower().startswith(b'sec-websocket-key:'):
+                key = line.split(b':', 1)[1].strip()
+        accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+        sock.sendall(b'HTTP/1.1 101 Switching Protocols\r\n'
+                     b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+    def _serve(self, sock):
+        self.clients += 1
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self._handshake(sock)
+            read_frame(sock)
+            started = time.time()
+            batch = []
+            for n, line in enumerate(self.lines):
+                batch.append(frame(line))
+                if self.rate:
+                    delay = started + n / float(self.rate) - time.time()
+                    if delay > 0:
+                        sock.sendall(b''.join(batch))
+                        batch = []
+                        time.sleep(delay)
+                elif len(batch) >= 64:
+                    sock.sendall(b''.join(batch))
+                    batch = []
+            batch.append(frame(struct.pack('>H', 1000), opcode=0x8))
+            sock.sendall(b''.join(batch))
+        except (ConnectionError, OSError):
+            pass
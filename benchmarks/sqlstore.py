@@ -0,0 +1,138 @@
+""" SQLite stand-in for the subset of pymysql the collectors use.
+
+    connect() returns an object with pymysql's connection/cursor interface.
+    The MySQL dialect in our queries is rewritten on the fly:
+
+        %s placeholders                 -> ?
+        show tables like "..."          -> sqlite_master lookup
+        ON DUPLICATE KEY UPDATE ...     -> ON CONFLICT DO UPDATE SET ...
+        VALUES(col), GREATEST, LEAST    -> excluded.col, MAX, MIN
+        SELECT ... FOR UPDATE           -> SELECT (SQLite locks the whole file)
+
+    REPLACE INTO tables keyed by `time` reports affected rows the MySQL way
+    (1 per new row, 2 per replaced row), which insert_rows() relies on to
+    count new candles. LOAD DATA INFILE is not supported.
+
+    Usage:
+        connection = sqlstore.connect()          # in memory
+        connection = sqlstore.connect('bench.db')
+"""
+
+import re
+import sqlite3
+
+
+_SHOW_TABLES = re.compile(r'^\s*show\s+tables\s+like\s+["\'](.*)["\']\s*;?\s*$', re.I)
+_ON_DUPLICATE = re.compile(r'\s+ON\s+DUPLICATE\s+KEY\s+UPDATE\s+', re.I)
+_VALUES_FN = re.compile(r'\bVALUES\((\w+)\)', re.I)
+_GREATEST = re.compile(r'\bGREATEST\(', re.I)
+_LEAST = re.compile(r'\bLEAST\(', re.I)
+_FOR_UPDATE = re.compile(r'\s+FOR\s+UPDATE\s*$', re.I)
+_REPLACE_BY_TIME = re.compile(r'^\s*REPLACE\s+INTO\s+(`[^`]+`|\w+)\s*\(\s*time\s*,', re.I)
+
+_translated = {}
+
+
+def translate(query):
+    """ Returns (sqlite query, table name if it is a REPLACE keyed by time). """
+    cached = _translated.get(query)
+    if cached is not None:
+        return cached
+    show = _SHOW_TABLES.match(query)
+    if show:
+        result = ("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE '{0}'".format(
+            show.group(1)), None)
+    else:
+        sql = _FOR_UPDATE.sub('', query.replace('%s', '?'))
+        parts = _ON_DUPLICATE.split(sql)
+        if len(parts) == 2:
+            update = _VALUES_FN.sub(r'excluded.\1', parts[1])
+            update = _LEAST.sub('MIN(', _GREATEST.sub('MAX(', update))
+            sql = parts[0] + ' ON CONFLICT DO UPDATE SET ' + update
+        replace = _REPLACE_BY_TIME.match(sql)
+        result = (sql, replace.group(1) if replace else None)
+    _translated[query] = result
+    return result
+
+
+class Cursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = connection._db.cursor()
+
+    def _existing(self, table, times):
+        if not times:
+            return 0
+        found = 0
+        for i in range(0, len(times), 500):
+            chunk = times[i:i + 500]
+            self._cursor.execute("SELECT COUNT(*) FROM {0} WHERE time IN ({1})".format(
+                table, ', '.join('?' * len(chunk))), chunk)
+            found += self._cursor.fetchone()[0]
+        return found
+
+    def execute(self, query, args=None):
+        sql, replace_table = translate(query)
+        params = tuple(args) if args is not None else ()
+        replaced = self._existing(replace_table, [params[0]]) if replace_table else 0
+        self._cursor.execute(sql, params)
+        return max(self._cursor.rowcount, 0) + replaced
+
+    def executemany(self, query, args):
+        sql, replace_table = translate(query)
+        rows = [tuple(row) for row in args]
+        replaced = 0
+        if replace_table:
+            replaced = self._existing(replace_table, list(set(row[0] for row in rows)))
+        self._cursor.executemany(sql, rows)
+        return max(self._cursor.rowcount, 0) + replaced
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size) if size else self._cursor.fetchmany()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection(object):
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self.open = True
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self._db.commit()
+
+    def rollback(self):
+        self._db.rollback()
+
+    def ping(self, reconnect=False):
+        if not self.open:
+            if not reconnect:
+                raise sqlite3.ProgrammingError("Connection is closed")
+            self.__init__(self.path)
+        return True
+
+    def close(self):
+        self._db.close()
+        self.open = False
+
+
+def connect(path=':memory:', **kwargs):
+    """ Accepts and ignores pymysql's connection arguments. """
+    return Connection(path)
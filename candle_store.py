@@ -0,0 +1,273 @@
+""" Local memory-mapped columnar store for GDAX candlesticks.
+
+    Keeps each market as append-only, fixed-width, time-sorted columns
+    (time/low/high/open/close/volume), one raw file per column, read back
+    through numpy memmaps. Range reads are a binary search on the time column
+    and return zero-copy slices, so analysis code can scan millions of candles
+    without touching RDS.
+
+    Layout:
+        {root}/{market}/time.i8     int64 unix timestamps, ascending
+        {root}/{market}/low.f8      float64, same length as time
+        ...
+
+    The time column is written last on every append, so its length is the
+    committed row count. Longer value columns left by an interrupted append
+    are trimmed when the market is opened.
+
+    MySQL rows can change below the newest stored candle: REST reconciliation
+    rewrites bars first built live, and gap fills and backfills insert older
+    rows. Each sync re-reads the trailing SYNC_OVERLAP seconds and patches
+    changed values in place, and reloads the market when MySQL has rows the
+    store lacks (checked against the watermark row count). Both bump
+    MarketCandles.revision, so incremental readers know to start over.
+
+    Sync from the MySQL tables written by get_gdax_candlesticks.py:
+        store = CandleStore('/data/candles')
+        store.market('BTC-USD').sync_from_mysql(cursor, 'gdax_btc-usd_candlesticks')
+        candles = store.market('BTC-USD').range(start, end)
+        candles['close'].mean()
+
+    Requires:
+        pip install numpy
+"""
+
+import logging
+import os
+
+import numpy as np
+
+
+COLUMNS = ['time', 'low', 'high', 'open', 'close', 'volume']
+DTYPES = {'time': np.int64, 'low': np.float64, 'high': np.float64,
+          'open': np.float64, 'close': np.float64, 'volume': np.float64}
+SYNC_FETCH_SIZE = 50000
+SYNC_OVERLAP = 6 * 3600  # seconds of stored candles re-read on every sync
+
+
+def aggregate_candles(rows, granularity=None, buckets=None):
+    """ Rolls time-sorted (n, 6) candles in COLUMNS order up into buckets of
+        `granularity` seconds, aligned to the epoch. Returns (m, 6) rows keyed
+        by bucket start. Uneven buckets (weeks, months) can be passed in as
+        `buckets`, the bucket start of every row.
+    """
+    rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(COLUMNS))
+    if not len(rows):
+        return rows
+    if buckets is None:
+        times = rows[:, 0].astype(np.int64)
+        buckets = times - times % granularity
+    starts = np.concatenate(([0], np.flatnonzero(buckets[1:] != buckets[:-1]) + 1))
+    ends = np.concatenate((starts[1:], [len(rows)]))
+    result = np.empty((len(starts), len(COLUMNS)))
+    result[:, 0] = buckets[starts]
+    result[:, 1] = np.minimum.reduceat(rows[:, 1], starts)
+    result[:, 2] = np.maximum.reduceat(rows[:, 2], starts)
+    result[:, 3] = rows[starts, 3]
+    result[:, 4] = rows[ends - 1, 4]
+    result[:, 5] = np.add.reduceat(rows[:, 5], starts)
+    return result
+
+
+def column_path(directory, column):
+    suffix = 'i8' if column == 'time' else 'f8'
+    return os.path.join(directory, '{0}.{1}'.format(column, suffix))
+
+
+class MarketCandles(object):
+    """ Columns for one market. Not safe for concurrent writers. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._columns = None
+        self._length = self._committed_length()
+        self.revision = 0  # bumped whenever stored rows change or are dropped
+
+    def _committed_length(self):
+        path = column_path(self.directory, 'time')
+        length = os.path.getsize(path) // 8 if os.path.exists(path) else 0
+        for column in COLUMNS[1:]:
+            path = column_path(self.directory, column)
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            if os.path.getsize(path) > length * 8:
+                with open(path, 'r+b') as f:
+                    f.truncate(length * 8)
+        return length
+
+    def __len__(self):
+        return self._length
+
+    def columns(self):
+        """ Read-only memmaps of every column, remapped after appends. """
+        if self._columns is None:
+            self._columns = {}
+            for column in COLUMNS:
+                if self._length:
+                    self._columns[column] = np.memmap(
+                        column_path(self.directory, column), dtype=DTYPES[column],
+                        mode='r', shape=(self._length,))
+                else:
+                    self._columns[column] = np.empty(0, dtype=DTYPES[column])
+        return self._columns
+
+    def first_time(self):
+        return int(self.columns()['time'][0]) if self._length else None
+
+    def last_time(self):
+        return int(self.columns()['time'][-1]) if self._length else None
+
+    def append(self, rows):
+        """ Appends (n, 6) rows in COLUMNS order. Rows are sorted by time and
+            anything not newer than the last stored candle is dropped.
+
+            Returns the number of rows appended.
+        """
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(COLUMNS))
+        if not len(rows):
+            return 0
+        rows = rows[np.argsort(rows[:, 0], kind='mergesort')]
+        times = rows[:, 0].astype(np.int64)
+        keep = np.concatenate((times[1:] != times[:-1], [True]))  # last duplicate wins
+        last = self.last_time()
+        if last is not None:
+            keep &= times > last
+        rows, times = rows[keep], times[keep]
+        if not len(rows):
+            return 0
+        for i, column in enumerate(COLUMNS[1:], 1):
+            with open(column_path(self.directory, column), 'ab') as f:
+                rows[:, i].tofile(f)
+        with open(column_path(self.directory, 'time'), 'ab') as f:
+            times.tofile(f)
+        self._length += len(rows)
+        self._columns = None
+        return len(rows)
+
+    def patch(self, rows):
+        """ Overwrites the values of stored candles from (n, 6) rows with the
+            same times. Returns (rows changed, whether any row's time is not
+            stored, i.e. the rows can't be patched in and need a reload).
+        """
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(COLUMNS))
+        if not len(rows):
+            return 0, False
+        stored = self.columns()
+        times = rows[:, 0].astype(np.int64)
+        index = np.searchsorted(stored['time'], times)
+        found = index < self._length
+        found[found] = stored['time'][index[found]] == times[found]
+        rows, index = rows[found], index[found]
+        changed = np.zeros(len(rows), dtype=bool)
+        for i, column in enumerate(COLUMNS[1:], 1):
+            changed |= stored[column][index] != rows[:, i]
+        if changed.any():
+            rows, index = rows[changed], index[changed]
+            for i, column in enumerate(COLUMNS[1:], 1):
+                values = np.memmap(column_path(self.directory, column), dtype=DTYPES[column],
+                                   mode='r+', shape=(self._length,))
+                values[index] = rows[:, i]
+                values.flush()
+                del values
+            self._columns = None
+            self.revision += 1
+        return int(changed.sum()), not found.all()
+
+    def count_until(self, time):
+        """ Number of stored candles with time <= `time`. """
+        return int(np.searchsorted(self.columns()['time'], time, side='right'))
+
+    def truncate(self):
+        for column in COLUMNS:
+            open(column_path(self.directory, column), 'wb').close()
+        self._length = 0
+        self._columns = None
+        self.revision += 1
+
+    def range(self, start=None, end=None):
+        """ Zero-copy views of the candles with start <= time < end. """
+        columns = self.columns()
+        times = columns['time']
+        i = 0 if start is None else int(np.searchsorted(times, start, side='left'))
+        j = len(times) if end is None else int(np.searchsorted(times, end, side='left'))
+        return dict((column, columns[column][i:j]) for column in COLUMNS)
+
+    def sync_from_mysql(self, cursor, table, oldest=None, newest=None, row_count=None):
+        """ Brings the market in line with a MySQL candle table: appends rows
+            newer than the last stored candle and patches changed candles in
+            the trailing SYNC_OVERLAP seconds. oldest/newest/row_count come
+            from the table's watermark, if known. The market is reloaded when
+            `oldest` predates the first stored candle, when the overlap holds
+            candles the store lacks, or when fewer than `row_count` candles
+            are stored up to `newest`.
+
+            Returns the number of rows appended.
+        """
+        first = self.first_time()
+        if oldest is not None and first is not None and oldest < first:
+            logging.info("Older candles found in {0}, reloading store.".format(table))
+            self.truncate()
+        last = self.last_time()
+        query = "SELECT time, low, high, open, close, volume FROM `{0}`".format(table)
+        if last is None:
+            cursor.execute(query + " ORDER BY time")
+        else:
+            cursor.execute(query + " WHERE time > %s ORDER BY time", (last - SYNC_OVERLAP,))
+        appended = patched = 0
+        missing = False
+        while True:
+            rows = cursor.fetchmany(SYNC_FETCH_SIZE)
+            if not rows:
+                break
+            rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(COLUMNS))
+            if last is not None:
+                older = rows[:, 0] <= last
+                changed, unknown = self.patch(rows[older])
+                patched += changed
+                missing |= unknown
+                rows = rows[~older]
+            appended += self.append(rows)
+        if not missing and row_count and newest is not None and self.count_until(newest) < row_count:
+            missing = True
+        if missing:
+            logging.info("{0} has candles the store lacks, reloading store.".format(table))
+            self.truncate()
+            return self.sync_from_mysql(cursor, table)
+        logging.info("{0} candle(s) synced from {1}, {2} corrected.".format(appended, table, patched))
+        return appended
+
+
+class CandleStore(object):
+
+    def __init__(self, root):
+        self.root = root
+        self._markets = {}
+
+    def market(self, market):
+        if market not in self._markets:
+            self._markets[market] = MarketCandles(os.path.join(self.root, market))
+        return self._markets[market]
+
+    def markets(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, name)))
+
+    def sync_from_mysql(self, cursor, markets, watermarks=None):
+        """ Syncs each market from its gdax_{market}_candlesticks table.
+            `watermarks` is the {table: {'oldest', 'newest', 'row_count'}}
+            cache from get_gdax_candlesticks.load_watermarks(); without it,
+            rows filled in below the overlap window go unnoticed.
+        """
+        watermarks = watermarks or {}
+        appended = {}
+        for market in markets:
+            table = 'gdax_{0}_candlesticks'.format(market.lower())
+            watermark = watermarks.get(table, {})
+            appended[market] = self.market(market).sync_from_mysql(
+                cursor, table, watermark.get('oldest'), watermark.get('newest'),
+                watermark.get('row_count'))
+        return appended
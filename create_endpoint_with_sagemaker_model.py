@@ -9,16 +9,41 @@
 
     Requires:
         pip install python-firebase
+
+    The SageMaker client and Firebase app are kept in resource_cache and
+    reused across warm invocations; boto3 and firebase are imported on first
+    use. The Firebase URL is config.URL, as in get_gdax_candlesticks.py.
+
+    Batch mode: pass {"model_ids": [...]} instead of {"model_id": ...}. Existing
+    models, endpoint configs and endpoints are listed once up front, missing
+    pieces are created for all models concurrently, and each endpoint is
+    polled with backoff until it is InService (or fails, or MAX_WAIT runs
+    out). Firebase is updated once per model at the end.
+
+    Pass {"instrument": true} to log per-stage timings (inventory, creates,
+    polling, Firebase) for the invocation; see instrumentation.py.
 """
 
-import boto3
-from firebase import firebase
+import config
+import instrumentation
+import resource_cache
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEPLOY_WORKERS = 8
+POLL_INTERVAL = 5  # first delay between describe_endpoint rounds
+MAX_POLL_INTERVAL = 60
+MAX_WAIT = 840  # stay inside Lambda's 15 minute limit
+TERMINAL_STATUSES = ('InService', 'Failed', 'OutOfService')
 
 
 def getFirebaseApp(URL):
+    from firebase import firebase
     return firebase.FirebaseApplication(URL, None)
 
 
+@instrumentation.timed('firebase')
 def get_job_name(fba, model_id):
     print("Getting model information from Firebase...")
     job_name = fba.get('/crypto/models/{}/metadata/job_name'.format(model_id), None)
@@ -26,9 +51,11 @@ def get_job_name(fba, model_id):
 
 
 def getSagemakerClient():
+    import boto3
     return boto3.client('sagemaker')
 
 
+@instrumentation.timed('describe_training_job')
 def get_model_metadata(client, job_name):
     try:
         response = client.describe_training_job(TrainingJobName = job_name)
@@ -37,12 +64,33 @@ def get_model_metadata(client, job_name):
         print("Could not find SageMaker job with name:", job_name)
 
 
-def create_model(client, model_id, model_metadata):
-    paginator = client.get_paginator('list_models')
-    response = paginator.paginate(NameContains=model_id)
-    for page in response:
-        if page['Models']:
-            if page['Models'][0]['ModelName'] == model_id:
+@instrumentation.timed('inventory')
+def get_inventory(client):
+    """ Names of every existing model and endpoint config, and every endpoint
+        with its status, across all pages.
+    """
+    inventory = {'models': set(), 'configs': set(), 'endpoints': {}}
+    for page in client.get_paginator('list_models').paginate():
+        inventory['models'].update(m['ModelName'] for m in page['Models'])
+    for page in client.get_paginator('list_endpoint_configs').paginate():
+        inventory['configs'].update(c['EndpointConfigName'] for c in page['EndpointConfigs'])
+    for page in client.get_paginator('list_endpoints').paginate():
+        for endpoint in page['Endpoints']:
+            inventory['endpoints'][endpoint['EndpointName']] = endpoint['EndpointStatus']
+    return inventory
+
+
+@instrumentation.timed()
+def create_model(client, model_id, model_metadata, inventory=None):
+    if inventory is not None:
+        if model_id in inventory['models']:
+            print("SageMaker model already exists.")
+            return True
+    else:
+        paginator = client.get_paginator('list_models')
+        response = paginator.paginate(NameContains=model_id)
+        for page in response:
+            if any(m['ModelName'] == model_id for m in page['Models']):
                 print("SageMaker model already exists.")
                 return True
     print("Creating SageMaker model...")
@@ -60,12 +108,17 @@ def create_model(client, model_id, model_metadata):
     return response
 
 
-def create_endpoint_configuration(client, model_id):
-    paginator = client.get_paginator('list_endpoint_configs')
-    response = paginator.paginate(NameContains=model_id)
-    for page in response:
-        if page['EndpointConfigs']:
-            if page['EndpointConfigs'][0]['EndpointConfigName'] == model_id:
+@instrumentation.timed()
+def create_endpoint_configuration(client, model_id, inventory=None):
+    if inventory is not None:
+        if model_id in inventory['configs']:
+            print("SageMaker endpoint configuration already exists.")
+            return True
+    else:
+        paginator = client.get_paginator('list_endpoint_configs')
+        response = paginator.paginate(NameContains=model_id)
+        for page in response:
+            if any(c['EndpointConfigName'] == model_id for c in page['EndpointConfigs']):
                 print("SageMaker endpoint configuration already exists.")
                 return True
     print("Creating SageMaker endpoint configuration...")
@@ -82,12 +135,18 @@ def create_endpoint_configuration(client, model_id):
     return response
 
 
-def create_endpoint(client, model_id):
-    existing_endpoints = client.list_endpoints()
-    for endpoint in existing_endpoints['Endpoints']:
-        if endpoint['EndpointName'] == model_id:
-            print("SageMaker endpoint already exists. Model is online.")
-            return True
+@instrumentation.timed()
+def create_endpoint(client, model_id, inventory=None):
+    if inventory is None:
+        paginator = client.get_paginator('list_endpoints')
+        existing = set(endpoint['EndpointName']
+                       for page in paginator.paginate(NameContains=model_id)
+                       for endpoint in page['Endpoints'])
+    else:
+        existing = inventory['endpoints']
+    if model_id in existing:
+        print("SageMaker endpoint already exists. Model is online.")
+        return True
     print("Creating SageMaker endpoint... model will be online in 10 minutes.")
     response = client.create_endpoint(
         EndpointName = model_id,
@@ -97,21 +156,95 @@ def create_endpoint(client, model_id):
     return response
 
 
-def updateFirebase(fba, model_id):
-    return fba.put('/crypto/models/{}/'.format(model_id), 'status', "enabled")
+@instrumentation.timed('firebase')
+def updateFirebase(fba, model_id, status="enabled"):
+    return fba.put('/crypto/models/{}/'.format(model_id), 'status', status)
 
 
+@instrumentation.timed('describe_endpoint')
 def getEndpointStatus(client, model_id):
     response = client.describe_endpoint(EndpointName = model_id)
     return response['EndpointStatus']
 
 
+def deploy_model(client, fba, model_id, inventory):
+    """ Creates whichever of model, endpoint config and endpoint is missing. """
+    if model_id not in inventory['models']:
+        job_name = get_job_name(fba, model_id)
+        model_metadata = get_model_metadata(client, job_name)
+        if model_metadata is None:
+            raise ValueError("No training job found for model {}".format(model_id))
+        create_model(client, model_id, model_metadata, inventory)
+    create_endpoint_configuration(client, model_id, inventory)
+    create_endpoint(client, model_id, inventory)
+
+
+def wait_for_endpoints(client, model_ids, max_wait=MAX_WAIT,
+                       poll_interval=POLL_INTERVAL, max_poll_interval=MAX_POLL_INTERVAL):
+    """ Polls describe_endpoint for each model with backoff until every
+        endpoint reaches a terminal status or max_wait runs out.
+        Returns {model_id: last status seen}.
+    """
+    statuses = dict((model_id, None) for model_id in model_ids)
+    deadline = time.time() + max_wait
+    delay = poll_interval
+    while True:
+        pending = [m for m, status in statuses.items() if status not in TERMINAL_STATUSES]
+        for model_id in pending:
+            try:
+                statuses[model_id] = getEndpointStatus(client, model_id)
+            except Exception as e:
+                print("Could not describe endpoint {}: {}".format(model_id, e))
+        pending = [m for m, status in statuses.items() if status not in TERMINAL_STATUSES]
+        if not pending or time.time() + delay > deadline:
+            return statuses
+        print("Waiting on {} endpoint(s)...".format(len(pending)))
+        time.sleep(delay)
+        delay = min(delay * 2, max_poll_interval)
+
+
+def deploy_models(client, fba, model_ids, workers=DEPLOY_WORKERS, max_wait=MAX_WAIT,
+                  poll_interval=POLL_INTERVAL):
+    """ Brings every model in model_ids online. Returns {model_id: status}. """
+    inventory = get_inventory(client)
+    statuses = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((model_id, executor.submit(deploy_model, client, fba, model_id, inventory))
+                       for model_id in model_ids)
+    for model_id, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            print("Could not deploy model {}: {}".format(model_id, e))
+            instrumentation.count('deploy_failures')
+            statuses[model_id] = 'Failed'
+    for model_id in model_ids:
+        if inventory['endpoints'].get(model_id) == 'InService':
+            statuses.setdefault(model_id, 'InService')
+    waiting = [model_id for model_id in model_ids if model_id not in statuses]
+    statuses.update(wait_for_endpoints(client, waiting, max_wait, poll_interval))
+    for model_id in model_ids:
+        status = statuses[model_id]
+        if status == 'InService':
+            updateFirebase(fba, model_id)
+        else:
+            updateFirebase(fba, model_id, (status or 'unknown').lower())
+    return statuses
+
+
+@resource_cache.handler
+@instrumentation.invocation
 def lambda_handler(event, context):
+    if 'model_ids' in event:
+        print("Enabling models:", ", ".join(event['model_ids']))
+        fba = resource_cache.get_resource('firebase', lambda: getFirebaseApp(config.URL))
+        client = resource_cache.get_resource('sagemaker', getSagemakerClient)
+        return deploy_models(client, fba, event['model_ids'])
     model_id = event['model_id']
     print("Enabling model:", model_id)
-    fba = getFirebaseApp(FIREBASE_URL)
+    fba = resource_cache.get_resource('firebase', lambda: getFirebaseApp(config.URL))
     job_name = get_job_name(fba, model_id)
-    client = getSagemakerClient()
+    client = resource_cache.get_resource('sagemaker', getSagemakerClient)
     model_metadata = get_model_metadata(client, job_name)
     response = create_model(client, model_id, model_metadata)
     response = create_endpoint_configuration(client, model_id)
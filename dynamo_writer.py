@@ -0,0 +1,126 @@
+""" Buffered, batched DynamoDB writer shared by the signal collectors.
+
+    put() only queues the item; a background thread groups items into
+    batch_write_item calls of up to 25 and retries unprocessed items with
+    exponential backoff, so a slow or throttled table never stalls scraping.
+
+    Usage:
+        writer = DynamoWriter('tradingview-signals')
+        writer.put(signals)
+        ...
+        writer.close()  # flushes whatever is left
+
+    Point it at DynamoDB Local (or any stand-in) with endpoint_url, or by
+    setting DYNAMO_ENDPOINT_URL in the environment.
+
+    Requires:
+        pip install boto3
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.types import TypeSerializer
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+
+BATCH_LIMIT = 25  # items per batch_write_item, fixed by DynamoDB
+FLUSH_INTERVAL = 1.0  # seconds a partial batch may wait
+MAX_RETRIES = 8
+MAX_BACKOFF = 10  # seconds
+
+
+def to_dynamo(value):
+    """ DynamoDB rejects floats; store them as Decimals. """
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    if isinstance(value, dict):
+        return dict((k, to_dynamo(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [to_dynamo(v) for v in value]
+    return value
+
+
+class DynamoWriter(object):
+
+    def __init__(self, table_name, endpoint_url=None, client=None,
+                 flush_interval=FLUSH_INTERVAL):
+        self.table_name = table_name
+        self.client = client or boto3.client(
+            'dynamodb', endpoint_url=endpoint_url or os.environ.get('DYNAMO_ENDPOINT_URL'))
+        self.flush_interval = flush_interval
+        self.serializer = TypeSerializer()
+        self.queue = Queue()
+        self.written = 0
+        self.retries = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name='dynamo-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, item):
+        item = to_dynamo(item)
+        self.queue.put({'PutRequest': {'Item': dict(
+            (k, self.serializer.serialize(v)) for k, v in item.items())}})
+
+    def flush(self):
+        """ Blocks until everything put so far has been written or given up on. """
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            try:
+                request = self.queue.get(timeout=timeout)
+            except Empty:
+                request = False
+            if isinstance(request, dict):
+                batch.append(request)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+                if len(batch) < BATCH_LIMIT:
+                    continue
+            if batch:
+                self._write(batch)
+                batch = []
+                deadline = None
+            if request is None:
+                return
+            if isinstance(request, threading.Event):
+                request.set()
+
+    def _write(self, requests):
+        for attempt in range(MAX_RETRIES):
+            try:
+                response = self.client.batch_write_item(
+                    RequestItems={self.table_name: requests})
+                unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            except Exception as e:
+                logging.warning("DynamoDB batch write failed: {0}".format(e))
+                unprocessed = requests
+            self.written += len(requests) - len(unprocessed)
+            if not unprocessed:
+                return
+            requests = unprocessed
+            self.retries += 1
+            time.sleep(min(MAX_BACKOFF, 0.05 * 2 ** attempt) * random.uniform(0.5, 1.0))
+        self.failed += len(requests)
+        logging.error("Giving up on {0} item(s) for table {1}.".format(len(requests), self.table_name))
@@ -4,77 +4,232 @@ Collects minutely price/volume candlestick data (Open, High, Low, Close, Volume)
 of all cryptocurrency markets (ex. 'BTC-USD') on GDAX exchange and stores into
 AWS RDS-managed MySQL database and Google Firebase database.
 
-Pulls 3 hours worth of data on each currency on every execution. 
-Script can be called as frequently as you'd like, but MySQL row count operations
-are time-consuming. I recommend running every 5 minutes.
+On every execution, requests only data we don't have yet: new candles since
+the last run, holes left by outages or failed requests, and 3 more hours of
+history per market. Script can be called as frequently as you'd like. I
+recommend running every 5 minutes.
+
+Newest/oldest timestamps and row counts per table are kept in a small
+watermark table (WATERMARK_TABLE), updated in the same transaction as each
+insert batch and cached in-process, so no run needs MAX/MIN/COUNT(*) scans.
 
 On each execution, this script does the following:
     1. Get current list of markets on GDAX exchange.
     2. Determine if tables for each market exist in MySQL database.
     3. Create table if one doesn't exist (i.e. on first run, or when a new coin 
         is added to exchange.)
-    4. Determine oldest entry in each table.
-    5. Query exchange for a batch of data (3 hours worth) of minutely price data
-        for each market.
-    6. Save the batch to MySQL.
-    7. Get total row count of each table.
+    4. Determine newest and oldest entry in each table from the watermarks.
+    5. Plan requests from each market's covered-interval index: missing ranges
+        are split into chunks of at most 300 candles, ranked most recent first,
+        and cut to REQUEST_BUDGET requests per run. Requests run concurrently on a thread pool, paced by a
+        token bucket at the exchange's public rate limit and retried with
+        backoff on 429/5xx responses.
+    6. Save each batch to MySQL as soon as it arrives, while the remaining
+        requests are still in flight, and recompute the 5m/15m/1h/6h/1d rollup
+        buckets (gdax_{market}_candlesticks_{seconds}) the new candles touch.
+    7. Row counts come from the watermarks, updated with each batch.
     8. Update Google Firebase to be used for live dashboard metrics.
 
 Requirements:
-    $ pip install pymysql gdax
+    $ pip install pymysql gdax numpy
     RDS-managed MySQL server and database provisioned and online.
     
 RDS Hostname, Credentials, DB name, Table name, and Firebase URL are all stored
 in config.py.
+
+The MySQL connection, HTTP session, GDAX client and Firebase app are kept in
+resource_cache and reused across warm invocations. gdax, firebase and numpy are
+only imported by the code paths that use them.
+
+Set INSTRUMENT=1 in the environment, or pass {"instrument": true}, to log a
+run_summary of per-stage timings (fetch, parse, insert, commit, rollup,
+Firebase) and counters at the end of each invocation. {"profile": true} also
+captures a cProfile of the invocation. See instrumentation.py.
+
+Bulk history:
+    backfill_handler() pages through a date range for many markets in parallel
+    worker processes. Each worker stages candles into CSV segment files and
+    checkpoints its remaining ranges per market, so a killed run resumes where
+    it stopped. Segments are bulk-loaded with LOAD DATA LOCAL INFILE as they
+    appear, or with batched REPLACE statements if config.BACKFILL_LOADER is
+    'insert'. Worker processes need a host with /dev/shm (EC2, a laptop), not
+    Lambda. config.API_URL can point at a local fake exchange for testing;
+    tests/test_backfill.py runs a killed run and its resume against
+    benchmarks.servers.FakeExchange and the SQLite stand-in.
+
+    $ python get_gdax_candlesticks.py backfill 2017-01-01 2018-01-01 BTC-USD ETH-USD
 """
 
 from __future__ import print_function
 
-import gdax
+import instrumentation
+import resource_cache
+import bisect
+import json
+import os
 import pymysql
 import logging
+import random
+import requests
 import sys
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
-from firebase import firebase
 import config
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+BATCH_SIZE = 500  # candles per REPLACE statement / commit
+API_URL = getattr(config, 'API_URL', 'https://api.gdax.com')
+PUBLIC_RATE_LIMIT = getattr(config, 'PUBLIC_RATE_LIMIT', 3)  # requests per second allowed on public endpoints
+PUBLIC_RATE_BURST = getattr(config, 'PUBLIC_RATE_BURST', 6)
+FETCH_WORKERS = 8
+MAX_RETRIES = 5
+MAX_BACKOFF = 30  # seconds
+WATERMARK_TABLE = 'gdax_candlestick_watermarks'
+WATERMARK_MAX_AGE = 3600  # seconds before the in-process cache is re-read
+
+COVERAGE_TABLE = 'gdax_candlestick_coverage'
+COVERAGE_COMPACT_ROWS = 64  # interval rows per table before they are merged
+SETTLE_TIME = 120  # seconds after a candle closes before REST results for it are trusted
+MAX_CANDLES_PER_REQUEST = 300
+BACKFILL_STEP = 10800  # seconds of history added per market per run
+REQUEST_BUDGET = 500  # exchange requests per run
+BACKFILL_DIR = getattr(config, 'BACKFILL_DIR', '/tmp/gdax_backfill')
+BACKFILL_WORKERS = 4
+BACKFILL_LOADER = getattr(config, 'BACKFILL_LOADER', 'load_data')  # or 'insert' where LOAD DATA LOCAL INFILE is unavailable
+SEGMENT_PAGES = 100  # exchange pages per staged file
+LOAD_INTERVAL = 5  # seconds between scans for staged files
+ROLLUP_GRANULARITIES = [300, 900, 3600, 21600, 86400]  # 5m, 15m, 1h, 6h, 1d
+
+_watermarks = {}
+_watermarks_loaded = 0
+_coverage = {}
+_coverage_loaded = 0
+
+
+class RetryableError(Exception):
+    pass
+
+
+class IntervalIndex(object):
+    """ Sorted, disjoint half-open [start, end) intervals of unix time that
+    have already been requested from the exchange.
+    """
+
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(intervals):
+            self.add(start, end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def add(self, start, end):
+        if end <= start:
+            return
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def remove(self, start, end):
+        if end <= start:
+            return
+        i = bisect.bisect_right(self.ends, start)
+        j = bisect.bisect_left(self.starts, end)
+        if i >= j:
+            return
+        pieces = []
+        if self.starts[i] < start:
+            pieces.append((self.starts[i], start))
+        if self.ends[j - 1] > end:
+            pieces.append((end, self.ends[j - 1]))
+        self.starts[i:j] = [piece[0] for piece in pieces]
+        self.ends[i:j] = [piece[1] for piece in pieces]
+
+    def missing(self, start, end):
+        """ Returns the uncovered [start, end) ranges within start..end. """
+        gaps = []
+        i = bisect.bisect_right(self.ends, start)
+        cursor = start
+        while i < len(self.starts) and self.starts[i] < end:
+            if self.starts[i] > cursor:
+                gaps.append((cursor, self.starts[i]))
+            cursor = max(cursor, self.ends[i])
+            i += 1
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket. acquire() blocks until a token is free. """
+
+    def __init__(self, rate=PUBLIC_RATE_LIMIT, capacity=PUBLIC_RATE_BURST):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
 def get_firebase_app(URL):
+    from firebase import firebase
     return firebase.FirebaseApplication(URL, None)
 
-def get_initial_rowcount(fba, table):
-    row_count = fba.get('crypto/rds_metrics/gdax/{}/'.format(table), "row_count")
-    logging.info("Initial row count for table {}: {}".format(table, row_count))    
-    return row_count
-
 def save_row_count(fba, table, row_count):
     try:
         fba.put('crypto/rds_metrics/gdax/{}/'.format(table), "row_count", row_count)
     except Exception as e:
         logging.error("Count not save row count to Firebase. Error: {}".format(e))
         
-def open_mysql_connection():
+def open_mysql_connection(**kwargs):
     try:
-        connection = pymysql.connect(config.RDS_HOST, user=config.USER, passwd=config.PASSWORD, db=config.DB_NAME, connect_timeout=5)
+        connection = pymysql.connect(config.RDS_HOST, user=config.USER, passwd=config.PASSWORD, db=config.DB_NAME, connect_timeout=5, **kwargs)
     except Exception:
         logging.critical("ERROR: Unexpected error: Could not connect to MySql instance.")
-        sys.exit()
+        raise
     return connection
 
+def rollup_table(table, granularity):
+    return '{}_{}'.format(table, granularity)
+
 def check_mysql_tables(connection, cursor, markets):
+    cursor.execute('show tables like "gdax%"')
+    existing = set(row[0] for row in cursor.fetchall())
     for market in markets:
-        query = 'show tables like "gdax_{}_candlesticks"'.format(market.lower())
-        cursor.execute(query)
-        result = cursor.fetchone()
-        if result is None:
-            logging.info("No table found for market {}. Creating one now...".format(market))
-            query = 'CREATE TABLE `gdax_{}_candlesticks` (time bigint, low float,' \
+        base_table = 'gdax_{}_candlesticks'.format(market.lower())
+        tables = [base_table] + [rollup_table(base_table, g) for g in ROLLUP_GRANULARITIES]
+        for table in tables:
+            if table in existing:
+                continue
+            logging.info("No table {} found for market {}. Creating one now...".format(table, market))
+            query = 'CREATE TABLE `{}` (time bigint, low float,' \
                     ' high float, open float, close float, volume float, primary' \
-                    ' key (time));'.format(market.lower())
+                    ' key (time));'.format(table)
             try:
                 cursor.execute(query)
                 connection.commit()
@@ -85,39 +240,211 @@ def check_mysql_tables(connection, cursor, markets):
 def unix_to_iso(timestamp):
     return datetime.fromtimestamp(timestamp).isoformat()
 
-def get_newest_oldest_entries(cursor, initial_row_count, table):
-    if initial_row_count > 0:
-        query = "SELECT MAX(time) FROM `{}`".format(table)
-        cursor.execute(query)
-        newest_entry = cursor.fetchone()[0]
-        time_in_iso = unix_to_iso(newest_entry)
-        logging.info("Newest entry in table {}: {}".format(table, time_in_iso))
-        
-        query = "SELECT MIN(time) FROM `{}`".format(table)
-        cursor.execute(query)
-        oldest_entry = cursor.fetchone()[0]
-        time_in_iso = unix_to_iso(oldest_entry)
-        logging.info("Oldest entry in table {}: {}".format(table, time_in_iso))
-    
-    else:
-        newest_entry = round(time.time())
-        oldest_entry = newest_entry
-        logging.info("No entries exist. The newest timestamp will be: {}".format(newest_entry))
+def check_watermark_table(connection, cursor):
+    query = ('CREATE TABLE IF NOT EXISTS `{}` (market_table varchar(64),'
+             ' newest bigint, oldest bigint, row_count bigint,'
+             ' primary key (market_table));'.format(WATERMARK_TABLE))
+    cursor.execute(query)
+    connection.commit()
 
-    return (newest_entry, oldest_entry)
+def load_watermarks(cursor, max_age=WATERMARK_MAX_AGE):
+    """ Reads the watermark table into the in-process cache, which is reused
+    across warm invocations until it is older than max_age seconds.
+    """
+    global _watermarks_loaded
+    if _watermarks and time.time() - _watermarks_loaded < max_age:
+        return _watermarks
+    cursor.execute("SELECT market_table, newest, oldest, row_count FROM `{}`".format(WATERMARK_TABLE))
+    _watermarks.clear()
+    for table, newest, oldest, row_count in cursor.fetchall():
+        _watermarks[table] = {'newest': newest, 'oldest': oldest, 'row_count': row_count}
+    _watermarks_loaded = time.time()
+    return _watermarks
 
-def get_start_end_datetime(newest_entry, oldest_entry):
-    end_time_unix = newest_entry + 10800 # 3 hours later
-    forward_start_time = unix_to_iso(newest_entry)
-    forward_end_time = unix_to_iso(end_time_unix)
-    
-    end_time_unix = oldest_entry - 10800 # 3 hours earlier
-    backward_start_time = unix_to_iso(end_time_unix)
-    backward_end_time = unix_to_iso(oldest_entry)
-    
-    return (forward_start_time, forward_end_time, backward_start_time, backward_end_time)
+def get_watermark(connection, cursor, table, granularity=60):
+    """ Watermark for a table. Tables that predate the watermark table are
+    measured once with a single aggregate query. If they have no coverage
+    yet either, the measured range is recorded as covered in the same
+    transaction (see get_coverage).
+    """
+    if table not in _watermarks:
+        cursor.execute("SELECT MAX(time), MIN(time), COUNT(*) FROM `{}`".format(table))
+        newest, oldest, row_count = cursor.fetchone()
+        cursor.execute(
+            "REPLACE INTO `{}` (market_table, newest, oldest, row_count) "
+            "VALUES (%s, %s, %s, %s)".format(WATERMARK_TABLE),
+            (table, newest, oldest, row_count))
+        seeded = bool(row_count) and table not in _coverage
+        if seeded:
+            insert_coverage(cursor, table, oldest, newest + granularity)
+        connection.commit()
+        if seeded:
+            _coverage[table] = IntervalIndex([(oldest, newest + granularity)])
+        _watermarks[table] = {'newest': newest, 'oldest': oldest, 'row_count': row_count}
+        logging.info("Initialized watermark for table {}: {}".format(table, _watermarks[table]))
+    return _watermarks[table]
+
+def update_watermark(cursor, table, newest, oldest, rows_added):
+    """ Adds a batch to the watermark row. Runs inside the caller's insert
+    transaction; apply_watermark() mirrors it into the cache after commit.
+    """
+    cursor.execute(
+        "INSERT INTO `{}` (market_table, newest, oldest, row_count) "
+        "VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE "
+        "newest = GREATEST(COALESCE(newest, VALUES(newest)), VALUES(newest)), "
+        "oldest = LEAST(COALESCE(oldest, VALUES(oldest)), VALUES(oldest)), "
+        "row_count = row_count + VALUES(row_count)".format(WATERMARK_TABLE),
+        (table, newest, oldest, rows_added))
+
+def apply_watermark(table, newest, oldest, rows_added):
+    watermark = _watermarks.setdefault(table, {'newest': None, 'oldest': None, 'row_count': 0})
+    watermark['newest'] = newest if watermark['newest'] is None else max(watermark['newest'], newest)
+    watermark['oldest'] = oldest if watermark['oldest'] is None else min(watermark['oldest'], oldest)
+    watermark['row_count'] = (watermark['row_count'] or 0) + rows_added
+
+def check_coverage_table(connection, cursor):
+    query = ('CREATE TABLE IF NOT EXISTS `{}` (market_table varchar(64),'
+             ' start_time bigint, end_time bigint,'
+             ' primary key (market_table, start_time));'.format(COVERAGE_TABLE))
+    cursor.execute(query)
+    connection.commit()
+
+def load_coverage(cursor, max_age=WATERMARK_MAX_AGE):
+    global _coverage_loaded
+    if _coverage and time.time() - _coverage_loaded < max_age:
+        return _coverage
+    cursor.execute("SELECT market_table, start_time, end_time FROM `{}`".format(COVERAGE_TABLE))
+    intervals = {}
+    for table, start, end in cursor.fetchall():
+        intervals.setdefault(table, []).append((start, end))
+    _coverage.clear()
+    for table in intervals:
+        _coverage[table] = IntervalIndex(intervals[table])
+    _coverage_loaded = time.time()
+    return _coverage
+
+def get_coverage(connection, cursor, table, watermark, granularity=60):
+    """ Covered-interval index for a table. Tables that predate the coverage
+    table are assumed complete between their oldest and newest candle, and
+    that range is saved so the next load_coverage() sees it too.
+    """
+    if table not in _coverage:
+        if watermark['row_count']:
+            add_coverage(connection, cursor, table, watermark['oldest'], watermark['newest'] + granularity)
+        else:
+            _coverage[table] = IntervalIndex()
+    return _coverage[table]
+
+def settled_end(end, now, granularity=60):
+    """ Newest time a REST response covering up to `end` can be trusted for.
+    The exchange can take a while to publish the last closed candles, and a
+    minute marked covered is never requested again.
+    """
+    return min(end, now - now % granularity - SETTLE_TIME)
+
+def insert_coverage(cursor, table, start, end):
+    """ Writes one interval row inside the caller's transaction. """
+    cursor.execute(
+        "INSERT INTO `{}` (market_table, start_time, end_time) VALUES (%s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE end_time = GREATEST(end_time, VALUES(end_time))".format(COVERAGE_TABLE),
+        (table, start, end))
+
+def add_coverage(connection, cursor, table, start, end):
+    """ Marks [start, end) as fetched. Only the new interval is written, so
+    intervals recorded by other processes (the live builder, backfill, other
+    Lambda runs) are kept; load_coverage() merges them on read.
+    """
+    if end <= start:
+        return
+    index = _coverage.setdefault(table, IntervalIndex())
+    index.add(start, end)
+    try:
+        insert_coverage(cursor, table, start, end)
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        logging.error("Could not save coverage for table {}. {}".format(table, e))
+
+def remove_coverage(connection, cursor, table, start, end):
+    """ Marks [start, end) as needing to be fetched again, e.g. a minute the
+    live builder closed before all of its trades arrived. Overlapping rows
+    are locked and split around the range.
+    """
+    if end <= start:
+        return
+    index = _coverage.get(table)
+    if index is not None:
+        index.remove(start, end)
+    try:
+        cursor.execute("SELECT start_time, end_time FROM `{}` WHERE market_table = %s "
+                       "AND start_time < %s AND end_time > %s FOR UPDATE".format(COVERAGE_TABLE),
+                       (table, end, start))
+        overlapping = cursor.fetchall()
+        cursor.execute("DELETE FROM `{}` WHERE market_table = %s "
+                       "AND start_time < %s AND end_time > %s".format(COVERAGE_TABLE),
+                       (table, end, start))
+        remaining = IntervalIndex(overlapping)
+        remaining.remove(start, end)
+        if len(remaining):
+            cursor.executemany(
+                "INSERT INTO `{}` (market_table, start_time, end_time) VALUES (%s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE end_time = GREATEST(end_time, VALUES(end_time))".format(COVERAGE_TABLE),
+                [(table, s, e) for s, e in remaining])
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        logging.error("Could not remove coverage for table {}. {}".format(table, e))
+
+def compact_coverage(connection, cursor, min_rows=COVERAGE_COMPACT_ROWS):
+    """ Merges the interval rows of tables that have collected more than
+    min_rows of them. Each table is re-read with its rows locked and rewritten
+    in the same transaction, so nothing another process adds is lost.
+    """
+    cursor.execute("SELECT market_table FROM `{}` GROUP BY market_table "
+                   "HAVING COUNT(*) > %s".format(COVERAGE_TABLE), (min_rows,))
+    for (table,) in cursor.fetchall():
+        try:
+            cursor.execute("SELECT start_time, end_time FROM `{}` WHERE market_table = %s "
+                           "FOR UPDATE".format(COVERAGE_TABLE), (table,))
+            index = IntervalIndex(cursor.fetchall())
+            cursor.execute("DELETE FROM `{}` WHERE market_table = %s".format(COVERAGE_TABLE), (table,))
+            cursor.executemany(
+                "INSERT INTO `{}` (market_table, start_time, end_time) "
+                "VALUES (%s, %s, %s)".format(COVERAGE_TABLE),
+                [(table, s, e) for s, e in index])
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            logging.error("Could not compact coverage for table {}. {}".format(table, e))
+
+def plan_requests(table, market, index, now, granularity=60, backfill=BACKFILL_STEP):
+    """ Splits the ranges missing from the index into request-sized chunks.
+
+    The planned range runs from `backfill` seconds before the oldest covered
+    time up to the start of the current (still open) candle. Chunks are
+    returned newest first as (table, market, start, end) tuples.
+    """
+    end = now - now % granularity
+    start = (index.starts[0] if len(index) else end) - backfill
+    chunk_size = MAX_CANDLES_PER_REQUEST * granularity
+    chunks = []
+    for gap_start, gap_end in index.missing(start, end):
+        gap_start -= gap_start % granularity
+        if gap_end - gap_start < granularity:
+            continue
+        chunk_end = gap_end
+        while chunk_end > gap_start:
+            chunk_start = max(gap_start, chunk_end - chunk_size)
+            chunks.append((table, market, chunk_start, chunk_end))
+            chunk_end = chunk_start
+    return rank_requests(chunks, budget=None)
+
+def rank_requests(chunks, budget=REQUEST_BUDGET):
+    """ Most recent chunks first, cut to the per-run request budget. """
+    return sorted(chunks, key=lambda chunk: chunk[3], reverse=True)[:budget]
 
 def get_public_client():
+    import gdax
     logging.info("Initiating GDAX public client...")
     return gdax.PublicClient()
 
@@ -131,36 +458,161 @@ def get_gdax_markets(client):
 def get_data_from_gdax(gdax_client, market, start, end, granularity=60):
     logging.info("Attempting to get data from GDAX...")
     try:
-        data = gdax_client.get_product_historic_rates(
-                    market,
-                    start = start,
-                    end = end, 
-                    granularity = granularity)
+        with instrumentation.span('fetch'):
+            data = gdax_client.get_product_historic_rates(
+                        market,
+                        start = start,
+                        end = end, 
+                        granularity = granularity)
     except:
         logging.error("Could not get data from GDAX")
+        instrumentation.count('fetch_failures')
+        return []
     logging.info("{} entries retrieved from GDAX for market {}.".format(len(data), market))
     return data
 
-def insert_rows(connection, cursor, table, data):
-    for row in data:
+def get_candles(session, market, start, end, granularity=60, api_url=API_URL):
+    with instrumentation.span('fetch'):
+        response = session.get(
+            '{}/products/{}/candles'.format(api_url, market),
+            params={'start': start, 'end': end, 'granularity': granularity},
+            timeout=10)
+    if response.status_code == 429 or response.status_code >= 500:
+        raise RetryableError("HTTP {} for market {}".format(response.status_code, market))
+    response.raise_for_status()
+    with instrumentation.span('parse'):
+        return response.json()
+
+def fetch_with_backoff(bucket, session, market, start, end, granularity=60, api_url=API_URL):
+    for attempt in range(MAX_RETRIES):
+        with instrumentation.span('rate_limit_wait'):
+            bucket.acquire()
         try:
-            query = (
-                    "REPLACE INTO `{0}` (time, low, high, open, close, volume)"
-                    "VALUES ({1}, {2}, {3}, {4}, {5}, {6})".format(
-                        table, row[0], row[1], row[2], row[3], 
-                        row[4], row[5])
-                    )
-            cursor.execute(query)
+            data = get_candles(session, market, start, end, granularity, api_url)
+            logging.info("{} entries retrieved from GDAX for market {}.".format(len(data), market))
+            return data
+        except (RetryableError, requests.ConnectionError, requests.Timeout) as e:
+            delay = min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.0)
+            instrumentation.count('fetch_retries')
+            logging.warning("{}. Retrying in {:.1f}s.".format(e, delay))
+            time.sleep(delay)
+        except Exception as e:
+            logging.error("Could not get data from GDAX for market {}. {}".format(market, e))
+            instrumentation.count('fetch_failures')
+            return None
+    logging.error("Giving up on market {} after {} attempts.".format(market, MAX_RETRIES))
+    instrumentation.count('fetch_failures')
+    return None
+
+def fetch_windows(windows, bucket=None, workers=FETCH_WORKERS):
+    """ Fetches (key, market, start, end) windows concurrently and yields
+    (key, data) as each one completes, so the caller can write results while
+    the remaining requests are still in flight. data is None if the request
+    failed.
+    """
+    bucket = bucket or TokenBucket()
+    session = resource_cache.get_resource('http', requests.Session)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for key, market, start, end in windows:
+            future = pool.submit(fetch_with_backoff, bucket, session, market, start, end)
+            futures[future] = key
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def update_rollups(connection, cursor, table, times, granularities=ROLLUP_GRANULARITIES):
+    """ Recomputes only the rollup buckets touched by 1-minute candles at
+    `times`. One read of the affected minutes (spanning the coarsest touched
+    buckets) feeds every granularity. Pass fewer granularities to skip the
+    coarse ones, and the long read they need.
+
+    Returns False if the rollups could not be written.
+    """
+    import numpy as np
+    from candle_store import aggregate_candles
+    times = np.unique(np.asarray(times, dtype=np.int64))
+    if not len(times) or not granularities:
+        return True
+    coarsest = max(granularities)
+    start = int(times[0] - times[0] % coarsest)
+    end = int(times[-1] - times[-1] % coarsest + coarsest)
+    try:
+        with instrumentation.span('rollup'):
+            cursor.execute("SELECT time, low, high, open, close, volume FROM `{}` "
+                           "WHERE time >= %s AND time < %s ORDER BY time".format(table), (start, end))
+            minutes = np.asarray(cursor.fetchall(), dtype=np.float64).reshape(-1, 6)
+            for granularity in granularities:
+                rollup = aggregate_candles(minutes, granularity)
+                touched = np.isin(rollup[:, 0], np.unique(times - times % granularity))
+                rows = [(int(row[0]),) + tuple(float(v) for v in row[1:]) for row in rollup[touched]]
+                cursor.executemany(
+                    "REPLACE INTO `{}` (time, low, high, open, close, volume) "
+                    "VALUES (%s, %s, %s, %s, %s, %s)".format(rollup_table(table, granularity)), rows)
+        with instrumentation.span('commit'):
             connection.commit()
+    except Exception as e:
+        connection.rollback()
+        logging.error("Could not update rollups for {}. {}".format(table, e))
+        return False
+    return True
+
+def write_batch(connection, cursor, query, table, batch):
+    """ Writes one batch and its watermark update in a single transaction.
+
+    REPLACE reports 1 affected row for a new candle and 2 for one it
+    overwrites, which gives the number of new rows without a COUNT(*).
+    """
+    rows = [tuple(row[:6]) for row in batch]
+    with instrumentation.span('insert'):
+        if len(rows) == 1:
+            affected = cursor.execute(query, rows[0])
+        else:
+            affected = cursor.executemany(query, rows)
+        rows_added = 2 * len(rows) - affected
+        times = [row[0] for row in rows]
+        update_watermark(cursor, table, max(times), min(times), rows_added)
+    with instrumentation.span('commit'):
+        connection.commit()
+    instrumentation.count('rows_written', len(rows))
+    instrumentation.count('rows_added', rows_added)
+    apply_watermark(table, max(times), min(times), rows_added)
+
+def insert_rows(connection, cursor, table, data, batch_size=BATCH_SIZE, rollup=True):
+    """ Writes candles as parameterized multi-row REPLACE statements with one
+    commit per batch. A batch that fails is rolled back and retried row by row,
+    so one bad candle only costs itself. The table's watermark is updated in
+    the same transaction as each batch, and the rollup buckets the candles fall
+    into are recomputed afterwards.
+
+    Returns (rows_written, seconds_spent).
+    """
+    started = time.time()
+    if not isinstance(data, list):
+        logging.error("Nothing to insert into {}: {}".format(table, data))
+        return 0, 0.0
+    query = ("REPLACE INTO `{}` (time, low, high, open, close, volume) "
+             "VALUES (%s, %s, %s, %s, %s, %s)".format(table))
+    rows_written = 0
+    for i in range(0, len(data), batch_size):
+        batch = data[i:i + batch_size]
+        try:
+            write_batch(connection, cursor, query, table, batch)
+            rows_written += len(batch)
         except Exception as e:
-            logging.error("Error: Could not insert row. {}".format(e))
-            
-def get_total_rows(cursor, table):
-    query = "SELECT COUNT(*) FROM `{}`".format(table)
-    cursor.execute(query)
-    total_rows = cursor.fetchone()[0]
-    logging.info("{} total rows in table: {}".format(total_rows, table))
-    return total_rows
+            connection.rollback()
+            logging.warning("Batch insert into {} failed, retrying row by row. {}".format(table, e))
+            for row in batch:
+                try:
+                    write_batch(connection, cursor, query, table, [row])
+                    rows_written += 1
+                except Exception as e:
+                    connection.rollback()
+                    logging.error("Error: Could not insert row {}. {}".format(row, e))
+    if rollup and rows_written:
+        update_rollups(connection, cursor, table, [row[0] for row in data])
+    elapsed = time.time() - started
+    logging.info("{} row(s) written to {} in {:.3f}s.".format(rows_written, table, elapsed))
+    return rows_written, elapsed
 
 def get_rows_added(initial_row_count, table, total_rows):
     rows_added = total_rows - initial_row_count
@@ -168,29 +620,233 @@ def get_rows_added(initial_row_count, table, total_rows):
     return rows_added
 
 def update_firebase(fba, table, total_rows):
-    fba.put('crypto/rds_metrics/gdax/{}/'.format(table), "row_count", total_rows)
+    with instrumentation.span('firebase'):
+        fba.put('crypto/rds_metrics/gdax/{}/'.format(table), "row_count", total_rows)
 
+@resource_cache.handler
+@instrumentation.invocation
 def lambda_handler(event, context):
-    connection = open_mysql_connection()
+    connection = resource_cache.get_resource('mysql', open_mysql_connection, resource_cache.ping_mysql)
     cursor = connection.cursor()
-    gdax_client = get_public_client()
+    gdax_client = resource_cache.get_resource('gdax', get_public_client)
     markets = get_gdax_markets(gdax_client)
     check_mysql_tables(connection, cursor, markets)
-    fba = get_firebase_app(config.URL)
+    check_watermark_table(connection, cursor)
+    check_coverage_table(connection, cursor)
+    load_watermarks(cursor)
+    compact_coverage(connection, cursor)
+    load_coverage(cursor)
+    fba = resource_cache.get_resource('firebase', lambda: get_firebase_app(config.URL))
+    now = int(time.time())
+    chunks = []
+    initial_row_counts = {}
     for market in markets:
         table = 'gdax_{}_candlesticks'.format(market.lower())
-        initial_row_count = get_initial_rowcount(fba, table)
-        (newest_entry, oldest_entry) = get_newest_oldest_entries(cursor, initial_row_count, table)
-        forward_start_time, forward_end_time, backward_start_time, backward_end_time = get_start_end_datetime(newest_entry, oldest_entry)
-        forward_candlestick_data = get_data_from_gdax(gdax_client, market, forward_start_time, forward_end_time)
-        insert_rows(connection, cursor, table, forward_candlestick_data)
-        time.sleep(1)
-        backward_candlestick_data = get_data_from_gdax(gdax_client, market, backward_start_time, backward_end_time)
-        insert_rows(connection, cursor, table, backward_candlestick_data)
-        total_rows = get_total_rows(cursor, table)
-        rows_added = get_rows_added(initial_row_count, table, total_rows)
-        update_firebase(fba, table, total_rows)
-        time.sleep(1)
+        watermark = get_watermark(connection, cursor, table)
+        initial_row_counts[table] = watermark['row_count'] or 0
+        index = get_coverage(connection, cursor, table, watermark)
+        chunks.extend(plan_requests(table, market, index, now))
+    chunks = rank_requests(chunks)
+    logging.info("{} request(s) planned for {} markets.".format(len(chunks), len(markets)))
+    windows = []
+    pending = {}
+    for table, market, start, end in chunks:
+        windows.append(((table, start, end), market, unix_to_iso(start), unix_to_iso(end)))
+        pending[table] = pending.get(table, 0) + 1
+    for (table, start, end), candlestick_data in fetch_windows(windows):
+        instrumentation.count('windows_fetched')
+        if candlestick_data is not None:
+            insert_rows(connection, cursor, table, candlestick_data)
+            with instrumentation.span('coverage'):
+                add_coverage(connection, cursor, table, start, settled_end(end, now))
+        pending[table] -= 1
+        if pending[table] == 0:
+            total_rows = _watermarks[table]['row_count']
+            rows_added = get_rows_added(initial_row_counts[table], table, total_rows)
+            update_firebase(fba, table, total_rows)
+    cursor.close()
+    return "Success."
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_checkpoint(path, checkpoint):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+def stage_segment(staging_dir, market, start, end, rows):
+    """ Writes a segment as CSV. The file only gets its final name once it is
+    complete, so the loader never sees a partial segment.
+    """
+    path = os.path.join(staging_dir, '{}_{}_{}.csv'.format(market, start, end))
+    with open(path + '.tmp', 'w') as f:
+        for row in rows:
+            f.write('{},{},{},{},{},{}\n'.format(*row[:6]))
+    os.replace(path + '.tmp', path)
+
+def backfill_market(market, checkpoint_path, staging_dir, api_url=API_URL, rate=PUBLIC_RATE_LIMIT,
+                    segment_pages=SEGMENT_PAGES):
+    """ Worker process. Fetches the ranges left in a market's checkpoint in
+    segments of SEGMENT_PAGES requests, staging each segment before moving the
+    checkpoint past it.
+
+    Returns (market, finished).
+    """
+    checkpoint = read_checkpoint(checkpoint_path)
+    bucket = TokenBucket(rate, 1)
+    session = requests.Session()
+    page = MAX_CANDLES_PER_REQUEST * 60
+    while checkpoint['ranges']:
+        range_start, range_end = checkpoint['ranges'][0]
+        segment_end = min(range_end, range_start + page * segment_pages)
+        rows = []
+        for page_start in range(range_start, segment_end, page):
+            page_end = min(segment_end, page_start + page)
+            data = fetch_with_backoff(bucket, session, market, unix_to_iso(page_start),
+                                      unix_to_iso(page_end), api_url=api_url)
+            if data is None:
+                logging.error("Backfill of {} stopped at {}.".format(market, unix_to_iso(page_start)))
+                return market, False
+            rows.extend(data)
+        stage_segment(staging_dir, market, range_start, segment_end, rows)
+        if segment_end >= range_end:
+            checkpoint['ranges'].pop(0)
+        else:
+            checkpoint['ranges'][0] = [segment_end, range_end]
+        write_checkpoint(checkpoint_path, checkpoint)
+    return market, True
+
+def read_segment(path):
+    rows = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                values = line.split(',')
+                rows.append([int(float(values[0]))] + [float(value) for value in values[1:6]])
+    return rows
+
+def load_segment(connection, cursor, table, path, start, end, loader=None):
+    if (loader or BACKFILL_LOADER) == 'insert':
+        rows = read_segment(path)
+        with instrumentation.span('load'):
+            rows_written, _ = insert_rows(connection, cursor, table, rows)
+        if rows_written < len(rows):
+            logging.error("Could not load all of {} into {}.".format(path, table))
+            return False
+        add_coverage(connection, cursor, table, start, settled_end(end, int(time.time())))
+        logging.info("Loaded {} candle(s) from {} into {}.".format(len(rows), path, table))
+        return True
+    with open(path) as f:
+        times = [int(float(line.split(',', 1)[0])) for line in f if line.strip()]
+    if times:
+        query = ("LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE `{}` "
+                 "FIELDS TERMINATED BY ',' (time, low, high, open, close, volume)".format(table))
+        try:
+            with instrumentation.span('load'):
+                affected = cursor.execute(query, (path,))
+            rows_added = 2 * len(times) - affected
+            update_watermark(cursor, table, max(times), min(times), rows_added)
+            connection.commit()
+            apply_watermark(table, max(times), min(times), rows_added)
+        except Exception as e:
+            connection.rollback()
+            logging.error("Could not load {} into {}. {}".format(path, table, e))
+            return False
+        update_rollups(connection, cursor, table, times)
+    add_coverage(connection, cursor, table, start, settled_end(end, int(time.time())))
+    logging.info("Loaded {} candle(s) from {} into {}.".format(len(times), path, table))
+    return True
+
+def load_staged_files(connection, cursor, staging_dir, loader=None):
+    for name in sorted(os.listdir(staging_dir)):
+        if not name.endswith('.csv'):
+            continue
+        market, start, end = name[:-len('.csv')].rsplit('_', 2)
+        table = 'gdax_{}_candlesticks'.format(market.lower())
+        path = os.path.join(staging_dir, name)
+        if load_segment(connection, cursor, table, path, int(start), int(end), loader):
+            os.remove(path)
+
+def backfill(markets, start, end, staging_dir=BACKFILL_DIR, workers=BACKFILL_WORKERS, api_url=API_URL,
+             connection=None, loader=None, segment_pages=SEGMENT_PAGES):
+    """ Backfills [start, end) unix time for the given markets, skipping ranges
+    the coverage index already has. Re-running with the same arguments resumes
+    from the per-market checkpoints in staging_dir. A connection passed in is
+    left open.
+
+    Returns {market: finished}.
+    """
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir)
+    start -= start % 60
+    end -= end % 60
+    owns_connection = connection is None
+    if owns_connection:
+        connection = open_mysql_connection(local_infile=True)
+    cursor = connection.cursor()
+    check_mysql_tables(connection, cursor, markets)
+    check_watermark_table(connection, cursor)
+    check_coverage_table(connection, cursor)
+    load_watermarks(cursor)
+    load_coverage(cursor)
+    load_staged_files(connection, cursor, staging_dir, loader)
+    jobs = []
+    for market in markets:
+        checkpoint_path = os.path.join(staging_dir, '{}.checkpoint.json'.format(market))
+        checkpoint = read_checkpoint(checkpoint_path)
+        if checkpoint is None or checkpoint['start'] != start or checkpoint['end'] != end:
+            table = 'gdax_{}_candlesticks'.format(market.lower())
+            index = get_coverage(connection, cursor, table, get_watermark(connection, cursor, table))
+            checkpoint = {'start': start, 'end': end,
+                          'ranges': [list(gap) for gap in index.missing(start, end)]}
+            write_checkpoint(checkpoint_path, checkpoint)
+        if checkpoint['ranges']:
+            jobs.append((market, checkpoint_path))
+    logging.info("Backfilling {} market(s) with {} worker(s).".format(len(jobs), workers))
+    results = {}
+    if jobs:
+        rate = PUBLIC_RATE_LIMIT / float(min(workers, len(jobs)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(backfill_market, market, path, staging_dir, api_url, rate,
+                                   segment_pages)
+                       for market, path in jobs]
+            while futures:
+                done, not_done = wait(futures, timeout=LOAD_INTERVAL)
+                load_staged_files(connection, cursor, staging_dir, loader)
+                for future in done:
+                    market, finished = future.result()
+                    results[market] = finished
+                futures = list(not_done)
+    load_staged_files(connection, cursor, staging_dir, loader)
+    for market, checkpoint_path in jobs:
+        if results.get(market):
+            os.remove(checkpoint_path)
     cursor.close()
-    connection.close()
-    return "Success."
\ No newline at end of file
+    if owns_connection:
+        connection.close()
+    return results
+
+@instrumentation.invocation
+def backfill_handler(event, context):
+    """ event: {'start': unix, 'end': unix, 'markets': [...] (default: all),
+                'workers': n (optional)}
+    """
+    markets = event.get('markets') or get_gdax_markets(get_public_client())
+    results = backfill(markets, int(event['start']), int(event.get('end', time.time())),
+                       workers=event.get('workers', BACKFILL_WORKERS))
+    return results
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == 'backfill':
+        def to_unix(date):
+            return int(time.mktime(datetime.strptime(date, '%Y-%m-%d').timetuple()))
+        print(backfill_handler({'start': to_unix(sys.argv[2]), 'end': to_unix(sys.argv[3]),
+                                'markets': sys.argv[4:]}, None))
+    else:
+        print("Usage: python get_gdax_candlesticks.py backfill START_DATE END_DATE [MARKET ...]")
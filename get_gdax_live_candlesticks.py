@@ -0,0 +1,277 @@
+""" Builds minutely candlesticks in real time from the GDAX 'matches' websocket
+    channel, for every market on the exchange.
+
+    get_gdax_candlesticks.py only sees a minute once the 5-minute Lambda polls
+    the REST API, so the freshest bar can be 5+ minutes old. This script keeps
+    an OHLCV bar per product in memory, closes it GRACE seconds after the
+    minute ends, and writes closed bars through the same candlestick writer
+    (insert_rows), so watermarks stay current too. Rollup buckets are
+    recomputed as they close rather than every minute; the 6h and 1d ones,
+    whose recompute re-reads up to a day of minutes, at most every
+    ROLLUP_MAX_INTERVAL seconds.
+
+    Minutes where the stream was gap-free (consecutive trade ids since the
+    'last_match' sent on subscribe) are recorded in the coverage index, so the
+    REST Lambda only has to reconcile what the stream missed: disconnects,
+    trade id gaps, and the partial minute around each (re)subscribe. A trade
+    that arrives after its minute was closed takes that minute back out of
+    the coverage index, so the REST Lambda refetches the bar, and so does a
+    trade id gap for the already written minutes the missing trades may
+    belong to.
+
+    The newest closed bar of each product is also published to the
+    STATE_SEGMENT shared memory segment (see state_publisher.py) for
+    strategy processes on the same host.
+
+    Meant to run 24/7 on a small VM:
+        $ python get_gdax_live_candlesticks.py
+
+    Requires:
+        pip install websocket-client pymysql gdax numpy
+"""
+
+from websocket import create_connection
+from websocket import WebSocketConnectionClosedException, WebSocketTimeoutException
+import calendar
+import json
+import logging
+import time
+from datetime import datetime
+
+import get_gdax_candlesticks as candlesticks
+import state_publisher
+
+
+WS_URL = "wss://ws-feed.gdax.com"
+GRANULARITY = 60
+GRACE = 2  # seconds after a minute ends before its bar is closed
+CONNECT_TIMEOUT = 10
+RECV_TIMEOUT = 1
+MAX_RECONNECT_DELAY = 60
+ROLLUP_MAX_INTERVAL = 3600  # seconds between recomputes of a still-open 6h or 1d bucket
+STATE_SEGMENT = 'gdax_candles'  # shared memory segment name; None disables it
+
+
+def parse_time(timestamp):
+    """ '2018-01-01T00:00:00.123456Z' -> unix seconds (float). """
+    timestamp = timestamp.rstrip('Z')
+    if '.' in timestamp:
+        timestamp, fraction = timestamp.split('.')
+        fraction = float('0.' + fraction)
+    else:
+        fraction = 0.0
+    parsed = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
+    return calendar.timegm(parsed.timetuple()) + fraction
+
+
+class CandleBuilder(object):
+    """ OHLCV bars for one product, built from match messages.
+
+        Bars are only built for minutes at or after `clean_since`, the first
+        minute the stream is known to have seen every trade of.
+    """
+
+    def __init__(self, product_id, granularity=GRANULARITY):
+        self.product_id = product_id
+        self.granularity = granularity
+        self.table = 'gdax_{}_candlesticks'.format(product_id.lower())
+        self.late = candlesticks.IntervalIndex()
+        self.rollups = dict((g, set()) for g in candlesticks.ROLLUP_GRANULARITIES)
+        self.reset()
+
+    def reset(self):
+        self.bars = {}
+        self.last_trade_id = None
+        self.last_trade_minute = None
+        self.clean_since = None
+        self.flushed_until = None
+
+    def bucket(self, timestamp):
+        return int(timestamp) - int(timestamp) % self.granularity
+
+    def add(self, message):
+        msg_type = message.get('type')
+        if msg_type not in ('match', 'last_match'):
+            return
+        trade_id = message['trade_id']
+        minute = self.bucket(parse_time(message['time']))
+        if msg_type == 'last_match':
+            self.last_trade_id = trade_id
+            self.last_trade_minute = minute
+            self.clean_since = minute + self.granularity
+            return
+        if self.last_trade_id is None:
+            self.clean_since = minute + self.granularity
+        elif trade_id <= self.last_trade_id:
+            return
+        elif trade_id != self.last_trade_id + 1:
+            logging.warning("{}: trade id gap {} -> {}.".format(
+                self.product_id, self.last_trade_id, trade_id))
+            if self.flushed_until is not None and self.flushed_until > self.last_trade_minute:
+                # The missing trades may belong to minutes already written.
+                self.late.add(self.last_trade_minute,
+                              min(self.flushed_until, minute + self.granularity))
+            self.bars = dict((m, bar) for m, bar in self.bars.items()
+                             if m < self.last_trade_minute)
+            self.clean_since = minute + self.granularity
+            self.flushed_until = None
+        self.last_trade_id = trade_id
+        self.last_trade_minute = minute
+        if self.clean_since is None or minute < self.clean_since:
+            return
+        if self.flushed_until is not None and minute < self.flushed_until:
+            logging.warning("{}: late trade for closed minute {}.".format(self.product_id, minute))
+            self.late.add(minute, minute + self.granularity)
+            return
+        price = float(message['price'])
+        size = float(message['size'])
+        bar = self.bars.get(minute)
+        if bar is None:
+            self.bars[minute] = [minute, price, price, price, price, size]
+        else:
+            bar[1] = min(bar[1], price)
+            bar[2] = max(bar[2], price)
+            bar[4] = price
+            bar[5] += size
+
+    def close_bars(self, before):
+        """ Removes and returns bars for minutes before `before`, plus the
+            [start, end) range the stream fully covered, or None.
+        """
+        closed = sorted(m for m in self.bars if m < before)
+        rows = [self.bars.pop(m) for m in closed]
+        covered = None
+        if self.clean_since is not None and self.clean_since < before:
+            start = self.clean_since if self.flushed_until is None else self.flushed_until
+            if start < before:
+                covered = (start, before)
+            self.flushed_until = before
+        return rows, covered
+
+    def take_late(self):
+        """ Returns and forgets the [start, end) ranges of closed minutes that
+            got late trades or may have missed some.
+        """
+        late = list(self.late)
+        self.late = candlesticks.IntervalIndex()
+        return late
+
+    def due_rollups(self, before):
+        """ Granularities with written minutes whose rollup is due at `before`:
+            when a bucket closes, and for the coarse ones also every
+            ROLLUP_MAX_INTERVAL seconds.
+        """
+        return [g for g in candlesticks.ROLLUP_GRANULARITIES
+                if self.rollups[g] and before % min(g, ROLLUP_MAX_INTERVAL) == 0]
+
+
+def flush(connection, cursor, builders, before, publisher=None):
+    """ Writes closed bars and their coverage. Minutes that can't be written
+        are left uncovered for the REST Lambda to fill.
+    """
+    try:
+        connection.ping(reconnect=True)
+    except Exception as e:
+        logging.error("MySQL unreachable, dropping bars before {}. {}".format(before, e))
+        for builder in builders.values():
+            builder.close_bars(before)
+        return
+    for builder in builders.values():
+        rows, covered = builder.close_bars(before)
+        try:
+            if rows:
+                rows_written, _ = candlesticks.insert_rows(connection, cursor, builder.table, rows,
+                                                           rollup=False)
+                if rows_written < len(rows):
+                    covered = None
+                for pending in builder.rollups.values():
+                    pending.update(row[0] for row in rows)
+                if publisher is not None:
+                    publisher.publish(builder.product_id, dict(zip(
+                        ['time', 'low', 'high', 'open', 'close', 'volume'], rows[-1])))
+            if covered is not None:
+                candlesticks.add_coverage(connection, cursor, builder.table, *covered)
+            for start, end in builder.take_late():
+                candlesticks.remove_coverage(connection, cursor, builder.table, start, end)
+            due = builder.due_rollups(before)
+            if due:
+                times = sorted(set().union(*(builder.rollups[g] for g in due)))
+                if candlesticks.update_rollups(connection, cursor, builder.table, times, due):
+                    for g in due:
+                        builder.rollups[g].clear()
+        except Exception as e:
+            logging.error("Could not write bars for {}. {}".format(builder.product_id, e))
+
+
+def prepare_tables(connection, cursor, product_ids):
+    candlesticks.check_mysql_tables(connection, cursor, product_ids)
+    candlesticks.check_watermark_table(connection, cursor)
+    candlesticks.check_coverage_table(connection, cursor)
+    candlesticks.load_watermarks(cursor)
+    candlesticks.load_coverage(cursor)
+    for product_id in product_ids:
+        table = 'gdax_{}_candlesticks'.format(product_id.lower())
+        candlesticks.get_coverage(connection, cursor, table,
+                                  candlesticks.get_watermark(connection, cursor, table))
+
+
+def run(product_ids=None, state_segment=STATE_SEGMENT):
+    if product_ids is None:
+        product_ids = candlesticks.get_gdax_markets(candlesticks.get_public_client())
+    connection = candlesticks.open_mysql_connection()
+    cursor = connection.cursor()
+    prepare_tables(connection, cursor, product_ids)
+    builders = dict((product_id, CandleBuilder(product_id)) for product_id in product_ids)
+    logging.info("Building live candles for {} products.".format(len(builders)))
+    publisher = None
+    if state_segment is not None:
+        publisher = state_publisher.StatePublisher(state_segment)
+    delay = 1
+    while True:
+        ws = None
+        try:
+            ws = create_connection(WS_URL, timeout=CONNECT_TIMEOUT)
+            ws.settimeout(RECV_TIMEOUT)
+            ws.send(json.dumps({
+                               "type": "subscribe",
+                               "product_ids": product_ids,
+                               "channels": ["matches"]
+                               }))
+            for builder in builders.values():
+                builder.reset()
+            delay = 1
+            now = time.time()
+            next_flush = now - now % GRANULARITY + GRANULARITY + GRACE
+            while True:
+                try:
+                    raw = ws.recv()
+                except WebSocketTimeoutException:
+                    raw = None
+                if raw is not None:
+                    if not raw:
+                        # recv() returns '' once the exchange sends a close frame.
+                        raise WebSocketConnectionClosedException("Feed closed the connection")
+                    try:
+                        message = json.loads(raw)
+                    except ValueError:
+                        raise WebSocketConnectionClosedException(
+                            "Unreadable frame from feed: {!r}".format(raw[:100]))
+                    builder = builders.get(message.get('product_id'))
+                    if builder is not None:
+                        builder.add(message)
+                now = time.time()
+                if now >= next_flush:
+                    flush(connection, cursor, builders, int(next_flush - GRACE), publisher)
+                    next_flush += GRANULARITY
+        except (WebSocketConnectionClosedException, WebSocketTimeoutException, OSError) as e:
+            logging.error("Websocket error: {}. Reconnecting in {}s.".format(e, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        finally:
+            if ws is not None:
+                ws.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()
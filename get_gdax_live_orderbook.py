@@ -8,116 +8,612 @@
     sell orders at $15,000.
 
     Saves results to MySQL database provisioned in AWS RDS.
+
+    Can run either as a Lambda (one BTC-USD snapshot per invocation) or as a
+    long-running collector. The collector subscribes to every product on one
+    websocket, keeps a level2 book per product in memory, applies l2update
+    deltas to it, and writes product-keyed band metrics every WRITE_INTERVAL
+    seconds. Given a DEPTH_ROOT, it also records the top levels of every book
+    at each write as binary snapshots (see depth_snapshots.py).
+
+    Every PUBLISH_INTERVAL seconds the collector also publishes each healthy
+    book's band metrics, keyed by product, to the STATE_SEGMENT shared memory
+    segment (see state_publisher.py) for strategy processes on the same host.
+    MySQL stays the durable copy.
+
+    With INSTRUMENT=1, the Lambda logs a run_summary of per-stage timings per
+    invocation and the collector logs one per write cycle (see
+    instrumentation.py).
+
+    Rows are keyed by product, i.e. gdax_orderbook needs a product_id column:
+        ALTER TABLE gdax_orderbook ADD COLUMN product_id varchar(16) NOT NULL
+            DEFAULT 'BTC-USD' FIRST, DROP PRIMARY KEY,
+            ADD PRIMARY KEY (product_id, time);
 """
 
+import instrumentation
+import resource_cache
 from websocket import create_connection
+from websocket import WebSocketConnectionClosedException, WebSocketTimeoutException
+import asyncio
+import config
+import functools
+import depth_snapshots
 import pymysql
+import state_publisher
 import json
 import numpy as np
 import logging
-import sys
 import time
 
 
+WS_URL = "wss://ws-feed.gdax.com"
+WRITE_INTERVAL = 60
+RECV_TIMEOUT = 30
+MAX_RECONNECT_DELAY = 60
+BANDS = [1, 5, 10]  # percent from best bid/ask
+PARSE_CHUNK = 256
+DEPTH_ROOT = None  # directory for binary depth snapshots; None disables them
+STATE_SEGMENT = 'gdax_orderbook'  # shared memory segment name; None disables it
+PUBLISH_INTERVAL = 1
+HEARTBEAT_TIMEOUT = 5  # seconds without a heartbeat before a book is considered stale
+RESYNC_TIMEOUT = 10  # seconds to wait for a requested snapshot before asking again
+WATCH_INTERVAL = 1
+# gdax_orderbook columns, one count and one volume per band and side; the
+# table needs a column for each band in BANDS. Labels follow band_label().
+ORDERBOOK_COLUMNS = ['{0}_{1}within_{2:g}percent'.format(side, kind, band)
+                     for kind in ('', 'volume_') for band in BANDS for side in ('bids', 'asks')]
+
+
+class OrderBookSide(object):
+    """ One side of a level2 book, kept as sorted numpy arrays.
+
+        Levels are stored by ascending key with the best level last, where the
+        key is the price for bids and the negated price for asks. Most updates
+        land near the top of the book, so inserts and deletes only shift the
+        few levels above them. Lookups are a binary search.
+    """
+
+    def __init__(self, is_bid, capacity=1024):
+        self.is_bid = is_bid
+        self._keys = np.empty(capacity)
+        self._sizes = np.empty(capacity)
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def _key(self, price):
+        return price if self.is_bid else -price
+
+    def load(self, levels):
+        levels = np.asarray(levels, dtype=float).reshape(-1, 2)
+        levels = levels[levels[:, 1] > 0]
+        keys = levels[:, 0] if self.is_bid else -levels[:, 0]
+        order = np.argsort(keys, kind='mergesort')
+        n = len(order)
+        capacity = max(1024, 2 * n)
+        self._keys = np.empty(capacity)
+        self._sizes = np.empty(capacity)
+        self._keys[:n] = keys[order]
+        self._sizes[:n] = levels[order, 1]
+        self._n = n
+
+    def update(self, price, size):
+        key = self._key(price)
+        n = self._n
+        i = int(np.searchsorted(self._keys[:n], key))
+        if i < n and self._keys[i] == key:
+            if size > 0:
+                self._sizes[i] = size
+            else:
+                self._keys[i:n - 1] = self._keys[i + 1:n]
+                self._sizes[i:n - 1] = self._sizes[i + 1:n]
+                self._n = n - 1
+        elif size > 0:
+            if n == len(self._keys):
+                self._keys = np.concatenate((self._keys, np.empty(n)))
+                self._sizes = np.concatenate((self._sizes, np.empty(n)))
+            self._keys[i + 1:n + 1] = self._keys[i:n]
+            self._sizes[i + 1:n + 1] = self._sizes[i:n]
+            self._keys[i] = key
+            self._sizes[i] = size
+            self._n = n + 1
+
+    def best(self):
+        if self._n == 0:
+            return None
+        key = self._keys[self._n - 1]
+        return key if self.is_bid else -key
+
+    def levels(self, depth=None, within=None):
+        """ Returns an (n, 2) array of [price, size] rows, best level first.
+            `within` limits the rows to a percent distance from the best level.
+        """
+        n = self._n
+        start = 0 if depth is None else max(0, n - depth)
+        if within is not None and n:
+            best = self._keys[n - 1]
+            if self.is_bid:
+                limit = best * (1 - within / 100.0)
+            else:
+                limit = best * (1 + within / 100.0)  # keys are negated prices
+            start = max(start, int(np.searchsorted(self._keys[:n], limit, side='right')))
+        keys = self._keys[start:n][::-1]
+        result = np.empty((n - start, 2))
+        result[:, 0] = keys if self.is_bid else -keys
+        result[:, 1] = self._sizes[start:n][::-1]
+        return result
+
+
+class OrderBook(object):
+    """ In-memory level2 book for one product, fed by websocket messages.
+
+        A book needs a resync when it has not seen a snapshot yet, when the
+        book ends up crossed, or when messages may have been missed. level2
+        messages carry no sequence numbers, so missed messages are detected
+        from the heartbeat channel: its per-product sequence must keep
+        increasing, and heartbeats (one a second) must not stop for longer
+        than HEARTBEAT_TIMEOUT. Messages that do carry a sequence are also
+        checked for gaps. Until then, l2update deltas are applied in place.
+    """
+
+    def __init__(self, product_id):
+        self.product_id = product_id
+        self.bids = OrderBookSide(is_bid=True)
+        self.asks = OrderBookSide(is_bid=False)
+        self.sequence = None
+        self.heartbeat_sequence = None
+        self.last_heartbeat = None
+        self.last_update = None
+        self.needs_resync = True
+        self.resync_pending = False
+        self.resync_requested = None
+
+    def expect_snapshot(self):
+        """ Marks the book stale until the snapshot just asked for arrives. """
+        self.needs_resync = True
+        self.resync_pending = True
+        self.resync_requested = time.time()
+        self.sequence = None
+
+    def _heartbeat(self, message, now):
+        sequence = message.get('sequence')
+        missed = False
+        if sequence is not None and self.heartbeat_sequence is not None \
+                and sequence <= self.heartbeat_sequence:
+            logging.warning("{0}: heartbeat sequence went back {1} -> {2}, resyncing.".format(
+                self.product_id, self.heartbeat_sequence, sequence))
+            missed = True
+        elif self.last_heartbeat is not None and now - self.last_heartbeat > HEARTBEAT_TIMEOUT:
+            logging.warning("{0}: no heartbeat for {1:.1f}s, resyncing.".format(
+                self.product_id, now - self.last_heartbeat))
+            missed = True
+        self.heartbeat_sequence = sequence
+        self.last_heartbeat = now
+        if missed and not self.needs_resync:
+            self.needs_resync = True
+        return not missed
+
+    def check(self, now=None):
+        """ Returns True if a (new) snapshot should be requested: heartbeats
+            stopped on a healthy book, or a requested snapshot never came.
+        """
+        now = time.time() if now is None else now
+        if self.resync_pending:
+            if self.resync_requested is not None and now - self.resync_requested > RESYNC_TIMEOUT:
+                logging.warning("{0}: no snapshot {1:.0f}s after resync, asking again.".format(
+                    self.product_id, now - self.resync_requested))
+                return True
+            return False
+        if not self.needs_resync and self.last_heartbeat is not None \
+                and now - self.last_heartbeat > HEARTBEAT_TIMEOUT:
+            logging.warning("{0}: no heartbeat for {1:.1f}s, resyncing.".format(
+                self.product_id, now - self.last_heartbeat))
+            self.needs_resync = True
+        return self.needs_resync
+
+    def apply(self, message):
+        msg_type = message.get('type')
+        if msg_type == 'heartbeat':
+            return self._heartbeat(message, time.time())
+        if msg_type == 'snapshot':
+            self.bids.load(message['bids'])
+            self.asks.load(message['asks'])
+            self.sequence = message.get('sequence')
+            self.last_update = time.time()
+            self.last_heartbeat = self.last_update
+            self.needs_resync = False
+            self.resync_pending = False
+            self.resync_requested = None
+            return True
+        if msg_type != 'l2update' or self.needs_resync:
+            return False
+        sequence = message.get('sequence')
+        if sequence is not None and self.sequence is not None:
+            if sequence <= self.sequence:
+                return False
+            if sequence != self.sequence + 1:
+                logging.warning("{0}: sequence gap {1} -> {2}, resyncing.".format(
+                    self.product_id, self.sequence, sequence))
+                self.needs_resync = True
+                return False
+        self.sequence = sequence
+        for side, price, size in message['changes']:
+            book_side = self.bids if side == 'buy' else self.asks
+            book_side.update(float(price), float(size))
+        best_bid = self.bids.best()
+        best_ask = self.asks.best()
+        if best_bid is not None and best_ask is not None and best_bid >= best_ask:
+            logging.warning("{0}: crossed book ({1} >= {2}), resyncing.".format(
+                self.product_id, best_bid, best_ask))
+            self.needs_resync = True
+        self.last_update = time.time()
+        return True
+
+    def snapshot(self, depth=None, within=None):
+        """ Returns the book in the same shape as a websocket snapshot. """
+        return {'product_id': self.product_id,
+                'bids': self.bids.levels(depth, within),
+                'asks': self.asks.levels(depth, within)}
+
+
 def openMySQLConnection():
     try:
-        connection = pymysql.connect(rds_host, user=name, passwd=password, db=db_name, connect_timeout=5)
+        connection = pymysql.connect(config.RDS_HOST, user=config.USER, passwd=config.PASSWORD,
+                                     db=config.DB_NAME, connect_timeout=5)
     except Exception:
         logging.critical("ERROR: Unexpected error: Could not connect to MySql instance.")
-        sys.exit()
+        raise
     return connection
 
 
 def get_orderbook():
-    ws = create_connection("wss://ws-feed.gdax.com")
-    request = json.dumps({
-                         "type": "subscribe",
-                         "product_ids": ["BTC-USD"],
-                         "channels": ["level2"]
-                         })
-    ws.send(request)
-    result = json.loads(ws.recv())
-    return result
+    with instrumentation.span('fetch'):
+        ws = create_connection(WS_URL)
+        request = json.dumps({
+                             "type": "subscribe",
+                             "product_ids": ["BTC-USD"],
+                             "channels": ["level2"]
+                             })
+        ws.send(request)
+        message = ws.recv()
+        ws.close()
+    with instrumentation.span('parse'):
+        return json.loads(message)
+
+
+def get_product_ids():
+    import gdax
+    products = gdax.PublicClient().get_products()
+    return [product['id'] for product in products]
+
+
+def subscribe(ws, product_ids, msg_type="subscribe", channels=("level2", "heartbeat")):
+    ws.send(json.dumps({
+                       "type": msg_type,
+                       "product_ids": product_ids,
+                       "channels": list(channels)
+                       }))
+
+
+def resync(ws, book):
+    """ Re-subscribes a single product's level2 channel so the feed sends a
+        fresh snapshot. The heartbeat subscription is left alone.
+    """
+    logging.info("Requesting new snapshot for {0}.".format(book.product_id))
+    subscribe(ws, [book.product_id], "unsubscribe", ["level2"])
+    subscribe(ws, [book.product_id], channels=["level2"])
+    book.expect_snapshot()
+
+
+def band_label(band):
+    return '{0:g}'.format(band)
+
+
+def _parse_side(levels, is_bid, widest):
+    """ Returns float (prices, sizes) for one side, best level first.
 
+        Snapshots from the feed are lists of strings sorted best-first, so only
+        a prefix can fall inside the widest band. That prefix is found by
+        parsing geometrically growing chunks; deeper levels are never converted.
+    """
+    if isinstance(levels, np.ndarray) and levels.dtype.kind == 'f':
+        return levels[:, 0], levels[:, 1]
+    n = len(levels)
+    if n == 0:
+        return np.empty(0), np.empty(0)
+    best = float(levels[0][0])
+    limit = best * (1 - widest / 100.0) if is_bid else best * (1 + widest / 100.0)
+    end = min(n, PARSE_CHUNK)
+    while end < n:
+        last = float(levels[end - 1][0])
+        if (last <= limit) if is_bid else (last >= limit):
+            break
+        end = min(n, end * 2)
+    parsed = np.array([(row[0], row[1]) for row in levels[:end]], dtype=float)
+    return parsed[:, 0], parsed[:, 1]
 
-def get_bid_ask_volumes(orderbook):
-    bids = np.asarray(orderbook['bids']).astype(float)
-    asks = np.asarray(orderbook['asks']).astype(float)
+
+def _side_bands(prices, sizes, is_bid, bands, side, result):
+    if len(prices) == 0:
+        cutoffs = np.zeros(len(bands), dtype=int)
+        volume = notional = np.zeros(1)
+    else:
+        best = prices[0]
+        if is_bid:
+            limits = best * (1 - np.asarray(bands) / 100.0)
+            cutoffs = np.searchsorted(-prices, -limits, side='left')
+        else:
+            limits = best * (1 + np.asarray(bands) / 100.0)
+            cutoffs = np.searchsorted(prices, limits, side='left')
+        volume = np.concatenate(([0.0], np.cumsum(sizes)))
+        notional = np.concatenate(([0.0], np.cumsum(prices * sizes)))
+    for band, cutoff in zip(bands, cutoffs):
+        label = band_label(band)
+        band_volume = float(volume[cutoff]) if cutoff else 0.0
+        band_notional = float(notional[cutoff]) if cutoff else 0.0
+        result['{0}_within_{1}percent'.format(side, label)] = int(cutoff)
+        result['{0}_volume_within_{1}percent'.format(side, label)] = band_volume
+        result['{0}_notional_within_{1}percent'.format(side, label)] = band_notional
+        result['{0}_vwap_within_{1}percent'.format(side, label)] = \
+            band_notional / band_volume if band_volume else 0.0
+
+
+def get_bid_ask_volumes(orderbook, bands=BANDS):
+    """ Order count, volume, notional and VWAP of the levels within each
+        percent band of the best bid/ask. Bids count when strictly above
+        best_bid * (1 - band%), asks when strictly below best_ask * (1 + band%).
+
+        Accepts a raw websocket snapshot or OrderBook.snapshot().
+    """
+    bands = sorted(bands)
+    widest = bands[-1]
     result = {}
-    result['asks_within_1percent'] = 0
-    result['asks_within_5percent'] = 0
-    result['asks_within_10percent'] = 0
-    result['bids_within_1percent'] = 0
-    result['bids_within_5percent'] = 0
-    result['bids_within_10percent'] = 0
-    result['bids_volume_within_1percent'] = 0
-    result['asks_volume_within_1percent'] = 0
-    result['bids_volume_within_5percent'] = 0
-    result['asks_volume_within_5percent'] = 0
-    result['bids_volume_within_10percent'] = 0
-    result['asks_volume_within_10percent'] = 0
-    for row in bids:
-        if row[0] > bids[0][0]*.99:
-            result['bids_volume_within_1percent'] += row[1]
-            result['bids_within_1percent'] += 1
-        if row[0] > bids[0][0]*.95:
-            result['bids_volume_within_5percent'] += row[1]
-            result['bids_within_5percent'] += 1
-        if row[0] > bids[0][0]*.9:
-            result['bids_volume_within_10percent'] += row[1]
-            result['bids_within_10percent'] += 1
-            
-
-    for row in asks:
-        if row[0] < asks[0][0]*1.01:
-            result['asks_volume_within_1percent'] += row[1]
-            result['asks_within_1percent'] += 1
-        if row[0] < asks[0][0]*1.05:
-            result['asks_volume_within_5percent'] += row[1]
-            result['asks_within_5percent'] += 1
-        if row[0] < asks[0][0]*1.1:
-            result['asks_volume_within_10percent'] += row[1]
-            result['asks_within_10percent'] += 1
+    bid_prices, bid_sizes = _parse_side(orderbook['bids'], True, widest)
+    ask_prices, ask_sizes = _parse_side(orderbook['asks'], False, widest)
+    _side_bands(bid_prices, bid_sizes, True, bands, 'bids', result)
+    _side_bands(ask_prices, ask_sizes, False, bands, 'asks', result)
     return result
 
 
-def insertRows(connection, cursor, data):
-    timestamp = int(time.time())
+def insertRows(connection, cursor, data, product_id="BTC-USD"):
+    insertProductRows(connection, cursor, {product_id: data})
+
+
+def insertProductRows(connection, cursor, volumes_by_product, timestamp=None):
+    """ Writes one row per product in a single statement and commit. """
+    if timestamp is None:
+        timestamp = int(time.time())
+    query = "REPLACE INTO gdax_orderbook (product_id, time, {0}) VALUES ({1})".format(
+        ", ".join(ORDERBOOK_COLUMNS), ", ".join(["%s"] * (len(ORDERBOOK_COLUMNS) + 2)))
+    rows = [[product_id, timestamp] + [data[column] for column in ORDERBOOK_COLUMNS]
+            for product_id, data in volumes_by_product.items()]
     try:
-        query = "REPLACE INTO gdax_orderbook (time, " \
-                "bids_within_1percent, asks_within_1percent," \
-                "bids_within_5percent, asks_within_5percent," \
-                "bids_within_10percent, asks_within_10percent," \
-                "bids_volume_within_1percent, asks_volume_within_1percent," \
-                "bids_volume_within_5percent, asks_volume_within_5percent," \
-                "bids_volume_within_10percent, asks_volume_within_10percent)" \
-                "VALUES ({0}, {1}, {2}, {3}, {4}, {5}, {6}, {7}, {8}, {9}, {10}, {11}, {12})".format(
-                    timestamp, 
-                    data['bids_within_1percent'],
-                    data['asks_within_1percent'],
-                    data['bids_within_5percent'],
-                    data['asks_within_5percent'],
-                    data['bids_within_10percent'],
-                    data['asks_within_10percent'],
-                    data['bids_volume_within_1percent'],
-                    data['asks_volume_within_1percent'],
-                    data['bids_volume_within_5percent'],
-                    data['asks_volume_within_5percent'],
-                    data['bids_volume_within_10percent'],
-                    data['asks_volume_within_10percent'])
-        cursor.execute(query)
-        connection.commit()
+        with instrumentation.span('insert'):
+            cursor.executemany(query, rows)
+        with instrumentation.span('commit'):
+            connection.commit()
+        instrumentation.count('rows_written', len(rows))
     except Exception as e:
-        logging.error("Error: Could not insert row. {0}".format(e))
+        logging.error("Error: Could not insert rows. {0}".format(e))
+        instrumentation.count('insert_failures')
 
 
+@resource_cache.handler
+@instrumentation.invocation
 def lambda_handler(event, context):
     orderbook = get_orderbook()
-    volumes = get_bid_ask_volumes(orderbook)
-    connection = openMySQLConnection()
+    with instrumentation.span('bands'):
+        volumes = get_bid_ask_volumes(orderbook)
+    connection = resource_cache.get_resource('mysql', openMySQLConnection, resource_cache.ping_mysql)
     cursor = connection.cursor()
     insertRows(connection, cursor, volumes)
     cursor.close()
-    connection.close()
     return 'Success'
-    
+
+
+async def _read_feed(ws, queues):
+    """ Routes feed messages to per-product queues. recv() blocks, so it runs
+        in the default executor and never stalls the per-product workers.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        raw = await loop.run_in_executor(None, ws.recv)
+        if not raw:
+            # recv() returns '' once the exchange sends a close frame.
+            raise WebSocketConnectionClosedException("Feed closed the connection")
+        with instrumentation.span('parse'):
+            try:
+                message = json.loads(raw)
+            except ValueError:
+                raise WebSocketConnectionClosedException(
+                    "Unreadable frame from feed: {0!r}".format(raw[:100]))
+        instrumentation.count('messages')
+        queue = queues.get(message.get('product_id'))
+        if queue is not None:
+            queue.put_nowait(message)
+
+
+async def _apply_updates(ws, book, queue):
+    while True:
+        message = await queue.get()
+        try:
+            with instrumentation.span('apply'):
+                book.apply(message)
+        except Exception as e:
+            logging.error("{0}: could not apply {1} message, resyncing. {2}".format(
+                book.product_id, message.get('type'), e))
+            instrumentation.count('apply_failures')
+            book.needs_resync = True
+        if book.needs_resync and not book.resync_pending:
+            resync(ws, book)
+
+
+async def _watch_books(ws, books, interval=WATCH_INTERVAL):
+    """ Resyncs books whose heartbeats stopped or whose snapshot never came,
+        which no incoming message would otherwise notice.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        now = time.time()
+        for book in books.values():
+            if book.check(now):
+                resync(ws, book)
+
+
+async def _until_first_failure(tasks):
+    """ Waits for any of a connection's tasks to stop and raises its error.
+        They all loop forever, so one stopping at all is a failure.
+    """
+    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+        task.result()
+    raise WebSocketConnectionClosedException("Feed task stopped unexpectedly")
+
+
+async def _restarting(name, start):
+    """ Runs the coroutine made by start(), restarting it whenever it fails. """
+    while True:
+        try:
+            await start()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("{0} failed, restarting it.".format(name))
+            instrumentation.count('task_restarts')
+            await asyncio.sleep(1)
+
+
+def writeProductRows(connection, cursor, volumes_by_product, timestamp):
+    """ Pings MySQL first, reconnecting if need be, so the collector outlives
+        RDS timeouts and failovers.
+    """
+    try:
+        connection.ping(reconnect=True)
+    except Exception as e:
+        logging.error("Error: MySQL unreachable, skipping write. {0}".format(e))
+        instrumentation.count('insert_failures')
+        return
+    insertProductRows(connection, cursor, volumes_by_product, timestamp)
+
+
+def writeDepthSnapshots(depth_writer, snapshots, timestamp):
+    with instrumentation.span('depth_snapshots'):
+        for product_id, snapshot in snapshots.items():
+            depth_writer.append(product_id, timestamp, snapshot['bids'], snapshot['asks'])
+        depth_writer.flush()
+
+
+async def _write_metrics(connection, cursor, books, interval, depth_writer=None):
+    loop = asyncio.get_running_loop()
+    widest = max(BANDS)
+    while True:
+        await asyncio.sleep(interval)
+        timestamp = time.time()
+        volumes = {}
+        snapshots = {}
+        for product_id, book in books.items():
+            if not book.needs_resync:
+                with instrumentation.span('bands'):
+                    volumes[product_id] = get_bid_ask_volumes(book.snapshot(within=widest))
+                if depth_writer is not None:
+                    snapshots[product_id] = book.snapshot(depth=depth_writer.levels)
+        if volumes:
+            await loop.run_in_executor(
+                None, writeProductRows, connection, cursor, volumes, int(timestamp))
+        if snapshots:
+            await loop.run_in_executor(
+                None, writeDepthSnapshots, depth_writer, snapshots, timestamp)
+        instrumentation.count('books_written', len(volumes))
+        instrumentation.report('orderbook_collector', interval=interval)
+
+
+async def _publish_state(books, publisher, interval=PUBLISH_INTERVAL):
+    widest = max(BANDS)
+    while True:
+        await asyncio.sleep(interval)
+        timestamp = time.time()
+        for product_id, book in books.items():
+            if not book.needs_resync:
+                with instrumentation.span('publish'):
+                    publisher.publish(
+                        product_id, get_bid_ask_volumes(book.snapshot(within=widest)), timestamp)
+
+
+async def collect(product_ids, interval=WRITE_INTERVAL, depth_root=DEPTH_ROOT,
+                  state_segment=STATE_SEGMENT):
+    """ Maintains a book per product over a single websocket subscription and
+        writes band metrics for all of them every `interval` seconds.
+        Reconnects with backoff if the connection drops or any of its tasks
+        fails; every book then starts again from a fresh snapshot. The
+        metrics writer and state publisher are restarted if they fail.
+    """
+    loop = asyncio.get_running_loop()
+    books = {product_id: OrderBook(product_id) for product_id in product_ids}
+    connection = openMySQLConnection()
+    cursor = connection.cursor()
+    depth_writer = None
+    if depth_root is not None:
+        depth_writer = depth_snapshots.DepthWriter(depth_root)
+    writer = asyncio.ensure_future(_restarting('Metrics writer', functools.partial(
+        _write_metrics, connection, cursor, books, interval, depth_writer)))
+    publisher = None
+    if state_segment is not None:
+        publisher = state_publisher.StatePublisher(state_segment)
+        publishing = asyncio.ensure_future(_restarting('State publisher', functools.partial(
+            _publish_state, books, publisher)))
+    delay = 1
+    try:
+        while True:
+            ws = None
+            workers = []
+            try:
+                ws = await loop.run_in_executor(
+                    None, functools.partial(create_connection, WS_URL, timeout=RECV_TIMEOUT))
+                subscribe(ws, list(product_ids))
+                queues = {}
+                for product_id, book in books.items():
+                    book.expect_snapshot()
+                    queues[product_id] = asyncio.Queue()
+                    workers.append(asyncio.ensure_future(
+                        _apply_updates(ws, book, queues[product_id])))
+                workers.append(asyncio.ensure_future(_watch_books(ws, books)))
+                delay = 1
+                workers.append(asyncio.ensure_future(_read_feed(ws, queues)))
+                await _until_first_failure(workers)
+            except (WebSocketConnectionClosedException, WebSocketTimeoutException, OSError) as e:
+                logging.error("Websocket error: {0}. Reconnecting in {1}s.".format(e, delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            except Exception:
+                logging.exception("Feed task failed. Reconnecting in {0}s.".format(delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                if ws is not None:
+                    ws.close()
+    finally:
+        writer.cancel()
+        if depth_writer is not None:
+            depth_writer.close()
+        if publisher is not None:
+            publishing.cancel()
+            publisher.close()
+        cursor.close()
+        connection.close()
+
+
+def run_collector(product_ids=None, interval=WRITE_INTERVAL, depth_root=DEPTH_ROOT):
+    """ Long-running mode. Covers every product on the exchange by default. """
+    if product_ids is None:
+        product_ids = get_product_ids()
+    logging.info("Collecting order books for {0} products.".format(len(product_ids)))
+    asyncio.run(collect(product_ids, interval, depth_root))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run_collector()
@@ -0,0 +1,428 @@
+""" Computes TradingView-style technical summaries locally from our own GDAX
+    candles, instead of scraping tradingview.com with Selenium.
+
+    For each of the 8 TIME_INTERVALS, the standard set behind TradingView's
+    technicals page is evaluated and each indicator votes buy/sell/neutral:
+
+      Moving averages: EMA and SMA 10/20/30/50/100/200, Ichimoku base line,
+        VWMA 20, Hull MA 9. Buy when the average is below the close.
+      Oscillators: RSI 14, Stochastic 14/3/3, CCI 20, ADX 14, Awesome
+        Oscillator, Momentum 10, MACD 12/26/9, Stochastic RSI 3/3/14/14,
+        Williams %R 14, Bull Bear Power 13, Ultimate Oscillator 7/14/28.
+
+    The output has the same shape as get_tradingview_technicals.get_signals():
+      {'market': 'BTCUSD', 'time': 1514764800,
+       '1_min': {'sell_count': 4, 'neutral_count': 9, 'buy_count': 12,
+                 'signal_word': 'Buy'}, ...}
+
+    Candles come from the local candle store (candle_store.py), synced from
+    MySQL. Engines are warmed up once from history, then only the newest bar
+    of each interval is folded in: EMA/Wilder states update in O(1), and
+    windowed indicators are evaluated over a bounded tail of bars. Indicators
+    without enough history yet (e.g. SMA 200 on monthly bars) don't vote.
+
+    Besides DynamoDB, signals are published by market to the STATE_SEGMENT
+    shared memory segment (see state_publisher.py) for same-host readers.
+
+    Requires:
+      pip install numpy boto3 pymysql
+"""
+
+import logging
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from candle_store import COLUMNS, CandleStore, aggregate_candles
+from dynamo_writer import DynamoWriter
+from state_publisher import StatePublisher
+
+
+STORE_ROOT = '/var/lib/gdax-candles'
+MARKETS = ['BCH-USD', 'BTC-USD', 'ETH-USD', 'LTC-USD']
+DYNAMO_TABLE_NAME = 'local-signals'
+TIME_INTERVALS = ['1_min', '5_min', '15_min', '1_hour', '4_hour', '1_day',
+                  '1_week', '1_month']
+INTERVAL_SECONDS = {'1_min': 60, '5_min': 300, '15_min': 900, '1_hour': 3600,
+                    '4_hour': 14400, '1_day': 86400, '1_week': 604800,
+                    '1_month': 31 * 86400}
+WEEK_OFFSET = 4 * 86400  # 1970-01-05, the first Monday after the epoch
+MA_LENGTHS = [10, 20, 30, 50, 100, 200]
+HISTORY = 256  # bars kept per interval for windowed indicators
+WARMUP_BARS = 1000  # closed bars replayed per interval on startup
+RUN_INTERVAL = 60
+STATE_SEGMENT = 'local_signals'
+
+
+def bucket_starts(times, interval):
+    """ Start of the `interval` bar each unix timestamp falls into. """
+    times = np.asarray(times, dtype=np.int64)
+    if interval == '1_month':
+        months = times.astype('datetime64[s]').astype('datetime64[M]')
+        return months.astype('datetime64[s]').astype(np.int64)
+    seconds = INTERVAL_SECONDS[interval]
+    offset = WEEK_OFFSET if interval == '1_week' else 0
+    return times - (times - offset) % seconds
+
+
+def rating_word(rating):
+    if rating > 0.5:
+        return 'Strong Buy'
+    if rating > 0.1:
+        return 'Buy'
+    if rating < -0.5:
+        return 'Strong Sell'
+    if rating < -0.1:
+        return 'Sell'
+    return 'Neutral'
+
+
+def sma_windows(values, length):
+    return sliding_window_view(values, length).mean(axis=1)
+
+
+def wma(values, length):
+    weights = np.arange(1, length + 1, dtype=np.float64)
+    return sliding_window_view(values, length).dot(weights) / weights.sum()
+
+
+def stochastic(close, high, low, length, smooth_k, smooth_d):
+    """ Last (%K, %D) of a stochastic over the tails of close/high/low. """
+    needed = length + smooth_k + smooth_d - 2
+    highest = sliding_window_view(high[-needed:], length).max(axis=1)
+    lowest = sliding_window_view(low[-needed:], length).min(axis=1)
+    spread = highest - lowest
+    raw = np.where(spread > 0, 100 * (close[-len(spread):] - lowest) / np.where(spread > 0, spread, 1), 50.0)
+    k = sma_windows(raw, smooth_k)
+    d = sma_windows(k, smooth_d)
+    return k[-1], d[-1]
+
+
+class Tail(object):
+    """ The last `size` values of a growing series, appended in amortized O(1). """
+
+    def __init__(self, size):
+        self.size = size
+        self._data = np.full(2 * size, np.nan)
+        self._n = 0
+
+    def __len__(self):
+        return min(self._n, self.size)
+
+    def append(self, value):
+        if self._n == len(self._data):
+            self._data[:self.size] = self._data[self._n - self.size:self._n]
+            self._n = self.size
+        self._data[self._n] = value
+        self._n += 1
+
+    def values(self):
+        return self._data[max(0, self._n - self.size):self._n]
+
+
+class IndicatorEngine(object):
+    """ Indicator state for one market and interval, fed one closed bar at a
+        time.
+    """
+
+    def __init__(self, history=HISTORY):
+        self.time = None
+        self.count = 0
+        self.state = {}
+        self.prev = None
+        self.bars = dict((column, Tail(history)) for column in COLUMNS[1:])
+        self.series = dict((name, Tail(history)) for name in
+                           ('rsi', 'adx', 'plus_di', 'minus_di', 'ema13'))
+
+    def _ema(self, key, value, length, wilder=False):
+        alpha = 1.0 / length if wilder else 2.0 / (length + 1)
+        previous = self.state.get(key)
+        self.state[key] = value if previous is None else previous + alpha * (value - previous)
+        return self.state[key]
+
+    def update(self, bar):
+        """ Folds in one closed bar (time, low, high, open, close, volume).
+            Bars not newer than the last one are ignored.
+        """
+        bar_time, low, high, open_, close, volume = [float(v) for v in bar[:6]]
+        if self.time is not None and bar_time <= self.time:
+            return False
+        self.time = bar_time
+        self.count += 1
+        for column, value in zip(COLUMNS[1:], (low, high, open_, close, volume)):
+            self.bars[column].append(value)
+        for length in set(MA_LENGTHS + [12, 26]):
+            self._ema(('ema', length), close, length)
+        self.series['ema13'].append(self._ema(('ema', 13), close, 13))
+        self._ema('macd_signal', self.state[('ema', 12)] - self.state[('ema', 26)], 9)
+
+        rsi = adx = plus_di = minus_di = np.nan
+        if self.prev is not None:
+            prev_low, prev_high, prev_close = self.prev
+            change = close - prev_close
+            gain = self._ema('rsi_gain', max(change, 0.0), 14, wilder=True)
+            loss = self._ema('rsi_loss', max(-change, 0.0), 14, wilder=True)
+            rsi = 100.0 if loss == 0 else 100.0 - 100.0 / (1 + gain / loss)
+
+            true_range = max(high, prev_close) - min(low, prev_close)
+            up_move = high - prev_high
+            down_move = prev_low - low
+            plus_dm = up_move if up_move > down_move and up_move > 0 else 0.0
+            minus_dm = down_move if down_move > up_move and down_move > 0 else 0.0
+            atr = self._ema('atr', true_range, 14, wilder=True)
+            smoothed_plus = self._ema('plus_dm', plus_dm, 14, wilder=True)
+            smoothed_minus = self._ema('minus_dm', minus_dm, 14, wilder=True)
+            plus_di = 100 * smoothed_plus / atr if atr else 0.0
+            minus_di = 100 * smoothed_minus / atr if atr else 0.0
+            di_sum = plus_di + minus_di
+            dx = 100 * abs(plus_di - minus_di) / di_sum if di_sum else 0.0
+            adx = self._ema('adx', dx, 14, wilder=True)
+        self.series['rsi'].append(rsi if self.count > 14 else np.nan)
+        self.series['adx'].append(adx if self.count > 28 else np.nan)
+        self.series['plus_di'].append(plus_di)
+        self.series['minus_di'].append(minus_di)
+        self.prev = (low, high, close)
+        return True
+
+    def moving_average_votes(self):
+        close = self.bars['close'].values()
+        high = self.bars['high'].values()
+        low = self.bars['low'].values()
+        volume = self.bars['volume'].values()
+        price = close[-1]
+        averages = []
+        for length in MA_LENGTHS:
+            if self.count >= length:
+                averages.append(self.state[('ema', length)])
+                averages.append(close[-length:].mean())
+        if len(close) >= 26:
+            averages.append((high[-26:].max() + low[-26:].min()) / 2)
+        if len(close) >= 20 and volume[-20:].sum() > 0:
+            averages.append((close[-20:] * volume[-20:]).sum() / volume[-20:].sum())
+        if len(close) >= 11:
+            tail = close[-11:]
+            averages.append(wma(2 * wma(tail, 4)[-3:] - wma(tail, 9), 3)[-1])
+        return [1 if average < price else -1 if average > price else 0 for average in averages]
+
+    def oscillator_votes(self):
+        close = self.bars['close'].values()
+        high = self.bars['high'].values()
+        low = self.bars['low'].values()
+        n = len(close)
+        votes = []
+
+        rsi = self.series['rsi'].values()
+        if n >= 16 and not np.isnan(rsi[-2]):
+            votes.append(1 if rsi[-1] < 30 and rsi[-1] > rsi[-2] else
+                         -1 if rsi[-1] > 70 and rsi[-1] < rsi[-2] else 0)
+
+        if n >= 18:
+            k, d = stochastic(close, high, low, 14, 3, 3)
+            votes.append(1 if k < 20 and d < 20 and k > d else
+                         -1 if k > 80 and d > 80 and k < d else 0)
+
+        if n >= 21:
+            typical = (high[-21:] + low[-21:] + close[-21:]) / 3
+            windows = sliding_window_view(typical, 20)
+            mean = windows.mean(axis=1)
+            deviation = np.abs(windows - mean[:, None]).mean(axis=1)
+            cci = np.where(deviation > 0, (typical[-2:] - mean) / (0.015 * np.where(deviation > 0, deviation, 1)), 0.0)
+            votes.append(1 if cci[-1] < -100 and cci[-1] > cci[-2] else
+                         -1 if cci[-1] > 100 and cci[-1] < cci[-2] else 0)
+
+        adx = self.series['adx'].values()
+        if n >= 2 and not np.isnan(adx[-2]):
+            plus_di = self.series['plus_di'].values()[-1]
+            minus_di = self.series['minus_di'].values()[-1]
+            rising = adx[-1] > 20 and adx[-1] > adx[-2]
+            votes.append(1 if rising and plus_di > minus_di else
+                         -1 if rising and minus_di > plus_di else 0)
+
+        if n >= 36:
+            median = (high[-36:] + low[-36:]) / 2
+            ao = sma_windows(median, 5)[-3:] - sma_windows(median, 34)
+            cross_up = ao[-1] > 0 and ao[-2] < 0
+            saucer_up = ao[-1] > 0 and ao[-2] > 0 and ao[-3] > ao[-2] and ao[-1] > ao[-2]
+            cross_down = ao[-1] < 0 and ao[-2] > 0
+            saucer_down = ao[-1] < 0 and ao[-2] < 0 and ao[-3] < ao[-2] and ao[-1] < ao[-2]
+            votes.append(1 if cross_up or saucer_up else -1 if cross_down or saucer_down else 0)
+
+        if n >= 12:
+            momentum = close[-1] - close[-11]
+            prev_momentum = close[-2] - close[-12]
+            votes.append(1 if momentum > prev_momentum else -1 if momentum < prev_momentum else 0)
+
+        if self.count >= 26:
+            macd = self.state[('ema', 12)] - self.state[('ema', 26)]
+            signal = self.state['macd_signal']
+            votes.append(1 if macd > signal else -1 if macd < signal else 0)
+
+        valid_rsi = rsi[~np.isnan(rsi)]
+        if len(valid_rsi) >= 18:
+            k, d = stochastic(valid_rsi, valid_rsi, valid_rsi, 14, 3, 3)
+            votes.append(1 if k < 20 and d < 20 and k > d else
+                         -1 if k > 80 and d > 80 and k < d else 0)
+
+        if n >= 15:
+            highest = sliding_window_view(high[-15:], 14).max(axis=1)
+            lowest = sliding_window_view(low[-15:], 14).min(axis=1)
+            spread = highest - lowest
+            wr = np.where(spread > 0, -100 * (highest - close[-2:]) / np.where(spread > 0, spread, 1), -50.0)
+            votes.append(1 if wr[-1] < -80 and wr[-1] > wr[-2] else
+                         -1 if wr[-1] > -20 and wr[-1] < wr[-2] else 0)
+
+        ema13 = self.series['ema13'].values()
+        if self.count >= 50 and n >= 2:
+            bear = low[-2:] - ema13[-2:]
+            bull = high[-2:] - ema13[-2:]
+            uptrend = close[-1] > self.state[('ema', 50)]
+            votes.append(1 if uptrend and bear[-1] < 0 and bear[-1] > bear[-2] else
+                         -1 if not uptrend and bull[-1] > 0 and bull[-1] < bull[-2] else 0)
+
+        if n >= 29:
+            prev_close = close[-29:-1]
+            buying = close[-28:] - np.minimum(low[-28:], prev_close)
+            ranges = np.maximum(high[-28:], prev_close) - np.minimum(low[-28:], prev_close)
+            averages = [buying[-length:].sum() / ranges[-length:].sum() if ranges[-length:].sum() else 0.0
+                        for length in (7, 14, 28)]
+            uo = 100 * (4 * averages[0] + 2 * averages[1] + averages[2]) / 7
+            votes.append(1 if uo > 70 else -1 if uo < 30 else 0)
+        return votes
+
+    def summary(self):
+        """ Counts and summary word for the latest bar, or None before the
+            first bar.
+        """
+        if not self.count:
+            return None
+        ma_votes = self.moving_average_votes()
+        oscillator_votes = self.oscillator_votes()
+        ratings = [float(np.mean(votes)) for votes in (ma_votes, oscillator_votes) if votes]
+        votes = ma_votes + oscillator_votes
+        return {
+            "sell_count": votes.count(-1),
+            "neutral_count": votes.count(0),
+            "buy_count": votes.count(1),
+            "signal_word": rating_word(np.mean(ratings)) if ratings else 'Neutral'
+            }
+
+
+class SignalEngine(object):
+    """ One IndicatorEngine per interval for a market, fed 1-minute candles.
+        A bar is folded into its interval's engine once the next bar starts.
+    """
+
+    def __init__(self, market):
+        self.market = market
+        self.engines = dict((interval, IndicatorEngine()) for interval in TIME_INTERVALS)
+        self.pending = {}
+        self.last_minute = None
+        self.revision = None  # MarketCandles.revision the engine was built from
+
+    def warmup(self, candles):
+        """ Replays the last WARMUP_BARS closed bars of every interval from a
+            {column: array} mapping such as MarketCandles.range().
+        """
+        times = np.asarray(candles['time'])
+        if not len(times):
+            return self
+        for interval in TIME_INTERVALS:
+            since = times[-1] - (WARMUP_BARS + 1) * INTERVAL_SECONDS[interval]
+            first = int(np.searchsorted(times, bucket_starts([since], interval)[0]))
+            rows = np.column_stack([np.asarray(candles[column][first:], dtype=np.float64)
+                                    for column in COLUMNS])
+            bars = aggregate_candles(rows, buckets=bucket_starts(rows[:, 0], interval))
+            engine = self.engines[interval]
+            for bar in bars[:-1]:
+                engine.update(bar)
+            self.pending[interval] = list(bars[-1])
+        self.last_minute = int(times[-1])
+        return self
+
+    def add_minute(self, bar):
+        minute = int(bar[0])
+        if self.last_minute is not None and minute <= self.last_minute:
+            return
+        self.last_minute = minute
+        low, high, open_, close, volume = [float(v) for v in bar[1:6]]
+        for interval in TIME_INTERVALS:
+            bucket = int(bucket_starts([minute], interval)[0])
+            pending = self.pending.get(interval)
+            if pending is None or pending[0] != bucket:
+                if pending is not None:
+                    self.engines[interval].update(pending)
+                self.pending[interval] = [bucket, low, high, open_, close, volume]
+            else:
+                pending[1] = min(pending[1], low)
+                pending[2] = max(pending[2], high)
+                pending[4] = close
+                pending[5] += volume
+
+    def signals(self):
+        signals = {}
+        signals['market'] = self.market.replace('-', '')
+        signals['time'] = int(time.time())
+        for interval in TIME_INTERVALS:
+            summary = self.engines[interval].summary()
+            if summary is not None:
+                signals[interval] = summary
+        return signals
+
+
+def load_engine(store, market):
+    candles = store.market(market)
+    engine = SignalEngine(market).warmup(candles.columns())
+    engine.revision = candles.revision
+    return engine
+
+
+def load_engines(store, markets=MARKETS):
+    return dict((market, load_engine(store, market)) for market in markets)
+
+
+def update_engines(store, engines):
+    for market, engine in list(engines.items()):
+        if engine.revision != store.market(market).revision:
+            # Stored candles were corrected or reloaded; rebuild from the store.
+            engines[market] = load_engine(store, market)
+            continue
+        start = None if engine.last_minute is None else engine.last_minute + 1
+        candles = store.market(market).range(start)
+        for bar in zip(*[candles[column] for column in COLUMNS]):
+            engine.add_minute(bar)
+
+
+def run(interval=RUN_INTERVAL, once=False):
+    import get_gdax_candlesticks as candlesticks
+    connection = candlesticks.open_mysql_connection()
+    cursor = connection.cursor()
+    store = CandleStore(STORE_ROOT)
+    store.sync_from_mysql(cursor, MARKETS, candlesticks.load_watermarks(cursor, max_age=0))
+    engines = load_engines(store)
+    writer = DynamoWriter(DYNAMO_TABLE_NAME)
+    publisher = None if once else StatePublisher(STATE_SEGMENT)
+    while True:
+        started = time.time()
+        for engine in engines.values():
+            signals = engine.signals()
+            writer.put(signals)
+            if publisher is not None:
+                publisher.publish(signals['market'], signals)
+        if once:
+            break
+        time.sleep(max(0, interval - (time.time() - started)))
+        connection.ping(reconnect=True)
+        connection.commit()  # end the read snapshot so new rows are visible
+        store.sync_from_mysql(cursor, MARKETS, candlesticks.load_watermarks(cursor, max_age=0))
+        update_engines(store, engines)
+    writer.close()
+    if publisher is not None:
+        publisher.close()
+    cursor.close()
+    connection.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()
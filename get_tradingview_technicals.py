@@ -13,19 +13,51 @@ Python package requirements:
   selenium
   boto3
 
+Signals are persisted through a shared DynamoWriter (dynamo_writer.py), which
+buffers items and batch-writes them off the scraping thread.
+
 Infrastructure requirements: 
   AWS CLI pre-configured for Boto3 usage
   AWS DynamoDB table already created.
   
 Local files:
   chromedriver for your host OS
+
+Chrome sessions are kept in a small DriverPool and reused across markets, which
+are scraped in parallel. Instead of fixed sleeps, each read waits until the
+technicals panel has actually rendered or changed. Run with --daemon to keep
+the pool alive between runs instead of relaunching Chrome from cron:
+  $ python get_tradingview_technicals.py --daemon
+
+In daemon mode each market's signals are also published, keyed by market, to
+the STATE_SEGMENT shared memory segment (see state_publisher.py) so strategy
+processes on the same VM can read them without going through DynamoDB.
+
+Set INSTRUMENT=1 to log a run_summary of per-stage timings (page load, panel
+reads, publish) after each run, and INSTRUMENT_PROFILE=/some/dir to also
+profile it (see instrumentation.py).
 """
 
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dynamo_writer import DynamoWriter
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+import instrumentation
+import logging
+import state_publisher
+import sys
+import threading
 import time
-import boto3
+
+try:
+  from queue import Empty, Queue
+except ImportError:
+  from Queue import Empty, Queue
 
 __author__ = 'Shiraz Hazrat'
 __email__ = 'shiraz@shirazhazrat.com'
@@ -36,49 +68,168 @@ MARKETS = ['BCHUSD', 'BTCUSD', 'ETHUSD', 'LTCUSD']
 DYNAMO_TABLE_NAME = 'tradingview-signals'
 TIME_INTERVALS = ['1_min', '5_min', '15_min', '1_hour', '4_hour', '1_day',
           '1_week', '1_month']
+POOL_SIZE = 2
+CREATE_RETRIES = 3  # attempts to start Chrome for an empty pool slot
+PAGE_TIMEOUT = 20  # seconds to wait for the technicals widget to render
+CHANGE_TIMEOUT = 2  # seconds to wait for the panel to change after a click
+RUN_INTERVAL = 300
+STATE_SEGMENT = 'tradingview_signals'
+
+BUTTON_XPATH = '//*[@id="technicals-root"]/div/div/div[1]/div/div[{}]/div'
+PANEL_XPATH = '//*[@id="technicals-root"]/div/div/div[2]/div[2]'
+SIGNAL_XPATH = PANEL_XPATH + '/span[2]'
+SELL_COUNT_XPATH = PANEL_XPATH + '/div[2]/div[1]/span[1]'
+NEUTRAL_COUNT_XPATH = PANEL_XPATH + '/div[2]/div[2]/span[1]'
+BUY_COUNT_XPATH = PANEL_XPATH + '/div[2]/div[3]/span[1]'
+
+
+def create_driver():
+  # Define settings for Selenium to open a Chrome window.
+  chrome_options = Options()
+  chrome_options.add_argument("--headless")
+  chrome_options.add_argument("--window-size=1920x1080")
+  return webdriver.Chrome('./chromedriver', chrome_options=chrome_options)
+
+
+class DriverPool(object):
+  """ A fixed number of long-lived Chrome sessions. Drivers that error out are
+    quit and replaced on release instead of being handed out again. If Chrome
+    won't start, the slot stays empty and acquire() tries to refill it later;
+    once no driver is left at all, acquire() raises instead of blocking.
+  """
+
+  def __init__(self, size=POOL_SIZE):
+    self.size = size
+    self.drivers = Queue()
+    self.live = 0
+    self.lock = threading.Lock()
+    for _ in range(size):
+      self.drivers.put(create_driver())
+      self.live += 1
+
+  def _create(self):
+    for attempt in range(CREATE_RETRIES):
+      try:
+        return create_driver()
+      except Exception as e:
+        logging.error("Could not start Chrome (attempt {}): {}".format(attempt + 1, e))
+        time.sleep(2 ** attempt)
+    return None
+
+  def acquire(self):
+    while True:
+      try:
+        return self.drivers.get(timeout=1)
+      except Empty:
+        pass
+      with self.lock:
+        if self.live >= self.size:
+          continue
+        self.live += 1
+      driver = self._create()
+      if driver is not None:
+        return driver
+      with self.lock:
+        self.live -= 1
+        if self.live == 0:
+          raise WebDriverException("Chrome will not start and no drivers are left in the pool.")
 
+  def release(self, driver, broken=False):
+    if broken:
+      try:
+        driver.quit()
+      except Exception:
+        pass
+      driver = self._create()
+      if driver is None:
+        with self.lock:
+          self.live -= 1
+        return
+    self.drivers.put(driver)
 
-def get_signals(MARKET):
+  def close(self):
+    """ Quits the idle drivers. Call once every driver has been released. """
+    while True:
+      try:
+        driver = self.drivers.get_nowait()
+      except Empty:
+        break
+      try:
+        driver.quit()
+      except Exception:
+        pass
+      with self.lock:
+        self.live -= 1
+
+
+def read_panel(driver):
+  """ Returns the (signal_word, sell, neutral, buy) currently displayed, or
+    False while the panel is still rendering.
+  """
+  try:
+    values = tuple(driver.find_element_by_xpath(xpath).text for xpath in
+                   (SIGNAL_XPATH, SELL_COUNT_XPATH, NEUTRAL_COUNT_XPATH, BUY_COUNT_XPATH))
+  except WebDriverException:
+    return False
+  if not all(value.strip() for value in values):
+    return False
+  return values
+
+def panel_changed(previous):
+  def condition(driver):
+    panel = read_panel(driver)
+    return panel if panel and panel != previous else False
+  return condition
+
+
+def get_signals(MARKET, driver=None):
   """ Loads TradingView technicals website. Grabs signals, and returns a
     dict with the data.
     
     Args:
       MARKET (string): Ex. 'BCHUSD'
+      driver (WebDriver): Optional session to reuse. If omitted, a new Chrome
+        is launched and quit afterwards.
       
     Returns:
       signals (dict): {'1_min': {'sell_count': 12, 'buy_count': 3, ... },
                        '5_min': {'sell_count': 9, 'buy_count': 2, ... }, ... }
   """
+  if driver is None:
+    driver = create_driver()
+    try:
+      return get_signals(MARKET, driver)
+    finally:
+      driver.quit()
+
   signals = {}
   signals['market'] = MARKET
   signals['time'] = int(time.time())
 
-  # Define settings for Selenium to open a Chrome window.
-  chrome_options = Options()
-  chrome_options.add_argument("--headless")
-  chrome_options.add_argument("--window-size=1920x1080")
-  driver = webdriver.Chrome('./chromedriver', chrome_options=chrome_options)
   url = BASE_URL.format(MARKET)
-  driver.get(url)
-  time.sleep(2)
+  with instrumentation.span('fetch'):
+    driver.get(url)
+    WebDriverWait(driver, PAGE_TIMEOUT).until(
+        EC.presence_of_element_located((By.XPATH, BUTTON_XPATH.format(1))))
+    panel = WebDriverWait(driver, PAGE_TIMEOUT).until(read_panel)
 
-  button_xpaths = []
   for i in range(1,9):
-    xpath = '//*[@id="technicals-root"]/div/div/div[1]/div/div[{}]/div'.format(i)
-    button = driver.find_element_by_xpath(xpath)
+    button = driver.find_element_by_xpath(BUTTON_XPATH.format(i))
     button.click()
 
-    time.sleep(1)
-    signal_xpath = '//*[@id="technicals-root"]/div/div/div[2]/div[2]/span[2]'
-    BASE_XPATH = '//*[@id="technicals-root"]/div/div/div[2]/div[2]/div[2]/div[{}]/span[1]'
-    sell_count_xpath = '//*[@id="technicals-root"]/div/div/div[2]/div[2]/div[2]/div[1]/span[1]'
-    neutral_count_xpath = '//*[@id="technicals-root"]/div/div/div[2]/div[2]/div[2]/div[2]/span[1]'
-    buy_count_xpath = '//*[@id="technicals-root"]/div/div/div[2]/div[2]/div[2]/div[3]/span[1]'
-
-    signal_word = driver.find_element_by_xpath(signal_xpath).text
-    sell_count = driver.find_element_by_xpath(sell_count_xpath).text
-    neutral_count = driver.find_element_by_xpath(neutral_count_xpath).text
-    buy_count = driver.find_element_by_xpath(buy_count_xpath).text
+    # Wait for the panel to show different values. Neighbouring intervals can
+    # legitimately show identical values, so a timeout here just means the
+    # panel already shows the current interval.
+    previous = panel
+    with instrumentation.span('parse'):
+      try:
+        panel = WebDriverWait(driver, CHANGE_TIMEOUT, poll_frequency=0.05).until(
+            panel_changed(previous))
+      except TimeoutException:
+        instrumentation.count('unchanged_panels')
+        panel = WebDriverWait(driver, PAGE_TIMEOUT).until(read_panel)
+
+    signal_word, sell_count, neutral_count, buy_count = panel
     signals[TIME_INTERVALS[i-1]] = {
         "sell_count": int(sell_count),
         "neutral_count": int(neutral_count),
@@ -88,16 +239,77 @@ def get_signals(MARKET):
 
   return signals
 
+def get_signals_from_pool(pool, market):
+  with instrumentation.span('driver_wait'):
+    driver = pool.acquire()
+  broken = False
+  try:
+    with instrumentation.span('scrape'):
+      return get_signals(market, driver)
+  except WebDriverException:
+    broken = True
+    instrumentation.count('broken_drivers')
+    raise
+  finally:
+    pool.release(driver, broken)
+
+def scrape_markets(pool, markets=MARKETS):
+  """ Scrapes markets in parallel across the pool, yielding each signal dict
+    as soon as its market is done. Markets that fail are logged and skipped.
+  """
+  with ThreadPoolExecutor(max_workers=pool.size) as executor:
+    futures = dict((executor.submit(get_signals_from_pool, pool, market), market)
+                   for market in markets)
+    for future in as_completed(futures):
+      try:
+        yield future.result()
+      except Exception as e:
+        logging.error("Could not get signals for {}: {}".format(futures[future], e))
+
+_writer = None
+
+def get_writer():
+  global _writer
+  if _writer is None:
+    _writer = DynamoWriter(DYNAMO_TABLE_NAME)
+  return _writer
+
 def save_to_dynamo(signals):
-  dynamodb = boto3.resource('dynamodb')
-  table = dynamodb.Table(DYNAMO_TABLE_NAME)
-  table.put_item(Item = signals)
+  with instrumentation.span('publish'):
+    get_writer().put(signals)
+  instrumentation.count('markets_saved')
 
 def main():
-  for market in MARKETS:
-    signals = get_signals(market)
-    save_to_dynamo(signals)
+  with instrumentation.run('tradingview'):
+    pool = DriverPool()
+    try:
+      for signals in scrape_markets(pool):
+        save_to_dynamo(signals)
+    finally:
+      pool.close()
+      get_writer().close()
+
+def run_forever(interval=RUN_INTERVAL):
+  """ Keeps one pool alive and scrapes every `interval` seconds. """
+  pool = DriverPool()
+  publisher = state_publisher.StatePublisher(STATE_SEGMENT)
+  try:
+    while True:
+      started = time.time()
+      with instrumentation.run('tradingview'):
+        for signals in scrape_markets(pool):
+          with instrumentation.span('publish_local'):
+            publisher.publish(signals['market'], signals)
+          save_to_dynamo(signals)
+      time.sleep(max(0, interval - (time.time() - started)))
+  finally:
+    pool.close()
+    publisher.close()
+    get_writer().close()
 
 if __name__ == "__main__":
   # Execute only if run as a script
-  main()
+  if '--daemon' in sys.argv:
+    run_forever()
+  else:
+    main()
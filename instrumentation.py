@@ -0,0 +1,261 @@
+""" Per-stage timers, counters and optional profiling for the collectors.
+
+    Stages are timed with spans:
+
+        with instrumentation.span('fetch'):
+            data = get_candles(...)
+        instrumentation.count('rows_written', len(rows))
+
+    Each span name gets a latency histogram (fixed millisecond buckets plus
+    count/mean/min/max and bucket-estimated percentiles). A run -- one Lambda
+    invocation, one collector cycle -- ends with report(), which logs one JSON
+    "run_summary" line and starts the next run from zero.
+
+    Disabled by default. Set INSTRUMENT=1 in the environment, or call
+    enable(). While disabled, span() returns a shared no-op object and
+    count() returns immediately, so spans can stay in hot paths.
+
+    Profiling: with INSTRUMENT_PROFILE=/some/dir (or {"profile": true} in a
+    Lambda event, which writes to /tmp), each run is captured with cProfile,
+    the top functions are logged and the raw stats dumped as
+    {dir}/{run}-{time}.prof for snakeviz/pstats. cProfile only sees the thread
+    that started the run.
+"""
+
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from bisect import bisect_left
+
+
+BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+              1000, 2500, 5000, 10000, 30000, 60000]
+PROFILE_TOP = 25
+LAMBDA_PROFILE_DIR = '/tmp'
+
+enabled = os.environ.get('INSTRUMENT', '') not in ('', '0')
+profile_dir = os.environ.get('INSTRUMENT_PROFILE') or None
+
+_timers = {}
+_counters = {}
+last_summary = None  # what the last report() logged
+_lock = threading.Lock()
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, ms):
+        self.buckets[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def percentile(self, q):
+        """ Upper bound of the bucket holding the q-th percentile, capped at
+            the largest value seen.
+        """
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                bound = BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max
+                return round(min(bound, self.max), 3)
+        return round(self.max, 3) if self.count else None
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.total, 3),
+            'mean_ms': round(self.total / self.count, 3) if self.count else None,
+            'min_ms': round(self.min, 3) if self.count else None,
+            'max_ms': round(self.max, 3) if self.count else None,
+            'p50_ms': self.percentile(50),
+            'p90_ms': self.percentile(90),
+            'p99_ms': self.percentile(99),
+            'buckets': dict(('le_{0}'.format(bound), n) for bound, n in
+                            zip(BUCKETS_MS + ['inf'], self.buckets) if n),
+        }
+
+
+def record(name, seconds):
+    """ Adds one timing, in seconds, to the histogram for name. """
+    if not enabled:
+        return
+    with _lock:
+        histogram = _timers.get(name)
+        if histogram is None:
+            histogram = _timers[name] = Histogram()
+        histogram.record(seconds * 1000.0)
+
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+class _Span(object):
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.name, time.perf_counter() - self.started)
+        if exc_type is not None:
+            count(self.name + '.errors')
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+def span(name):
+    return _Span(name) if enabled else NULL_SPAN
+
+
+def timed(name=None):
+    """ Decorator form of span(), named after the function by default. """
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Span(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable(profile=None):
+    global enabled, profile_dir
+    enabled = True
+    if profile is not None:
+        profile_dir = profile
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def summary():
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'timers': dict((name, histogram.summary()) for name, histogram in _timers.items()),
+        }
+
+
+def report(run_name, **extra):
+    """ Logs the summary for the run that just finished and resets. """
+    global last_summary
+    if not enabled:
+        return None
+    result = summary()
+    result['run'] = run_name
+    result.update(extra)
+    reset()
+    last_summary = result
+    logging.info("run_summary {0}".format(json.dumps(result, sort_keys=True)))
+    return result
+
+
+class run(object):
+    """ Context manager around one run: reports on exit and, if a profile
+        directory is set, profiles the run.
+    """
+
+    def __init__(self, name, profile=None):
+        self.name = name
+        self.profile = profile or profile_dir
+        self.profiler = None
+        self.started = None
+
+    def __enter__(self):
+        if not enabled:
+            return self
+        reset()
+        self.started = time.time()
+        if self.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.started is None:
+            return False
+        if self.profiler is not None:
+            self.profiler.disable()
+            self._dump_profile()
+        report(self.name, seconds=round(time.time() - self.started, 3),
+               error=None if exc_type is None else exc_type.__name__)
+        return False
+
+    def _dump_profile(self):
+        if not os.path.isdir(self.profile):
+            os.makedirs(self.profile)
+        path = os.path.join(self.profile, '{0}-{1}.prof'.format(self.name, int(time.time())))
+        self.profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        logging.info("Profile for {0} saved to {1}\n{2}".format(self.name, path, out.getvalue()))
+
+
+def invocation(func):
+    """ Wraps a Lambda handler in run(). {"instrument": true} in the event
+        turns instrumentation on for that invocation, and {"profile": true}
+        also profiles it.
+    """
+    @functools.wraps(func)
+    def wrapper(event, context):
+        global enabled
+        requested = isinstance(event, dict) and (event.get('instrument') or event.get('profile'))
+        was_enabled = enabled
+        if requested:
+            enabled = True
+        profile = LAMBDA_PROFILE_DIR if isinstance(event, dict) and event.get('profile') else None
+        try:
+            with run(func.__module__, profile):
+                return func(event, context)
+        finally:
+            enabled = was_enabled
+    return wrapper
@@ -0,0 +1,109 @@
+""" Module-level cache of connections and clients for the Lambda handlers.
+
+    Lambda keeps the Python process alive between warm invocations, so
+    anything stored at module level survives. get_resource() hands back the
+    cached object after an optional liveness check, and rebuilds it
+    transparently if the check fails.
+
+    @handler wraps a lambda_handler to record whether the invocation was a
+    cold start, how long the runtime spent importing before the first call,
+    and how much of each invocation went into creating/checking resources.
+    Numbers are logged as one JSON line per invocation and available from
+    stats().
+
+    Usage:
+        import resource_cache
+
+        @resource_cache.handler
+        def lambda_handler(event, context):
+            connection = resource_cache.get_resource(
+                'mysql', open_mysql_connection, resource_cache.ping_mysql)
+"""
+
+import functools
+import json
+import logging
+import time
+
+PROCESS_STARTED = time.time()
+
+_resources = {}
+_stats = {
+    'cold_start_init_seconds': None,
+    'invocations': 0,
+    'resources_created': 0,
+    'reconnects': 0,
+    'last_invocation': None,
+}
+_current = None
+
+
+def ping_mysql(connection):
+    connection.ping(reconnect=True)
+    return True
+
+
+def _record_setup(seconds):
+    if _current is not None:
+        _current['setup_seconds'] += seconds
+
+
+def get_resource(name, factory, check=None):
+    """ Returns the cached resource `name`, creating it with factory() on first
+        use. If check(resource) raises or returns False, the resource is
+        discarded and created again.
+    """
+    started = time.time()
+    try:
+        resource = _resources.get(name)
+        if resource is not None and check is not None:
+            try:
+                alive = check(resource)
+            except Exception as e:
+                logging.warning("Cached resource {0} failed its check: {1}".format(name, e))
+                alive = False
+            if not alive:
+                _stats['reconnects'] += 1
+                drop(name)
+                resource = None
+        if resource is None:
+            resource = factory()
+            _resources[name] = resource
+            _stats['resources_created'] += 1
+        return resource
+    finally:
+        _record_setup(time.time() - started)
+
+
+def drop(name):
+    """ Forgets a cached resource, closing it if it has a close() method. """
+    resource = _resources.pop(name, None)
+    if resource is not None and hasattr(resource, 'close'):
+        try:
+            resource.close()
+        except Exception:
+            pass
+
+
+def stats():
+    return dict(_stats)
+
+
+def handler(func):
+    @functools.wraps(func)
+    def wrapper(event, context):
+        global _current
+        started = time.time()
+        cold_start = _stats['invocations'] == 0
+        if cold_start:
+            _stats['cold_start_init_seconds'] = started - PROCESS_STARTED
+        _stats['invocations'] += 1
+        _current = {'handler': func.__module__, 'cold_start': cold_start, 'setup_seconds': 0.0}
+        try:
+            return func(event, context)
+        finally:
+            _current['total_seconds'] = time.time() - started
+            _stats['last_invocation'] = _current
+            _current = None
+            logging.info("invocation_stats {0}".format(json.dumps(_stats)))
+    return wrapper
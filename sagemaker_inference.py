@@ -0,0 +1,351 @@
+""" Real-time inference client for models deployed with
+    create_endpoint_with_sagemaker_model.py.
+
+    Feature vectors are assembled per product from what the collectors
+    already produce:
+
+        candles     CANDLE_WINDOW log returns of the close and volumes relative
+                    to the window mean, from the local candle store
+        order book  bid/ask imbalance of counts and volumes per band, from the
+                    'gdax_orderbook' shared memory segment
+        signals     (buy - sell) / total votes per interval, from the
+                    'local_signals' shared memory segment
+
+    Candle windows are cached per product, so each call only reads and
+    transforms bars newer than the last one seen.
+
+    Requests from all products are micro-batched into one invoke_endpoint
+    call as text/csv rows: a batch goes out when MAX_BATCH rows are queued or
+    MAX_LATENCY seconds after its first row, whichever is first. Latency is
+    tracked per stage (features, queue, invoke, parse, total).
+
+    Point it at a local stand-in with endpoint_url, or by setting
+    SAGEMAKER_RUNTIME_URL in the environment; the stand-in only has to answer
+    POST /endpoints/{name}/invocations. boto3 still signs requests, so dummy
+    AWS credentials are enough.
+
+    Usage:
+        $ python sagemaker_inference.py MODEL_ID
+
+    Requires:
+        pip install numpy boto3
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import boto3
+import numpy as np
+
+from candle_store import CandleStore
+from get_local_technicals import MARKETS, STORE_ROOT, TIME_INTERVALS
+from state_publisher import StateReader
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+
+CANDLE_WINDOW = 30  # minutes of returns per feature vector
+BANDS = [1, 5, 10]  # same bands as get_gdax_live_orderbook.BANDS
+ORDERBOOK_SEGMENT = 'gdax_orderbook'
+SIGNAL_SEGMENT = 'local_signals'
+MAX_BATCH = 64
+MAX_LATENCY = 0.005  # seconds the first row of a batch may wait
+LATENCY_SAMPLES = 1000
+RUN_INTERVAL = 60
+FEATURE_COUNT = 2 * CANDLE_WINDOW + 2 * len(BANDS) + len(TIME_INTERVALS)
+
+
+class LatencyStats(object):
+    """ Recent latency samples per stage. Thread-safe. """
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.samples = samples
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            if stage not in self._stages:
+                self._stages[stage] = deque(maxlen=self.samples)
+            self._stages[stage].append(seconds)
+
+    def summary(self):
+        """ {stage: {count, mean_ms, p50_ms, p99_ms, max_ms}} """
+        with self._lock:
+            stages = dict((stage, np.array(values)) for stage, values in self._stages.items())
+        summary = {}
+        for stage, values in stages.items():
+            if not len(values):
+                continue
+            values = values * 1000
+            summary[stage] = {
+                'count': len(values),
+                'mean_ms': round(float(values.mean()), 3),
+                'p50_ms': round(float(np.percentile(values, 50)), 3),
+                'p99_ms': round(float(np.percentile(values, 99)), 3),
+                'max_ms': round(float(values.max()), 3),
+            }
+        return summary
+
+
+class CandleWindow(object):
+    """ Cached candle features for one product. """
+
+    def __init__(self, window=CANDLE_WINDOW):
+        self.window = window
+        self.closes = np.empty(0)
+        self.volumes = np.empty(0)
+        self.returns = np.empty(0)
+        self.last_time = None
+        self.revision = None
+
+    def update(self, market):
+        """ Folds in bars newer than the last one seen from a MarketCandles. """
+        if self.revision != market.revision:
+            # Stored candles were corrected or reloaded; start over.
+            self.__init__(self.window)
+            self.revision = market.revision
+        last = market.last_time()
+        if last is None:
+            return self
+        if self.last_time is None:
+            bars = market.range(last - self.window * 60)
+        elif last > self.last_time:
+            bars = market.range(self.last_time + 1)
+        else:
+            return self
+        closes = np.asarray(bars['close'], dtype=np.float64)
+        volumes = np.asarray(bars['volume'], dtype=np.float64)
+        if len(self.closes):
+            new_returns = np.diff(np.log(np.concatenate((self.closes[-1:], closes))))
+        else:
+            new_returns = np.diff(np.log(closes))
+        self.returns = np.concatenate((self.returns, new_returns))[-self.window:]
+        self.closes = np.concatenate((self.closes, closes))[-1:]
+        self.volumes = np.concatenate((self.volumes, volumes))[-self.window:]
+        self.last_time = last
+        return self
+
+    def features(self):
+        vector = np.zeros(2 * self.window)
+        vector[self.window - len(self.returns):self.window] = self.returns
+        mean = self.volumes.mean() if len(self.volumes) else 0
+        if mean > 0:
+            vector[2 * self.window - len(self.volumes):] = self.volumes / mean
+        return vector
+
+
+def imbalance(a, b):
+    total = a + b
+    return (a - b) / total if total else 0.0
+
+
+def orderbook_features(volumes):
+    vector = np.zeros(2 * len(BANDS))
+    if volumes is None:
+        return vector
+    for i, band in enumerate(BANDS):
+        vector[i] = imbalance(volumes.get('bids_within_{0}percent'.format(band), 0),
+                              volumes.get('asks_within_{0}percent'.format(band), 0))
+        vector[len(BANDS) + i] = imbalance(
+            volumes.get('bids_volume_within_{0}percent'.format(band), 0),
+            volumes.get('asks_volume_within_{0}percent'.format(band), 0))
+    return vector
+
+
+def signal_features(signals):
+    vector = np.zeros(len(TIME_INTERVALS))
+    if signals is None:
+        return vector
+    for i, interval in enumerate(TIME_INTERVALS):
+        counts = signals.get(interval)
+        if counts:
+            total = counts['buy_count'] + counts['sell_count'] + counts['neutral_count']
+            if total:
+                vector[i] = float(counts['buy_count'] - counts['sell_count']) / total
+    return vector
+
+
+def _attach(name):
+    try:
+        return StateReader(name)
+    except FileNotFoundError:
+        logging.warning("Shared memory segment {0} not found; its features will be zero.".format(name))
+        return None
+
+
+class FeatureBuilder(object):
+
+    def __init__(self, store, orderbook_segment=ORDERBOOK_SEGMENT, signal_segment=SIGNAL_SEGMENT):
+        self.store = store
+        self.orderbook = _attach(orderbook_segment) if orderbook_segment else None
+        self.signals = _attach(signal_segment) if signal_segment else None
+        self.windows = {}
+
+    def _latest(self, reader, key):
+        if reader is None:
+            return None
+        latest = reader.latest(key)
+        return latest[1] if latest else None
+
+    def features(self, product_id):
+        window = self.windows.get(product_id)
+        if window is None:
+            window = self.windows[product_id] = CandleWindow()
+        window.update(self.store.market(product_id))
+        return np.concatenate((
+            window.features(),
+            orderbook_features(self._latest(self.orderbook, product_id)),
+            signal_features(self._latest(self.signals, product_id.replace('-', '')))))
+
+
+def parse_predictions(body, content_type=''):
+    """ Handles CSV / newline-separated scores and the JSON shapes returned by
+        SageMaker's built-in algorithms.
+    """
+    text = body.decode('utf-8').strip()
+    if 'json' in content_type or text[:1] in ('[', '{'):
+        data = json.loads(text)
+        if isinstance(data, dict):
+            data = data.get('predictions', data.get('scores'))
+        return [p.get('score', p) if isinstance(p, dict) else p for p in data]
+    return [float(value) for value in text.replace('\n', ',').split(',') if value.strip()]
+
+
+class InferenceClient(object):
+    """ Micro-batches submit() calls into invoke_endpoint requests on a
+        background thread.
+    """
+
+    def __init__(self, endpoint_name, endpoint_url=None, client=None,
+                 max_batch=MAX_BATCH, max_latency=MAX_LATENCY, stats=None):
+        self.endpoint_name = endpoint_name
+        self.client = client or boto3.client(
+            'sagemaker-runtime',
+            endpoint_url=endpoint_url or os.environ.get('SAGEMAKER_RUNTIME_URL'))
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.stats = stats or LatencyStats()
+        self.batches = 0
+        self.queue = Queue()
+        self._thread = threading.Thread(target=self._run, name='inference-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, features):
+        """ Queues one feature vector. Returns a Future for its prediction. """
+        future = Future()
+        self.queue.put((time.time(), np.asarray(features, dtype=np.float64), future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            try:
+                request = self.queue.get(timeout=timeout)
+            except Empty:
+                request = False
+            if request:
+                batch.append(request)
+                if deadline is None:
+                    deadline = time.time() + self.max_latency
+                if len(batch) < self.max_batch:
+                    continue
+            if batch:
+                self._invoke(batch)
+                batch = []
+                deadline = None
+            if request is None:
+                return
+
+    def _invoke(self, batch):
+        started = time.time()
+        for submitted, _, _ in batch:
+            self.stats.record('queue', started - submitted)
+        try:
+            body = '\n'.join(','.join(repr(float(v)) for v in features)
+                             for _, features, _ in batch)
+            response = self.client.invoke_endpoint(
+                EndpointName=self.endpoint_name, ContentType='text/csv', Body=body)
+            payload = response['Body'].read()
+            invoked = time.time()
+            self.stats.record('invoke', invoked - started)
+            predictions = parse_predictions(payload, response.get('ContentType', ''))
+            if len(predictions) != len(batch):
+                raise ValueError("Endpoint returned {0} predictions for {1} rows.".format(
+                    len(predictions), len(batch)))
+            self.stats.record('parse', time.time() - invoked)
+        except Exception as e:
+            logging.error("Inference on {0} failed: {1}".format(self.endpoint_name, e))
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        finished = time.time()
+        for (submitted, _, future), prediction in zip(batch, predictions):
+            self.stats.record('total', finished - submitted)
+            future.set_result(prediction)
+
+
+def predict(client, builder, product_ids):
+    """ Builds features for every product and returns {product_id: prediction}.
+        Products whose prediction failed are left out.
+    """
+    futures = {}
+    for product_id in product_ids:
+        started = time.time()
+        features = builder.features(product_id)
+        client.stats.record('features', time.time() - started)
+        futures[product_id] = client.submit(features)
+    predictions = {}
+    for product_id, future in futures.items():
+        try:
+            predictions[product_id] = future.result()
+        except Exception:
+            pass
+    return predictions
+
+
+def run(endpoint_name, markets=MARKETS, interval=RUN_INTERVAL, once=False):
+    import get_gdax_candlesticks as candlesticks
+    connection = candlesticks.open_mysql_connection()
+    cursor = connection.cursor()
+    store = CandleStore(STORE_ROOT)
+    builder = FeatureBuilder(store)
+    client = InferenceClient(endpoint_name)
+    try:
+        while True:
+            started = time.time()
+            connection.ping(reconnect=True)
+            connection.commit()  # end the read snapshot so new rows are visible
+            store.sync_from_mysql(cursor, markets, candlesticks.load_watermarks(cursor, max_age=0))
+            predictions = predict(client, builder, markets)
+            logging.info("Predictions: {0}".format(json.dumps(predictions)))
+            logging.info("Latency: {0}".format(json.dumps(client.stats.summary())))
+            if once:
+                break
+            time.sleep(max(0, interval - (time.time() - started)))
+    finally:
+        client.close()
+        cursor.close()
+        connection.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run(sys.argv[1])
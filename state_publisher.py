@@ -0,0 +1,232 @@
+""" Latest-state publishing over shared memory, for same-host consumers.
+
+    Strategy processes on the collector's VM shouldn't have to go through
+    MySQL or DynamoDB for the newest order book metrics, candles or signals.
+    Each collector owns one named shared memory segment and publishes every
+    update into it; readers attach to the segment and read the latest value
+    for a key without locks or syscalls.
+
+    Layout, little-endian:
+
+        header      magic, max_keys, depth, slot_size, key_count
+        directory   max_keys x KEY_SIZE bytes of utf-8 key names
+        key blocks  max_keys x (head uint64, depth x slot)
+        slot        seq uint64, time float64, length uint32, pad, payload
+
+    Each key has a ring of `depth` slots and a head counting publishes. A
+    slot is written seqlock style: the writer makes seq odd, writes the
+    payload, makes seq even again, then advances head. Readers copy a slot
+    and retry if its seq was odd or changed while copying, so they never
+    block the writer and never see a torn value. There must be exactly one
+    writer per segment.
+
+    Payloads are JSON; a slot holds up to slot_size bytes of it.
+
+    Usage:
+        publisher = StatePublisher('gdax_orderbook')
+        publisher.publish('BTC-USD', volumes)
+
+        reader = StateReader('gdax_orderbook')
+        timestamp, volumes = reader.latest('BTC-USD')
+
+    Requires Python 3.8+ (multiprocessing.shared_memory).
+"""
+
+import json
+import logging
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+
+MAGIC = b'STATE001'
+HEADER = struct.Struct('<8sIIII8x')  # magic, max_keys, depth, slot_size, key_count
+KEY_COUNT_OFFSET = 20
+KEY_SIZE = 64
+HEAD = struct.Struct('<Q')
+SLOT = struct.Struct('<QdI4x')  # seq, time, length
+MAX_KEYS = 512
+DEPTH = 4
+SLOT_SIZE = 4096
+MAX_SPINS = 100
+
+_published = set()  # segments created by publishers in this process
+
+
+class Layout(object):
+
+    def __init__(self, max_keys, depth, slot_size):
+        self.max_keys = max_keys
+        self.depth = depth
+        self.slot_size = slot_size
+        self.slot_stride = SLOT.size + slot_size
+        self.block_stride = HEAD.size + depth * self.slot_stride
+        self.directory = HEADER.size
+        self.blocks = self.directory + max_keys * KEY_SIZE
+        self.size = self.blocks + max_keys * self.block_stride
+
+    def block(self, index):
+        return self.blocks + index * self.block_stride
+
+    def slot(self, block, n):
+        return block + HEAD.size + (n % self.depth) * self.slot_stride
+
+
+def _attach(name):
+    """ Attaches without registering with the resource tracker, which would
+        otherwise unlink the writer's segment when a reader exits. A segment
+        published from this same process stays registered for its writer.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        memory = shared_memory.SharedMemory(name=name)
+        if name not in _published:
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+class StatePublisher(object):
+    """ Single writer for a segment. Creates it, replacing any segment of the
+        same name left behind by a previous run.
+    """
+
+    def __init__(self, name, max_keys=MAX_KEYS, depth=DEPTH, slot_size=SLOT_SIZE):
+        self.name = name
+        self.layout = Layout(max_keys, depth, slot_size)
+        try:
+            self.memory = shared_memory.SharedMemory(name=name, create=True, size=self.layout.size)
+        except FileExistsError:
+            logging.warning("Replacing stale shared memory segment {0}.".format(name))
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.memory = shared_memory.SharedMemory(name=name, create=True, size=self.layout.size)
+        _published.add(name)
+        self.buf = self.memory.buf
+        HEADER.pack_into(self.buf, 0, MAGIC, max_keys, depth, slot_size, 0)
+        self._index = {}
+
+    def _block(self, key):
+        index = self._index.get(key)
+        if index is not None:
+            return self.layout.block(index)
+        index = len(self._index)
+        if index >= self.layout.max_keys:
+            raise ValueError("Segment {0} is full ({1} keys).".format(self.name, index))
+        encoded = key.encode('utf-8')
+        if len(encoded) > KEY_SIZE:
+            raise ValueError("Key too long: {0}".format(key))
+        entry = self.layout.directory + index * KEY_SIZE
+        self.buf[entry:entry + len(encoded)] = encoded
+        # Publish the directory entry only once it is complete.
+        struct.pack_into('<I', self.buf, KEY_COUNT_OFFSET, index + 1)
+        self._index[key] = index
+        return self.layout.block(index)
+
+    def publish(self, key, value, timestamp=None):
+        payload = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if len(payload) > self.layout.slot_size:
+            raise ValueError("State for {0} is {1} bytes, over the {2} byte slot.".format(
+                key, len(payload), self.layout.slot_size))
+        block = self._block(key)
+        head = HEAD.unpack_from(self.buf, block)[0]
+        slot = self.layout.slot(block, head)
+        seq = HEAD.unpack_from(self.buf, slot)[0]
+        SLOT.pack_into(self.buf, slot, seq + 1, timestamp or time.time(), len(payload))
+        start = slot + SLOT.size
+        self.buf[start:start + len(payload)] = payload
+        HEAD.pack_into(self.buf, slot, seq + 2)
+        HEAD.pack_into(self.buf, block, head + 1)
+
+    def publish_many(self, values, timestamp=None):
+        timestamp = timestamp or time.time()
+        for key, value in values.items():
+            self.publish(key, value, timestamp)
+
+    def close(self, unlink=True):
+        self.buf = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+        _published.discard(self.name)
+
+
+class StateReader(object):
+    """ Lock-free reader. Any number of processes may attach. """
+
+    def __init__(self, name):
+        self.name = name
+        self.memory = _attach(name)
+        self.buf = self.memory.buf
+        magic, max_keys, depth, slot_size, _ = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a state segment".format(name))
+        self.layout = Layout(max_keys, depth, slot_size)
+        self._index = {}
+
+    def keys(self):
+        count = struct.unpack_from('<I', self.buf, KEY_COUNT_OFFSET)[0]
+        for index in range(len(self._index), count):
+            entry = self.layout.directory + index * KEY_SIZE
+            key = bytes(self.buf[entry:entry + KEY_SIZE]).rstrip(b'\0').decode('utf-8')
+            self._index[key] = index
+        return list(self._index)
+
+    def _block(self, key):
+        index = self._index.get(key)
+        if index is None:
+            self.keys()
+            index = self._index.get(key)
+            if index is None:
+                return None
+        return self.layout.block(index)
+
+    def _read(self, block, back):
+        for _ in range(MAX_SPINS):
+            head = HEAD.unpack_from(self.buf, block)[0]
+            if head <= back:
+                return None
+            slot = self.layout.slot(block, head - 1 - back)
+            seq, timestamp, length = SLOT.unpack_from(self.buf, slot)
+            if seq & 1:
+                continue
+            start = slot + SLOT.size
+            payload = bytes(self.buf[start:start + min(length, self.layout.slot_size)])
+            if HEAD.unpack_from(self.buf, slot)[0] == seq:
+                return timestamp, json.loads(payload.decode('utf-8'))
+        logging.warning("Gave up reading {0} after {1} attempts.".format(self.name, MAX_SPINS))
+        return None
+
+    def latest(self, key):
+        """ (time, value) most recently published for key, or None. """
+        block = self._block(key)
+        if block is None:
+            return None
+        return self._read(block, 0)
+
+    def history(self, key, count=None):
+        """ Up to `count` (at most depth) recent (time, value) pairs, newest first. """
+        block = self._block(key)
+        if block is None:
+            return []
+        values = []
+        for back in range(min(count or self.layout.depth, self.layout.depth)):
+            value = self._read(block, back)
+            if value is None:
+                break
+            values.append(value)
+        return values
+
+    def snapshot(self):
+        """ {key: (time, value)} for every key in the segment. """
+        state = {}
+        for key in self.keys():
+            value = self.latest(key)
+            if value is not None:
+                state[key] = value
+        return state
+
+    def close(self):
+        self.buf = None
+        self.memory.close()
@@ -0,0 +1,87 @@
+""" Backfill and resume against the fake exchange and the SQLite stand-in. """
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from benchmarks import fixtures, servers, sqlstore
+from benchmarks.run import install_config
+
+install_config('http://127.0.0.1:9')
+import get_gdax_candlesticks as candlesticks  # noqa: E402
+
+MARKETS = ['BTC-USD', 'ETH-USD']
+PAGE = candlesticks.MAX_CANDLES_PER_REQUEST * 60
+
+
+class BackfillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.staging = os.path.join(self.directory, 'staging')
+        fixtures.generate(self.directory, products=len(MARKETS), levels=10, updates=10,
+                          minutes=3 * 24 * 60)
+        self.fixtures = fixtures.Fixtures(self.directory)
+        self.connection = sqlstore.connect()
+        candlesticks._watermarks.clear()
+        candlesticks._coverage.clear()
+        now = int(time.time())
+        self.end = now - now % 60 - 24 * 3600
+        self.start = self.end - 24 * 3600
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+    def backfill(self, exchange):
+        return candlesticks.backfill(MARKETS, self.start, self.end, staging_dir=self.staging,
+                                     workers=2, api_url=exchange.url, connection=self.connection,
+                                     loader='insert', segment_pages=2)
+
+    def count(self, market):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM `gdax_{}_candlesticks` WHERE time >= %s AND time < %s".format(
+            market.lower()), (self.start, self.end))
+        return cursor.fetchone()[0]
+
+    def test_backfill_loads_every_candle(self):
+        with servers.FakeExchange(self.fixtures) as exchange:
+            self.assertEqual(self.backfill(exchange), dict((m, True) for m in MARKETS))
+        pages = len(MARKETS) * -(-(self.end - self.start) // PAGE)
+        self.assertEqual(exchange.requests, pages)
+        for market in MARKETS:
+            self.assertEqual(self.count(market), (self.end - self.start) // 60)
+            table = 'gdax_{}_candlesticks'.format(market.lower())
+            self.assertEqual(candlesticks._watermarks[table]['row_count'], (self.end - self.start) // 60)
+        self.assertEqual([name for name in os.listdir(self.staging)], [])
+
+    def test_killed_run_resumes_from_checkpoints(self):
+        with servers.FakeExchange(self.fixtures, fail_after=5) as exchange:
+            results = self.backfill(exchange)
+        self.assertFalse(any(results.values()))
+        checkpoints = [name for name in os.listdir(self.staging) if name.endswith('.checkpoint.json')]
+        self.assertEqual(len(checkpoints), len(MARKETS))
+        loaded = sum(self.count(market) for market in MARKETS)
+        self.assertGreater(loaded, 0)
+
+        with servers.FakeExchange(self.fixtures) as exchange:
+            self.assertEqual(self.backfill(exchange), dict((m, True) for m in MARKETS))
+        pages = len(MARKETS) * -(-(self.end - self.start) // PAGE)
+        # Staged segments are whole pages; only the rest is fetched again.
+        self.assertEqual(exchange.requests, pages - loaded // candlesticks.MAX_CANDLES_PER_REQUEST)
+        for market in MARKETS:
+            self.assertEqual(self.count(market), (self.end - self.start) // 60)
+        self.assertEqual(os.listdir(self.staging), [])
+
+    def test_rerun_skips_covered_ranges(self):
+        with servers.FakeExchange(self.fixtures) as exchange:
+            self.backfill(exchange)
+        with servers.FakeExchange(self.fixtures) as exchange:
+            self.assertEqual(self.backfill(exchange), {})
+        self.assertEqual(exchange.requests, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+""" Coverage for tables that predate the coverage table survives a reload. """
+
+import time
+import unittest
+
+from benchmarks import sqlstore
+from benchmarks.run import install_config
+
+install_config('http://127.0.0.1:9')
+import get_gdax_candlesticks as candlesticks  # noqa: E402
+
+MARKET = 'BTC-USD'
+TABLE = 'gdax_btc-usd_candlesticks'
+
+
+class LegacyCoverageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlstore.connect()
+        self.cursor = self.connection.cursor()
+        candlesticks._watermarks.clear()
+        candlesticks._coverage.clear()
+        candlesticks.check_mysql_tables(self.connection, self.cursor, [MARKET])
+        candlesticks.check_watermark_table(self.connection, self.cursor)
+        candlesticks.check_coverage_table(self.connection, self.cursor)
+        now = int(time.time())
+        self.now = now - now % 60
+        self.oldest = self.now - 30 * 24 * 3600
+        self.newest = self.now - 3600
+        self.cursor.executemany(
+            "INSERT INTO `{}` (time, low, high, open, close, volume) VALUES (%s, %s, %s, %s, %s, %s)".format(TABLE),
+            [(t, 1, 1, 1, 1, 1) for t in range(self.oldest, self.newest + 60, 60)])
+        self.connection.commit()
+
+    def tearDown(self):
+        self.connection.close()
+
+    def reload(self):
+        """ A cold start: both caches are re-read from the database. """
+        candlesticks._watermarks.clear()
+        candlesticks._coverage.clear()
+        candlesticks.load_watermarks(self.cursor, max_age=0)
+        candlesticks.load_coverage(self.cursor, max_age=0)
+        watermark = candlesticks.get_watermark(self.connection, self.cursor, TABLE)
+        return candlesticks.get_coverage(self.connection, self.cursor, TABLE, watermark)
+
+    def assert_stored_range_not_planned(self, index):
+        chunks = candlesticks.plan_requests(TABLE, MARKET, index, self.now, backfill=0)
+        self.assertEqual([(start, end) for _, _, start, end in chunks], [(self.newest + 60, self.now)])
+
+    def test_measured_range_is_saved(self):
+        index = candlesticks.get_coverage(
+            self.connection, self.cursor, TABLE,
+            candlesticks.get_watermark(self.connection, self.cursor, TABLE))
+        self.assertEqual(list(index), [(self.oldest, self.newest + 60)])
+        self.cursor.execute("SELECT start_time, end_time FROM `{}` WHERE market_table = %s".format(
+            candlesticks.COVERAGE_TABLE), (TABLE,))
+        self.assertEqual(self.cursor.fetchall(), [(self.oldest, self.newest + 60)])
+        self.assert_stored_range_not_planned(self.reload())
+
+    def test_watermark_without_coverage_rows(self):
+        # Watermark measured before coverage seeding was saved to the database.
+        candlesticks.get_watermark(self.connection, self.cursor, TABLE)
+        self.cursor.execute("DELETE FROM `{}`".format(candlesticks.COVERAGE_TABLE))
+        self.connection.commit()
+        self.assert_stored_range_not_planned(self.reload())
+        self.assert_stored_range_not_planned(self.reload())
+
+    def test_empty_table_is_not_covered(self):
+        self.cursor.execute("DELETE FROM `{}`".format(TABLE))
+        self.connection.commit()
+        index = self.reload()
+        self.assertEqual(len(index), 0)
+        self.cursor.execute("SELECT COUNT(*) FROM `{}`".format(candlesticks.COVERAGE_TABLE))
+        self.assertEqual(self.cursor.fetchone()[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+""" DynamoWriter batching and retries against a fake batch_write_item client. """
+
+import threading
+import time
+import unittest
+from decimal import Decimal
+from unittest import mock
+
+import dynamo_writer
+
+TABLE = 'tradingview-signals'
+
+
+class FakeClient(object):
+    """ Records every batch_write_item call. `unprocessed` lists how many
+        items to hand back per call; `errors` how many calls to fail first.
+    """
+
+    def __init__(self, unprocessed=(), errors=0):
+        self.unprocessed = list(unprocessed)
+        self.errors = errors
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def batch_write_item(self, RequestItems):
+        with self.lock:
+            requests = RequestItems[TABLE]
+            self.batches.append(requests)
+            if self.errors:
+                self.errors -= 1
+                raise RuntimeError('ProvisionedThroughputExceededException')
+            count = self.unprocessed.pop(0) if self.unprocessed else 0
+            if not count:
+                return {'UnprocessedItems': {}}
+            return {'UnprocessedItems': {TABLE: requests[-count:]}}
+
+
+def item(n):
+    return {'market': 'BTC-USD', 'time': n, 'score': n / 2.0}
+
+
+def written(batches):
+    return [request['PutRequest']['Item']['time'] for batch in batches for request in batch]
+
+
+class DynamoWriterTest(unittest.TestCase):
+
+    def writer(self, client, flush_interval=60):
+        return dynamo_writer.DynamoWriter(TABLE, client=client, flush_interval=flush_interval)
+
+    def test_to_dynamo_converts_floats(self):
+        self.assertEqual(dynamo_writer.to_dynamo({'a': 0.1, 'b': [1.5, 2], 'c': 'x'}),
+                         {'a': Decimal('0.1'), 'b': [Decimal('1.5'), 2], 'c': 'x'})
+
+    def test_full_batches_of_25(self):
+        client = FakeClient()
+        writer = self.writer(client)
+        for n in range(60):
+            writer.put(item(n))
+        writer.close()
+        self.assertEqual([len(batch) for batch in client.batches], [25, 25, 10])
+        self.assertEqual(writer.written, 60)
+        self.assertEqual((writer.retries, writer.failed), (0, 0))
+
+    def test_partial_batch_written_after_flush_interval(self):
+        client = FakeClient()
+        writer = self.writer(client, flush_interval=0.05)
+        for n in range(3):
+            writer.put(item(n))
+        deadline = time.time() + 1
+        while not client.batches and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([len(batch) for batch in client.batches], [3])
+        writer.close()
+        self.assertEqual(writer.written, 3)
+
+    def test_unprocessed_items_are_retried(self):
+        client = FakeClient(unprocessed=[10, 4])
+        writer = self.writer(client)
+        for n in range(25):
+            writer.put(item(n))
+        writer.close()
+        self.assertEqual([len(batch) for batch in client.batches], [25, 10, 4])
+        self.assertEqual(client.batches[1], client.batches[0][-10:])
+        self.assertEqual(client.batches[2], client.batches[0][-4:])
+        self.assertEqual(writer.written, 25)
+        self.assertEqual((writer.retries, writer.failed), (2, 0))
+
+    def test_failed_call_retries_whole_batch(self):
+        client = FakeClient(errors=1)
+        writer = self.writer(client)
+        for n in range(5):
+            writer.put(item(n))
+        writer.close()
+        self.assertEqual(len(client.batches), 2)
+        self.assertEqual(client.batches[0], client.batches[1])
+        self.assertEqual(writer.written, 5)
+        self.assertEqual(writer.retries, 1)
+
+    def test_gives_up_after_max_retries(self):
+        client = FakeClient(unprocessed=[2] * 10)
+        with mock.patch.object(dynamo_writer, 'MAX_RETRIES', 3):
+            writer = self.writer(client)
+            for n in range(5):
+                writer.put(item(n))
+            writer.close()
+        self.assertEqual([len(batch) for batch in client.batches], [5, 2, 2])
+        self.assertEqual(writer.written, 3)
+        self.assertEqual(writer.failed, 2)
+
+    def test_flush_waits_for_queued_items(self):
+        client = FakeClient()
+        writer = self.writer(client)
+        for n in range(30):
+            writer.put(item(n))
+        writer.flush()
+        self.assertEqual(writer.written, 30)
+        self.assertEqual(sorted(int(t['N']) for t in written(client.batches)), list(range(30)))
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
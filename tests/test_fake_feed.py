@@ -0,0 +1,42 @@
+""" Smoke tests for the benchmark stand-ins: the websocket feed and fixtures. """
+
+import json
+import unittest
+
+from websocket import create_connection
+
+from benchmarks import fixtures, servers
+
+
+class FakeFeedTest(unittest.TestCase):
+
+    def test_handshake_and_first_message(self):
+        lines = [json.dumps({'type': 'heartbeat', 'product_id': 'BTC-USD', 'sequence': n})
+                 for n in range(3)]
+        with servers.FakeFeed(lines) as feed:
+            ws = create_connection(feed.url, timeout=5)
+            try:
+                ws.send(json.dumps({'type': 'subscribe'}))
+                self.assertEqual(json.loads(ws.recv()), json.loads(lines[0]))
+            finally:
+                ws.close()
+        self.assertEqual(feed.clients, 1)
+
+
+class SyntheticLevel2Test(unittest.TestCase):
+
+    def test_messages_look_like_the_level2_channel(self):
+        messages = list(fixtures.synthetic_level2(['BTC-USD', 'ETH-USD'], levels=5, updates=2001))
+        types = [m['type'] for m in messages]
+        self.assertEqual(types[:2], ['snapshot', 'snapshot'])
+        self.assertEqual(types.count('l2update'), 2001)
+        self.assertEqual(types.count('heartbeat'), 2 * 3)
+        for message in messages:
+            if message['type'] != 'heartbeat':
+                self.assertNotIn('sequence', message)
+            if 'time' in message:
+                self.assertRegex(message['time'], r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.000000Z$')
+
+
+if __name__ == '__main__':
+    unittest.main()
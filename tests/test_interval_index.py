@@ -0,0 +1,66 @@
+""" IntervalIndex merging, gap finding and removal. """
+
+import unittest
+
+from benchmarks.run import install_config
+
+install_config('http://127.0.0.1:9')
+import get_gdax_candlesticks as candlesticks  # noqa: E402
+
+IntervalIndex = candlesticks.IntervalIndex
+
+
+class IntervalIndexTest(unittest.TestCase):
+
+    def test_add_merges_overlapping_and_adjacent(self):
+        index = IntervalIndex([(50, 60), (0, 10), (20, 30)])
+        self.assertEqual(list(index), [(0, 10), (20, 30), (50, 60)])
+        index.add(10, 20)
+        self.assertEqual(list(index), [(0, 30), (50, 60)])
+        index.add(25, 55)
+        self.assertEqual(list(index), [(0, 60)])
+        index.add(5, 5)
+        self.assertEqual(len(index), 1)
+
+    def test_add_inside_existing_is_a_no_op(self):
+        index = IntervalIndex([(0, 100)])
+        index.add(10, 20)
+        self.assertEqual(list(index), [(0, 100)])
+
+    def test_missing(self):
+        index = IntervalIndex([(10, 20), (30, 40)])
+        self.assertEqual(index.missing(0, 50), [(0, 10), (20, 30), (40, 50)])
+        self.assertEqual(index.missing(10, 40), [(20, 30)])
+        self.assertEqual(index.missing(12, 18), [])
+        self.assertEqual(index.missing(15, 35), [(20, 30)])
+        self.assertEqual(IntervalIndex().missing(0, 5), [(0, 5)])
+
+    def test_remove_splits_and_trims(self):
+        index = IntervalIndex([(0, 100)])
+        index.remove(40, 60)
+        self.assertEqual(list(index), [(0, 40), (60, 100)])
+        index.remove(30, 70)
+        self.assertEqual(list(index), [(0, 30), (70, 100)])
+        index.remove(0, 30)
+        self.assertEqual(list(index), [(70, 100)])
+        index.remove(90, 200)
+        self.assertEqual(list(index), [(70, 90)])
+
+    def test_remove_spanning_several_intervals(self):
+        index = IntervalIndex([(0, 10), (20, 30), (40, 50), (60, 70)])
+        index.remove(5, 45)
+        self.assertEqual(list(index), [(0, 5), (45, 50), (60, 70)])
+        index.remove(50, 60)
+        self.assertEqual(list(index), [(0, 5), (45, 50), (60, 70)])
+        self.assertEqual(index.missing(0, 70), [(5, 45), (50, 60)])
+
+    def test_remove_then_add_round_trips(self):
+        index = IntervalIndex([(0, 600)])
+        index.remove(120, 180)
+        self.assertEqual(index.missing(0, 600), [(120, 180)])
+        index.add(120, 180)
+        self.assertEqual(list(index), [(0, 600)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+""" Live candle builder: coverage after late trades and trade id gaps, and
+    rollup scheduling, against the SQLite stand-in.
+"""
+
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from benchmarks import sqlstore
+from benchmarks.run import install_config
+
+install_config('http://127.0.0.1:9')
+import get_gdax_candlesticks as candlesticks  # noqa: E402
+import get_gdax_live_candlesticks as live  # noqa: E402
+from candle_store import aggregate_candles  # noqa: E402
+
+PRODUCT = 'BTC-USD'
+DAY = 1500000000 - 1500000000 % 86400
+
+
+def match(trade_id, timestamp, price=100.0, size=1.0, msg_type='match'):
+    return {'type': msg_type, 'product_id': PRODUCT, 'trade_id': trade_id,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + '.000000Z',
+            'price': str(price), 'size': str(size)}
+
+
+class LiveCandlesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlstore.connect()
+        self.cursor = self.connection.cursor()
+        candlesticks._watermarks.clear()
+        candlesticks._coverage.clear()
+        live.prepare_tables(self.connection, self.cursor, [PRODUCT])
+        self.builder = live.CandleBuilder(PRODUCT)
+        self.builders = {PRODUCT: self.builder}
+        self.builder.add(match(100, DAY - 30, msg_type='last_match'))
+
+    def tearDown(self):
+        self.connection.close()
+
+    def flush(self, before):
+        live.flush(self.connection, self.cursor, self.builders, before)
+
+    def stored_coverage(self):
+        """ Coverage rows as load_coverage() would merge them. """
+        self.cursor.execute("SELECT start_time, end_time FROM `{}`".format(candlesticks.COVERAGE_TABLE))
+        return list(candlesticks.IntervalIndex(self.cursor.fetchall()))
+
+    def test_gap_uncovers_flushed_minutes(self):
+        self.builder.add(match(101, DAY + 5))
+        self.builder.add(match(102, DAY + 65))
+        self.flush(DAY + 120)
+        self.flush(DAY + 180)
+        self.assertEqual(self.stored_coverage(), [(DAY, DAY + 180)])
+        # Trades 103-106 never arrive; they may belong to any minute from DAY+60 on.
+        self.builder.add(match(107, DAY + 185))
+        self.assertEqual(list(self.builder.late), [(DAY + 60, DAY + 180)])
+        self.assertEqual(sorted(self.builder.bars), [])
+        self.flush(DAY + 240)
+        self.assertEqual(self.stored_coverage(), [(DAY, DAY + 60)])
+        self.assertEqual(list(candlesticks._coverage[self.builder.table]), [(DAY, DAY + 60)])
+        self.builder.add(match(108, DAY + 245))
+        self.flush(DAY + 300)
+        self.assertEqual(self.stored_coverage(), [(DAY, DAY + 60), (DAY + 240, DAY + 300)])
+
+    def test_gap_after_an_open_minute_uncovers_nothing_written(self):
+        self.builder.add(match(101, DAY + 5))
+        self.builder.add(match(102, DAY + 65))
+        self.flush(DAY + 120)
+        self.builder.add(match(103, DAY + 125))
+        # Trades 104-106 came after 103, so they belong to DAY+120 or later.
+        self.builder.add(match(107, DAY + 185))
+        self.assertEqual(list(self.builder.late), [])
+
+    def test_gap_within_open_minutes_uncovers_nothing_written(self):
+        self.builder.add(match(101, DAY + 5))
+        self.flush(DAY + 60)
+        self.builder.add(match(102, DAY + 65))
+        self.builder.add(match(110, DAY + 70))
+        self.assertEqual(list(self.builder.late), [])
+        self.flush(DAY + 120)
+        self.assertEqual(self.stored_coverage(), [(DAY, DAY + 60)])
+
+    def test_late_trade_uncovers_its_minute(self):
+        self.builder.add(match(101, DAY + 5))
+        self.builder.add(match(102, DAY + 65))
+        self.flush(DAY + 120)
+        self.builder.add(match(103, DAY + 50))
+        self.assertEqual(list(self.builder.late), [(DAY, DAY + 60)])
+        self.flush(DAY + 180)
+        self.assertEqual(self.stored_coverage(), [(DAY + 60, DAY + 180)])
+
+    def test_late_ranges_survive_a_reconnect(self):
+        self.builder.add(match(101, DAY + 5))
+        self.flush(DAY + 60)
+        self.builder.add(match(102, DAY + 30))
+        self.builder.reset()
+        self.assertEqual(self.builder.take_late(), [(DAY, DAY + 60)])
+
+    def test_rollups_run_once_per_closed_bucket(self):
+        calls = []
+        update_rollups = candlesticks.update_rollups
+
+        def record(connection, cursor, table, times, granularities):
+            calls.append((len(times), list(granularities)))
+            return update_rollups(connection, cursor, table, times, granularities)
+
+        with mock.patch.object(candlesticks, 'update_rollups', record):
+            for n in range(60):
+                minute = DAY + 60 * n
+                self.builder.add(match(101 + n, minute + 10, price=100 + n % 7, size=1 + n % 3))
+                self.flush(minute + 60)
+
+        hourly = candlesticks.ROLLUP_GRANULARITIES
+        self.assertEqual(len(calls), 12)
+        self.assertEqual(calls[0], (5, [300]))
+        self.assertEqual(calls[2], (15, [300, 900]))
+        self.assertEqual(calls[-1], (60, hourly))
+
+        self.cursor.execute("SELECT time, low, high, open, close, volume FROM `{}` "
+                            "ORDER BY time".format(self.builder.table))
+        minutes = np.asarray(self.cursor.fetchall(), dtype=np.float64)
+        self.assertEqual(len(minutes), 60)
+        for granularity in hourly:
+            self.cursor.execute("SELECT time, low, high, open, close, volume FROM `{}` ORDER BY time".format(
+                candlesticks.rollup_table(self.builder.table, granularity)))
+            stored = np.asarray(self.cursor.fetchall(), dtype=np.float64)
+            np.testing.assert_allclose(stored, aggregate_candles(minutes, granularity))
+        self.assertTrue(all(not pending for pending in self.builder.rollups.values()))
+
+    def test_failed_rollup_is_kept_for_the_next_flush(self):
+        for n in range(5):
+            self.builder.add(match(101 + n, DAY + 60 * n + 10))
+        with mock.patch.object(candlesticks, 'update_rollups', return_value=False):
+            self.flush(DAY + 300)
+        self.assertEqual(len(self.builder.rollups[300]), 5)
+        self.flush(DAY + 600)
+        self.assertEqual(self.builder.rollups[300], set())
+        self.cursor.execute("SELECT COUNT(*) FROM `{}`".format(
+            candlesticks.rollup_table(self.builder.table, 300)))
+        self.assertEqual(self.cursor.fetchone()[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+""" Incremental level2 book: side updates, resync triggers and heartbeats. """
+
+import unittest
+
+import numpy as np
+
+from benchmarks.run import install_config
+
+install_config('http://127.0.0.1:9')
+import get_gdax_live_orderbook as live  # noqa: E402
+
+
+def snapshot(bids, asks):
+    return {'type': 'snapshot', 'product_id': 'BTC-USD',
+            'bids': [[str(p), str(s)] for p, s in bids],
+            'asks': [[str(p), str(s)] for p, s in asks]}
+
+
+def l2update(*changes):
+    return {'type': 'l2update', 'product_id': 'BTC-USD',
+            'changes': [[side, str(p), str(s)] for side, p, s in changes]}
+
+
+def heartbeat(sequence):
+    return {'type': 'heartbeat', 'product_id': 'BTC-USD', 'sequence': sequence}
+
+
+class OrderBookSideTest(unittest.TestCase):
+
+    def test_load_orders_best_first_and_drops_empty_levels(self):
+        bids = live.OrderBookSide(is_bid=True)
+        bids.load([['99', '1'], ['101', '2'], ['100', '0'], ['98', '3']])
+        self.assertEqual(bids.levels().tolist(), [[101, 2], [99, 1], [98, 3]])
+        self.assertEqual(bids.best(), 101)
+        asks = live.OrderBookSide(is_bid=False)
+        asks.load([['103', '1'], ['102', '2'], ['104', '3']])
+        self.assertEqual(asks.levels().tolist(), [[102, 2], [103, 1], [104, 3]])
+        self.assertEqual(asks.best(), 102)
+
+    def test_update_inserts_changes_and_deletes(self):
+        asks = live.OrderBookSide(is_bid=False)
+        asks.load([[102, 1], [104, 1]])
+        asks.update(103, 5)
+        asks.update(101, 2)
+        asks.update(104, 7)
+        asks.update(102, 0)
+        asks.update(110, 0)  # removing an unknown level is ignored
+        self.assertEqual(asks.levels().tolist(), [[101, 2], [103, 5], [104, 7]])
+        self.assertEqual(len(asks), 3)
+
+    def test_update_grows_past_capacity(self):
+        bids = live.OrderBookSide(is_bid=True, capacity=4)
+        for price in range(10):
+            bids.update(price + 1, 1)
+        self.assertEqual(len(bids), 10)
+        self.assertEqual(bids.levels(depth=3)[:, 0].tolist(), [10, 9, 8])
+
+    def test_levels_within_percent(self):
+        bids = live.OrderBookSide(is_bid=True)
+        bids.load([[100, 1], [99.5, 1], [98, 1], [90, 1]])
+        self.assertEqual(bids.levels(within=1)[:, 0].tolist(), [100, 99.5])
+        asks = live.OrderBookSide(is_bid=False)
+        asks.load([[100, 1], [100.5, 1], [104, 1], [120, 1]])
+        self.assertEqual(asks.levels(within=5)[:, 0].tolist(), [100, 100.5, 104])
+
+    def test_matches_rebuilt_side_after_random_updates(self):
+        rng = np.random.RandomState(7)
+        side = live.OrderBookSide(is_bid=True, capacity=8)
+        expected = {}
+        for _ in range(2000):
+            price = float(rng.randint(1, 200))
+            size = float(rng.choice([0, 0, 1, 2, 3]))
+            side.update(price, size)
+            if size:
+                expected[price] = size
+            else:
+                expected.pop(price, None)
+        self.assertEqual(side.levels().tolist(),
+                         [[p, expected[p]] for p in sorted(expected, reverse=True)])
+
+
+class OrderBookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.book = live.OrderBook('BTC-USD')
+        self.book.apply(snapshot([(100, 1), (99, 2)], [(101, 1), (102, 2)]))
+
+    def test_needs_snapshot_before_updates(self):
+        book = live.OrderBook('BTC-USD')
+        self.assertTrue(book.needs_resync)
+        self.assertFalse(book.apply(l2update(('buy', 100, 1))))
+        self.assertFalse(self.book.needs_resync)
+
+    def test_applies_deltas(self):
+        self.assertTrue(self.book.apply(l2update(('buy', 100.5, 3), ('sell', 101, 0))))
+        self.assertEqual(self.book.bids.best(), 100.5)
+        self.assertEqual(self.book.asks.best(), 102)
+        self.assertFalse(self.book.needs_resync)
+
+    def test_crossed_book_needs_resync(self):
+        self.book.apply(l2update(('buy', 101.5, 1)))
+        self.assertTrue(self.book.needs_resync)
+        self.assertFalse(self.book.apply(l2update(('buy', 100, 5))))
+
+    def test_heartbeat_sequence_must_increase(self):
+        now = self.book.last_heartbeat
+        self.assertTrue(self.book._heartbeat(heartbeat(10), now + 1))
+        self.assertTrue(self.book._heartbeat(heartbeat(11), now + 2))
+        self.assertFalse(self.book.needs_resync)
+        self.assertFalse(self.book._heartbeat(heartbeat(11), now + 3))
+        self.assertTrue(self.book.needs_resync)
+
+    def test_late_heartbeat_needs_resync(self):
+        now = self.book.last_heartbeat
+        self.book._heartbeat(heartbeat(10), now + 1)
+        self.assertFalse(self.book._heartbeat(heartbeat(11), now + 2 + live.HEARTBEAT_TIMEOUT))
+        self.assertTrue(self.book.needs_resync)
+
+    def test_check_notices_stopped_heartbeats(self):
+        now = self.book.last_heartbeat
+        self.assertFalse(self.book.check(now + 1))
+        self.assertTrue(self.book.check(now + live.HEARTBEAT_TIMEOUT + 1))
+        self.assertTrue(self.book.needs_resync)
+
+    def test_check_asks_again_when_snapshot_never_comes(self):
+        self.book.expect_snapshot()
+        requested = self.book.resync_requested
+        self.assertTrue(self.book.needs_resync)
+        self.assertFalse(self.book.check(requested + 1))
+        self.assertTrue(self.book.check(requested + live.RESYNC_TIMEOUT + 1))
+        self.book.apply(snapshot([(100, 1)], [(101, 1)]))
+        self.assertFalse(self.book.resync_pending)
+        self.assertFalse(self.book.check(self.book.last_heartbeat + 1))
+
+    def test_snapshot_shape(self):
+        book = self.book.snapshot(depth=1)
+        self.assertEqual(book['product_id'], 'BTC-USD')
+        self.assertEqual(book['bids'].tolist(), [[100, 1]])
+        self.assertEqual(book['asks'].tolist(), [[101, 1]])
+
+
+class FakeCursor(object):
+
+    def __init__(self):
+        self.queries = []
+
+    def executemany(self, query, rows):
+        self.queries.append((query, rows))
+
+
+class FakeConnection(object):
+
+    def commit(self):
+        pass
+
+
+class BandColumnsTest(unittest.TestCase):
+
+    def test_columns_follow_bands(self):
+        volumes = live.get_bid_ask_volumes(snapshot([(100, 1), (98, 2)], [(101, 1), (110, 2)]))
+        self.assertEqual(len(live.ORDERBOOK_COLUMNS), 4 * len(live.BANDS))
+        self.assertTrue(set(live.ORDERBOOK_COLUMNS) <= set(volumes))
+        cursor = FakeCursor()
+        live.insertProductRows(FakeConnection(), cursor, {'BTC-USD': volumes}, timestamp=60)
+        query, rows = cursor.queries[0]
+        self.assertIn(', '.join(live.ORDERBOOK_COLUMNS), query)
+        self.assertEqual(rows, [['BTC-USD', 60] + [volumes[c] for c in live.ORDERBOOK_COLUMNS]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+""" Batch deployment flow against fake SageMaker and Firebase clients. """
+
+import threading
+import unittest
+
+from benchmarks.run import install_config
+
+install_config('http://127.0.0.1:9')
+import create_endpoint_with_sagemaker_model as deploy  # noqa: E402
+
+
+class FakePaginator(object):
+
+    def __init__(self, key, pages):
+        self.key = key
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        for page in self.pages:
+            yield {self.key: page}
+
+
+class FakeSageMaker(object):
+    """ Serves list_* from fixed pages and walks each endpoint through the
+        statuses in `progress` on successive describe_endpoint calls.
+    """
+
+    def __init__(self, models=(), configs=(), endpoints=None, progress=None, page_size=2):
+        self.models = list(models)
+        self.configs = list(configs)
+        self.endpoints = dict(endpoints or {})
+        self.progress = dict((k, list(v)) for k, v in (progress or {}).items())
+        self.page_size = page_size
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _record(self, name, *args):
+        with self.lock:
+            self.calls.append((name,) + args)
+
+    def _pages(self, rows):
+        return [rows[i:i + self.page_size] for i in range(0, len(rows), self.page_size)] or [[]]
+
+    def get_paginator(self, name):
+        self._record(name)
+        if name == 'list_models':
+            return FakePaginator('Models', self._pages([{'ModelName': m} for m in self.models]))
+        if name == 'list_endpoint_configs':
+            return FakePaginator('EndpointConfigs', self._pages(
+                [{'EndpointConfigName': c} for c in self.configs]))
+        return FakePaginator('Endpoints', self._pages(
+            [{'EndpointName': e, 'EndpointStatus': s} for e, s in sorted(self.endpoints.items())]))
+
+    def describe_training_job(self, TrainingJobName):
+        self._record('describe_training_job', TrainingJobName)
+        if TrainingJobName is None:
+            raise RuntimeError('ValidationException')
+        return {'ModelArtifacts': {'S3ModelArtifacts': 's3://models/' + TrainingJobName},
+                'AlgorithmSpecification': {'TrainingImage': 'image'},
+                'RoleArn': 'arn:role'}
+
+    def create_model(self, ModelName, **kwargs):
+        self._record('create_model', ModelName)
+        return {}
+
+    def create_endpoint_config(self, EndpointConfigName, **kwargs):
+        self._record('create_endpoint_config', EndpointConfigName)
+        return {}
+
+    def create_endpoint(self, EndpointName, EndpointConfigName):
+        self._record('create_endpoint', EndpointName)
+        return {}
+
+    def describe_endpoint(self, EndpointName):
+        self._record('describe_endpoint', EndpointName)
+        statuses = self.progress.get(EndpointName) or ['InService']
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        return {'EndpointStatus': status}
+
+    def called(self, name):
+        return sorted(args[1] for args in self.calls if args[0] == name)
+
+
+class FakeFirebase(object):
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.statuses = {}
+        self.lock = threading.Lock()
+
+    def get(self, path, name):
+        model_id = path.split('/')[3]
+        return self.jobs.get(model_id)
+
+    def put(self, path, name, value):
+        with self.lock:
+            self.statuses[path.split('/')[3]] = value
+
+
+class InventoryTest(unittest.TestCase):
+
+    def test_lists_every_page(self):
+        client = FakeSageMaker(models=['a', 'b', 'c'], configs=['a', 'b'],
+                               endpoints={'a': 'InService', 'b': 'Creating', 'c': 'Failed'})
+        inventory = deploy.get_inventory(client)
+        self.assertEqual(inventory['models'], set(['a', 'b', 'c']))
+        self.assertEqual(inventory['configs'], set(['a', 'b']))
+        self.assertEqual(inventory['endpoints'], {'a': 'InService', 'b': 'Creating', 'c': 'Failed'})
+
+
+class WaitForEndpointsTest(unittest.TestCase):
+
+    def test_polls_until_terminal(self):
+        client = FakeSageMaker(progress={'a': ['Creating', 'Creating', 'InService'],
+                                         'b': ['Creating', 'Failed']})
+        statuses = deploy.wait_for_endpoints(client, ['a', 'b'], max_wait=5, poll_interval=0.01)
+        self.assertEqual(statuses, {'a': 'InService', 'b': 'Failed'})
+        # Finished endpoints are not described again.
+        self.assertEqual(client.called('describe_endpoint'), ['a', 'a', 'a', 'b', 'b'])
+
+    def test_gives_up_at_max_wait(self):
+        client = FakeSageMaker(progress={'a': ['Creating']})
+        statuses = deploy.wait_for_endpoints(client, ['a'], max_wait=0.05, poll_interval=0.01)
+        self.assertEqual(statuses, {'a': 'Creating'})
+
+
+class DeployModelsTest(unittest.TestCase):
+
+    def test_creates_only_missing_pieces(self):
+        client = FakeSageMaker(models=['live', 'half'], configs=['live', 'half'],
+                               endpoints={'live': 'InService'},
+                               progress={'half': ['Creating', 'InService'],
+                                         'new': ['Creating', 'InService']})
+        fba = FakeFirebase({'new': 'job-new'})
+        statuses = deploy.deploy_models(client, fba, ['live', 'half', 'new'], poll_interval=0.01)
+
+        self.assertEqual(statuses, {'live': 'InService', 'half': 'InService', 'new': 'InService'})
+        self.assertEqual(fba.statuses, {'live': 'enabled', 'half': 'enabled', 'new': 'enabled'})
+        self.assertEqual(client.called('describe_training_job'), ['job-new'])
+        self.assertEqual(client.called('create_model'), ['new'])
+        self.assertEqual(client.called('create_endpoint_config'), ['new'])
+        self.assertEqual(client.called('create_endpoint'), ['half', 'new'])
+        # The inventory is listed once, not once per model.
+        self.assertEqual([c[0] for c in client.calls if c[0].startswith('list_')],
+                         ['list_models', 'list_endpoint_configs', 'list_endpoints'])
+        self.assertNotIn('live', client.called('describe_endpoint'))
+
+    def test_failed_model_does_not_block_the_rest(self):
+        client = FakeSageMaker(progress={'bad-endpoint': ['Creating', 'Failed']})
+        fba = FakeFirebase({'good': 'job-good', 'bad-endpoint': 'job-bad'})
+        statuses = deploy.deploy_models(client, fba, ['good', 'missing-job', 'bad-endpoint'],
+                                        poll_interval=0.01)
+
+        self.assertEqual(statuses, {'good': 'InService', 'missing-job': 'Failed',
+                                    'bad-endpoint': 'Failed'})
+        self.assertEqual(fba.statuses, {'good': 'enabled', 'missing-job': 'failed',
+                                        'bad-endpoint': 'failed'})
+        self.assertEqual(client.called('create_model'), ['bad-endpoint', 'good'])
+        self.assertNotIn('missing-job', client.called('describe_endpoint'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+""" Shared memory publish/read round trips and the seqlock retry. """
+
+import itertools
+import multiprocessing
+import os
+import unittest
+from unittest import mock
+
+import state_publisher
+
+_names = itertools.count()
+
+
+def _read_in_child(name, key, results):
+    reader = state_publisher.StateReader(name)
+    results.put(reader.latest(key))
+    reader.close()
+
+
+class StatePublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.name = 'test_state_{0}_{1}'.format(os.getpid(), next(_names))
+        self.publisher = state_publisher.StatePublisher(self.name, max_keys=4, depth=3,
+                                                        slot_size=256)
+        self.reader = state_publisher.StateReader(self.name)
+
+    def tearDown(self):
+        self.reader.close()
+        self.publisher.close()
+
+    def test_latest_round_trip(self):
+        self.assertIsNone(self.reader.latest('BTC-USD'))
+        self.publisher.publish('BTC-USD', {'bids': [1.5, 2]}, timestamp=100.0)
+        self.assertEqual(self.reader.latest('BTC-USD'), (100.0, {'bids': [1.5, 2]}))
+        self.publisher.publish('BTC-USD', {'bids': [3]}, timestamp=101.0)
+        self.assertEqual(self.reader.latest('BTC-USD'), (101.0, {'bids': [3]}))
+
+    def test_history_is_newest_first_and_bounded_by_depth(self):
+        for n in range(5):
+            self.publisher.publish('ETH-USD', n, timestamp=float(n))
+        self.assertEqual(self.reader.history('ETH-USD'), [(4.0, 4), (3.0, 3), (2.0, 2)])
+        self.assertEqual(self.reader.history('ETH-USD', 2), [(4.0, 4), (3.0, 3)])
+        self.assertEqual(self.reader.history('LTC-USD'), [])
+
+    def test_keys_and_snapshot_pick_up_new_keys(self):
+        self.publisher.publish_many({'BTC-USD': 1, 'ETH-USD': 2}, timestamp=5.0)
+        self.assertEqual(sorted(self.reader.keys()), ['BTC-USD', 'ETH-USD'])
+        self.publisher.publish('LTC-USD', 3, timestamp=6.0)
+        self.assertEqual(self.reader.snapshot(),
+                         {'BTC-USD': (5.0, 1), 'ETH-USD': (5.0, 2), 'LTC-USD': (6.0, 3)})
+
+    def test_limits(self):
+        with self.assertRaises(ValueError):
+            self.publisher.publish('BTC-USD', 'x' * 300)
+        for n in range(4):
+            self.publisher.publish('key{0}'.format(n), n)
+        with self.assertRaises(ValueError):
+            self.publisher.publish('key4', 4)
+
+    def test_reader_skips_slot_being_written(self):
+        self.publisher.publish('BTC-USD', 'old', timestamp=1.0)
+        self.publisher.publish('BTC-USD', 'new', timestamp=2.0)
+        layout = self.publisher.layout
+        block = layout.block(0)
+        slot = layout.slot(block, 1)
+        seq = state_publisher.HEAD.unpack_from(self.publisher.buf, slot)[0]
+        # A writer stopped between making seq odd and making it even again.
+        state_publisher.HEAD.pack_into(self.publisher.buf, slot, seq + 1)
+        self.assertIsNone(self.reader.latest('BTC-USD'))
+        self.assertEqual(self.reader.history('BTC-USD', 1), [])
+        state_publisher.HEAD.pack_into(self.publisher.buf, slot, seq + 2)
+        self.assertEqual(self.reader.latest('BTC-USD'), (2.0, 'new'))
+
+    def test_reader_retries_when_slot_changes_while_copying(self):
+        self.publisher.publish('BTC-USD', 'first', timestamp=1.0)
+        publisher = self.publisher
+        slot_header = state_publisher.SLOT
+
+        class Racing(object):
+            """ Lets the writer lap the reader right after the first slot header read. """
+            size = slot_header.size
+            reads = 0
+
+            def pack_into(self, *args):
+                slot_header.pack_into(*args)
+
+            def unpack_from(self, *args):
+                value = slot_header.unpack_from(*args)
+                Racing.reads += 1
+                if Racing.reads == 1:
+                    for n, payload in enumerate(['second', 'third', 'fourth']):
+                        publisher.publish('BTC-USD', payload, timestamp=2.0 + n)
+                return value
+
+        with mock.patch.object(state_publisher, 'SLOT', Racing()):
+            self.assertEqual(self.reader.latest('BTC-USD'), (4.0, 'fourth'))
+        self.assertEqual(Racing.reads, 2)
+
+    def test_reader_in_another_process(self):
+        self.publisher.publish('BTC-USD', {'price': 100.5}, timestamp=7.0)
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_read_in_child,
+                                        args=(self.name, 'BTC-USD', results))
+        child.start()
+        result = results.get(timeout=10)
+        child.join()
+        self.assertEqual(tuple(result), (7.0, {'price': 100.5}))
+        # The reader exiting must not unlink the writer's segment.
+        self.publisher.publish('BTC-USD', 1, timestamp=8.0)
+        self.assertEqual(self.reader.latest('BTC-USD'), (8.0, 1))
+
+    def test_replaces_stale_segment(self):
+        stale = state_publisher.StatePublisher(self.name + '_stale', max_keys=2, depth=1,
+                                               slot_size=16)
+        stale.publish('BTC-USD', 1)
+        stale.close(unlink=False)
+        publisher = state_publisher.StatePublisher(self.name + '_stale', max_keys=2, depth=1,
+                                                   slot_size=16)
+        reader = state_publisher.StateReader(self.name + '_stale')
+        self.assertEqual(reader.keys(), [])
+        reader.close()
+        publisher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()